@@ -0,0 +1,172 @@
+import threading
+import time
+from collections import OrderedDict
+from copy import copy
+
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+from rest_framework.authentication import TokenAuthentication
+
+from .metrics import record_lookup
+
+
+class TokenCache:
+    """
+    Token key -> (user, token) cache: a bounded LRU with a TTL in each
+    worker, optionally backed by a shared Django cache.
+
+    Invalidation drops the entries of the current worker and the shared
+    cache, and records the time of revocation of the token or of all the
+    user's tokens in the backend (the default cache without one). Every hit
+    checks these records, so copies cached before the revocation in other
+    workers are not served either.
+    """
+
+    def __init__(self, maxsize, ttl, backend=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.backend = backend
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def shared(self):
+        return caches[self.backend] if self.backend else None
+
+    @property
+    def revocations(self):
+        return caches[self.backend or DEFAULT_CACHE_ALIAS]
+
+    @staticmethod
+    def shared_key(key):
+        return f'auth-token:{key}'
+
+    @staticmethod
+    def revoked_token_key(key):
+        return f'auth-token-revoked:{key}'
+
+    @staticmethod
+    def revoked_user_key(user_id):
+        return f'auth-user-revoked:{user_id}'
+
+    def is_revoked(self, key, entry):
+        """Whether the token or its user was revoked after entry was read."""
+        created, (user, _) = entry
+        revoked = self.revocations.get_many([self.revoked_token_key(key),
+                                             self.revoked_user_key(user.pk)])
+        return any(when >= created for when in revoked.values())
+
+    def get(self, key):
+        shared = False
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                entry = entry[1]
+            else:
+                self._entries.pop(key, None)
+                entry = None
+        if entry is None and self.backend:
+            entry = self.shared.get(self.shared_key(key))
+            shared = True
+        if entry is not None and self.is_revoked(key, entry):
+            with self._lock:
+                self._entries.pop(key, None)
+            entry = None
+        if entry is None:
+            with self._lock:
+                self.misses += 1
+            record_lookup('token', False)
+            return None
+        if shared:
+            self._store(key, entry)
+        with self._lock:
+            self.hits += 1
+        record_lookup('token', True)
+        return entry[1]
+
+    def set(self, key, value, created):
+        """
+        Cache value read from the database at created (time.time()), taken
+        before the read so that a concurrent revocation is not missed.
+        """
+        entry = (created, value)
+        self._store(key, entry)
+        if self.backend:
+            self.shared.set(self.shared_key(key), entry, self.ttl)
+
+    def revoke(self, keys):
+        # Записи живут не дольше ttl, дольше помнить об отзыве не нужно
+        self.revocations.set_many(dict.fromkeys(keys, time.time()),
+                                  self.ttl + 1)
+
+    def _store(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+        if keys:
+            self.revoke([self.revoked_token_key(key) for key in keys])
+        if self.backend and keys:
+            self.shared.delete_many([self.shared_key(key) for key in keys])
+
+    def invalidate_user(self, user_id, keys=()):
+        """Revoke every cached token of the user, dropping the given keys."""
+        self.revoke([self.revoked_user_key(user_id)])
+        with self._lock:
+            for key in [key for key, (_, (_, (user, _)))
+                        in self._entries.items() if user.pk == user_id]:
+                self._entries.pop(key)
+        if self.backend and keys:
+            self.shared.delete_many([self.shared_key(key) for key in keys])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else None,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'backend': self.backend,
+            }
+
+
+token_cache = TokenCache(settings.TOKEN_CACHE_SIZE, settings.TOKEN_CACHE_TTL,
+                         settings.TOKEN_CACHE_BACKEND)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication that skips the Token + User query on cache hits."""
+
+    def authenticate_credentials(self, key):
+        if not token_cache.ttl:
+            return super().authenticate_credentials(key)
+        credentials = token_cache.get(key)
+        if credentials is None:
+            created = time.time()
+            credentials = super().authenticate_credentials(key)
+            token_cache.set(key, credentials, created)
+        user, token = credentials
+        # Каждый запрос получает свою копию пользователя, чтобы изменения
+        # request.user не попадали в общий кеш. Счетчики копии отложены:
+        # при обращении они читаются из базы, а save() их не пишет
+        user = copy(user)
+        for name in user.counter_fields:
+            user.__dict__.pop(name, None)
+        return user, token
@@ -0,0 +1,57 @@
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS
+from django.core.checks import Error, register
+
+# Кэши, которые не видны другим воркерам
+PER_PROCESS_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+@register('replicas')
+def check_replica_sticky_cache(app_configs, **kwargs):
+    """Sticky primary marks have to be seen by every worker."""
+    if not settings.DATABASE_REPLICAS:
+        return []
+    cache = settings.CACHES.get(settings.REPLICA_STICKY_CACHE)
+    if cache is None:
+        return [Error(
+            f'REPLICA_STICKY_CACHE names the missing cache '
+            f'{settings.REPLICA_STICKY_CACHE!r}.',
+            hint='Add it to CACHES or set REPLICA_STICKY_CACHE.',
+            id='api.E001',
+        )]
+    if cache['BACKEND'] in PER_PROCESS_CACHES:
+        return [Error(
+            'Read replicas need a cache shared by all workers, '
+            f'REPLICA_STICKY_CACHE uses {cache["BACKEND"]}.',
+            hint='Set CACHE_BACKEND (and CACHE_LOCATION) or point '
+                 'REPLICA_STICKY_CACHE at a shared cache.',
+            id='api.E002',
+        )]
+    return []
+
+
+@register('caches')
+def check_token_revocation_cache(app_configs, **kwargs):
+    """Token revocations have to be seen by every worker."""
+    if not settings.TOKEN_CACHE_TTL:
+        return []
+    alias = settings.TOKEN_CACHE_BACKEND or DEFAULT_CACHE_ALIAS
+    cache = settings.CACHES.get(alias)
+    if cache is None:
+        return [Error(
+            f'TOKEN_CACHE_BACKEND names the missing cache {alias!r}.',
+            hint='Add it to CACHES or set TOKEN_CACHE_BACKEND.',
+            id='api.E003',
+        )]
+    if cache['BACKEND'] in PER_PROCESS_CACHES:
+        return [Error(
+            'The token cache needs a revocation cache shared by all '
+            f'workers, {alias!r} uses {cache["BACKEND"]}.',
+            hint='Set CACHE_BACKEND or TOKEN_CACHE_BACKEND to a shared '
+                 'cache, or TOKEN_CACHE_TTL=0.',
+            id='api.E004',
+        )]
+    return []
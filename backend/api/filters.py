@@ -1,7 +1,16 @@
+from django.conf import settings
 from django_filters import rest_framework
 from rest_framework import filters
 
+from recipes import ingredient_index
 from recipes.models import Recipe, Tag
+from recipes.search import search as search_recipes
+
+INGREDIENT_PARAMS = ('include_ingredients', 'exclude_ingredients', 'pantry')
+
+
+class NumberInFilter(rest_framework.BaseInFilter, rest_framework.NumberFilter):
+    pass
 
 
 class RecipeFilter(rest_framework.FilterSet):
@@ -13,10 +22,40 @@ class RecipeFilter(rest_framework.FilterSet):
     tags = rest_framework.ModelMultipleChoiceFilter(field_name='tags__slug',
                                                     to_field_name='slug',
                                                     queryset=Tag.objects.all())
+    search = rest_framework.CharFilter(method='filter_search')
+    include_ingredients = NumberInFilter(method='filter_ingredients')
+    exclude_ingredients = NumberInFilter(method='filter_ingredients')
+    pantry = NumberInFilter(method='filter_ingredients')
+    max_missing = rest_framework.NumberFilter(
+        method='filter_ingredients', min_value=0,
+        max_value=settings.INGREDIENT_INDEX_MAX_MISSING
+    )
 
     class Meta:
         model = Recipe
-        fields = ['is_favorited', 'is_in_shopping_cart', 'author', 'tags']
+        fields = ['is_favorited', 'is_in_shopping_cart', 'author', 'tags',
+                  'search', 'include_ingredients', 'exclude_ingredients',
+                  'pantry', 'max_missing']
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        data = self.form.cleaned_data
+        ids = {name: [int(pk) for pk in data.get(name) or ()]
+               for name in INGREDIENT_PARAMS}
+        if any(ids.values()):
+            # Без параметра ordering рецепты из кладовой отсортированы по
+            # покрытию
+            queryset = ingredient_index.filter_recipes(
+                queryset, include=ids['include_ingredients'],
+                exclude=ids['exclude_ingredients'], pantry=ids['pantry'],
+                max_missing=int(data.get('max_missing') or 0)
+            )
+        if data.get('search'):
+            # Поиск - последним: его лимит совпадений применяется к уже
+            # отфильтрованным рецептам, без параметра ordering результаты
+            # отсортированы по релевантности
+            queryset = search_recipes(queryset, data['search'])
+        return queryset
 
     def filter_is_favorited(self, queryset, name, value):
         user = self.request.user
@@ -30,6 +69,30 @@ class RecipeFilter(rest_framework.FilterSet):
             return queryset.filter(buyers__user=user)
         return queryset
 
+    def filter_search(self, queryset, name, value):
+        # Поиск выполняется после остальных фильтров в filter_queryset
+        return queryset
 
-class IngredientSearchFilter(filters.SearchFilter):
+    def filter_ingredients(self, queryset, name, value):
+        # Фильтры по ингредиентам выполняются одним запросом к индексу в
+        # filter_queryset
+        return queryset
+
+
+class RecipeOrderingFilter(filters.OrderingFilter):
+    def get_ordering(self, request, queryset, view):
+        ordering = super().get_ordering(request, queryset, view)
+        if ordering:
+            # id как последний ключ делает порядок однозначным для пагинации
+            return [*ordering, '-id']
+        return ordering
+
+
+class IngredientSearchFilter(filters.BaseFilterBackend):
     search_param = 'name'
+
+    def filter_queryset(self, request, queryset, view):
+        name = request.query_params.get(self.search_param, '').strip()
+        if not name:
+            return queryset
+        return queryset.filter(name_lower__startswith=name.lower())
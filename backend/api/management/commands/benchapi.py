@@ -0,0 +1,329 @@
+"""
+Examples: python manage.py benchapi
+          python manage.py benchapi --scales small,medium --iterations 50
+          python manage.py benchapi --report bench.json --label abc1234
+
+Runs in a throwaway test database: every scale is seeded with
+recipes.synthetic, every endpoint is requested through the DRF test client
+and its query count and latency are recorded. The command exits with an
+error if a query budget is exceeded or an endpoint answers with an
+unexpected status; the JSON report is written in any case.
+"""
+import json
+import tempfile
+import time
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import (CaptureQueriesContext, override_settings,
+                               setup_test_environment,
+                               teardown_test_environment)
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from api.authentication import token_cache
+from recipes import ingredient_index, synthetic
+from recipes.models import (Cart, Favorite, Ingredient, Recipe,
+                            ShoppingListExport, Subscription, Tag)
+from users.models import User
+
+SCALES = {
+    'small': {'users': 50, 'recipes': 300, 'ingredients': 1000},
+    'medium': {'users': 300, 'recipes': 3000, 'ingredients': 3000},
+    'large': {'users': 1000, 'recipes': 20000, 'ingredients': 10000},
+}
+
+NEW_PASSWORD = 'Benchmark-pa55word'
+PIXEL = ('data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAf'
+         'FcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg==')
+
+
+def recipe_data(ctx):
+    return {
+        'name': 'Бенчмарк',
+        'text': 'Рецепт для бенчмарка',
+        'cooking_time': 10,
+        'image': PIXEL,
+        'tags': ctx['tag_ids'][:2],
+        'ingredients': [{'id': ingredient_id, 'amount': 10}
+                        for ingredient_id in ctx['ingredient_ids']],
+    }
+
+
+# name, client, method, path, data, expected status, query budget.
+# Шаги выполняются по кругу; парные шаги (POST/DELETE, create/destroy)
+# возвращают базу в исходное состояние
+STEPS = (
+    ('users.list', 'anonymous', 'get', '/api/users/?limit=6', None, 200, 3),
+    ('users.retrieve', 'user', 'get', '/api/users/{author}/', None, 200, 3),
+    ('users.me', 'user', 'get', '/api/users/me/', None, 200, 3),
+    ('users.subscriptions', 'user', 'get',
+     '/api/users/subscriptions/?limit=6&recipes_limit=3', None, 200, 5),
+    ('users.subscribe', 'user', 'post', '/api/users/{author}/subscribe/',
+     None, 201, 14),
+    ('users.unsubscribe', 'user', 'delete', '/api/users/{author}/subscribe/',
+     None, 204, 7),
+    # Лента заполняется отдельно для каждого автора из списка, при удалении
+    # сигналы post_delete меняют счетчики и ленту для каждой строки
+    ('users.subscribe_bulk', 'user', 'post', '/api/users/subscribe/',
+     lambda ctx: {'ids': ctx['author_ids']}, 201, 30),
+    ('users.unsubscribe_bulk', 'user', 'delete', '/api/users/subscribe/',
+     lambda ctx: {'ids': ctx['author_ids']}, 204, 15),
+    ('users.set_password', 'user', 'post', '/api/users/set_password/',
+     {'current_password': synthetic.PASSWORD,
+      'new_password': NEW_PASSWORD}, 204, 5),
+    ('users.set_password', 'user', 'post', '/api/users/set_password/',
+     {'current_password': NEW_PASSWORD,
+      'new_password': synthetic.PASSWORD}, 204, 5),
+    ('users.auth_cache', 'admin', 'get', '/api/users/auth_cache/', None,
+     200, 2),
+    ('auth.login', 'anonymous', 'post', '/api/auth/token/login/',
+     lambda ctx: {'email': ctx['email'], 'password': synthetic.PASSWORD},
+     200, 6),
+    ('auth.logout', 'login', 'post', '/api/auth/token/logout/', None, 204,
+     6),
+    ('tags.list', 'anonymous', 'get', '/api/tags/', None, 200, 1),
+    ('tags.retrieve', 'anonymous', 'get', '/api/tags/{tag}/', None, 200, 1),
+    ('ingredients.list', 'anonymous', 'get', '/api/ingredients/', None, 200,
+     2),
+    ('ingredients.retrieve', 'anonymous', 'get',
+     '/api/ingredients/{ingredient}/', None, 200, 1),
+    ('ingredients.search', 'anonymous', 'get',
+     '/api/ingredients/?name=ингредиент 1', None, 200, 1),
+    ('ingredients.autocomplete', 'anonymous', 'get',
+     '/api/ingredients/autocomplete/?name=ингредиент 1', None, 200, 2),
+    ('recipes.list.anonymous', 'anonymous', 'get',
+     '/api/recipes/?page=2&limit=6', None, 200, 7),
+    ('recipes.list.tags', 'anonymous', 'get',
+     '/api/recipes/?limit=6&tags={tag_slug}&tags={other_tag_slug}', None,
+     200, 7),
+    ('recipes.list', 'user', 'get', '/api/recipes/?limit=6', None, 200, 7),
+    ('recipes.list.favorited', 'user', 'get',
+     '/api/recipes/?limit=6&is_favorited=1', None, 200, 7),
+    ('recipes.list.in_cart', 'user', 'get',
+     '/api/recipes/?limit=6&is_in_shopping_cart=1', None, 200, 7),
+    ('recipes.list.popular', 'user', 'get',
+     '/api/recipes/?limit=6&ordering=-favorites_count', None, 200, 7),
+    ('recipes.list.cursor', 'user', 'get', '/api/recipes/?cursor=', None,
+     200, 6),
+    ('recipes.list.search', 'user', 'get',
+     '/api/recipes/?limit=6&search=рецепт+7', None, 200, 7),
+    ('recipes.list.ingredients', 'user', 'get',
+     '/api/recipes/?limit=6&include_ingredients={ingredient}', None, 200, 8),
+    ('recipes.list.pantry', 'user', 'get',
+     '/api/recipes/?limit=6&pantry={pantry}&max_missing=2', None, 200, 7),
+    ('recipes.retrieve', 'user', 'get', '/api/recipes/{recipe}/', None, 200,
+     6),
+    ('recipes.feed', 'user', 'get', '/api/recipes/feed/', None, 200, 9),
+    ('recipes.create', 'user', 'post', '/api/recipes/', recipe_data, 201,
+     16),
+    ('recipes.update', 'user', 'patch', '/api/recipes/{created}/',
+     lambda ctx: {'name': 'Бенчмарк 2', 'ingredients': [
+         {'id': ctx['ingredient_ids'][0], 'amount': 20}
+     ]}, 200, 16),
+    ('recipes.destroy', 'user', 'delete', '/api/recipes/{created}/', None,
+     204, 20),
+    ('recipes.favorite', 'user', 'post', '/api/recipes/{recipe}/favorite/',
+     None, 201, 5),
+    ('recipes.unfavorite', 'user', 'delete',
+     '/api/recipes/{recipe}/favorite/', None, 204, 6),
+    ('recipes.favorite_bulk', 'user', 'post', '/api/recipes/favorite/',
+     lambda ctx: {'ids': ctx['recipe_ids']}, 201, 5),
+    ('recipes.unfavorite_bulk', 'user', 'delete', '/api/recipes/favorite/',
+     lambda ctx: {'ids': ctx['recipe_ids']}, 204, 15),
+    ('recipes.shopping_cart', 'user', 'post',
+     '/api/recipes/{recipe}/shopping_cart/', None, 201, 5),
+    ('recipes.shopping_cart_remove', 'user', 'delete',
+     '/api/recipes/{recipe}/shopping_cart/', None, 204, 6),
+    ('recipes.shopping_cart_bulk', 'user', 'post',
+     '/api/recipes/shopping_cart/', lambda ctx: {'ids': ctx['recipe_ids']},
+     201, 5),
+    ('recipes.shopping_cart_remove_bulk', 'user', 'delete',
+     '/api/recipes/shopping_cart/', lambda ctx: {'ids': ctx['recipe_ids']},
+     204, 15),
+    ('recipes.download_shopping_cart', 'user', 'get',
+     '/api/recipes/download_shopping_cart/', None, 200, 3),
+    ('recipes.shopping_cart_export', 'user', 'get',
+     '/api/recipes/shopping_cart_exports/{export}/', None, 200, 2),
+)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Command(BaseCommand):
+    help = 'Benchmark API query counts and latency on synthetic data'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scales', default='small,medium',
+                            help=f"comma separated: {', '.join(SCALES)}")
+        parser.add_argument('--iterations', type=int, default=20,
+                            help="measured rounds over all endpoints")
+        parser.add_argument('--warmup', type=int, default=1,
+                            help="unmeasured rounds before measuring")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--report', help="write the JSON report here")
+        parser.add_argument('--label',
+                            help="stored in the report, e.g. a commit id")
+
+    def handle(self, *args, **options):
+        scales = options['scales'].split(',')
+        unknown = set(scales) - set(SCALES)
+        if unknown:
+            raise CommandError(f"Unknown scales: {', '.join(unknown)}")
+
+        report = {
+            'label': options['label'],
+            'created': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'iterations': options['iterations'],
+            'scales': {},
+            'failures': [],
+        }
+        old_name = connection.settings_dict['NAME']
+        setup_test_environment()
+        connection.creation.create_test_db(verbosity=0, autoclobber=True,
+                                           serialize=False)
+        try:
+            with tempfile.TemporaryDirectory() as media_root, \
+                    override_settings(MEDIA_ROOT=media_root,
+                                      DATABASE_REPLICAS=[]):
+                for scale in scales:
+                    report['scales'][scale] = self.run_scale(
+                        scale, options, report['failures']
+                    )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        if options['report']:
+            with open(options['report'], 'w') as report_file:
+                json.dump(report, report_file, ensure_ascii=False, indent=2)
+        if report['failures']:
+            raise CommandError('\n'.join(report['failures']))
+
+    def run_scale(self, scale, options, failures):
+        call_command('flush', interactive=False, verbosity=0)
+        cache.clear()
+        token_cache.clear()
+        started = time.monotonic()
+        dataset = synthetic.build(seed=options['seed'], **SCALES[scale])
+        self.stdout.write(f'{scale}: dataset built in '
+                          f'{time.monotonic() - started:.1f}s {dataset}')
+        # Как воркер, построенный при старте индекс ингредиентов
+        ingredient_index._indexes.clear()
+        ingredient_index.prewarm()
+
+        ctx, clients = self.prepare(scale)
+        for _ in range(options['warmup']):
+            self.run_round(ctx, clients)
+        samples = {}
+        for _ in range(options['iterations']):
+            for name, elapsed, queries, status, expected in self.run_round(
+                    ctx, clients):
+                sample = samples.setdefault(name, {'ms': [], 'queries': [],
+                                                   'statuses': set()})
+                sample['ms'].append(elapsed * 1000)
+                sample['queries'].append(queries)
+                sample['statuses'].add(status)
+                if status != expected:
+                    failures.append(f'{scale} {name}: status {status}, '
+                                    f'expected {expected}')
+
+        budgets = {step[0]: step[6] for step in STEPS}
+        endpoints = {}
+        self.stdout.write(f"{'endpoint':<36}{'queries':>8}{'budget':>8}"
+                          f"{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}")
+        for name, sample in samples.items():
+            max_queries = max(sample['queries'])
+            endpoints[name] = {
+                'queries': {'min': min(sample['queries']),
+                            'max': max_queries},
+                'budget': budgets[name],
+                'statuses': sorted(sample['statuses']),
+                'ms': {key: round(percentile(sample['ms'], fraction), 2)
+                       for key, fraction in (('p50', 0.5), ('p90', 0.9),
+                                             ('p99', 0.99), ('max', 1))},
+            }
+            if max_queries > budgets[name]:
+                failures.append(f'{scale} {name}: {max_queries} queries, '
+                                f'budget {budgets[name]}')
+            ms = endpoints[name]['ms']
+            self.stdout.write(f"{name:<36}{max_queries:>8}{budgets[name]:>8}"
+                              f"{ms['p50']:>9}{ms['p90']:>9}{ms['p99']:>9}")
+        return {'dataset': dataset, 'endpoints': endpoints}
+
+    def prepare(self, scale):
+        """Pick the objects the endpoints work on and log the clients in."""
+        # Выход в djoser удаляет токен пользователя, поэтому вход и выход
+        # выполняются отдельным аккаунтом
+        user, admin, guest = User.objects.order_by('id')[:3]
+        User.objects.filter(pk=admin.pk).update(is_staff=True)
+        # Рецепты и авторы, с которыми связи создаются и удаляются в каждом
+        # круге, заранее отвязываются от пользователя
+        recipe_ids = list(Recipe.objects.exclude(author=user).order_by(
+            'id'
+        ).values_list('id', flat=True)[:11])
+        author_ids = list(User.objects.exclude(pk=user.pk).filter(
+            recipes_count__gt=0
+        ).order_by('recipes_count', 'id').values_list('id', flat=True)[:6])
+        for model in (Favorite, Cart):
+            model.objects.filter(user=user, recipe_id__in=recipe_ids).delete()
+        Subscription.objects.filter(user=user,
+                                    author_id__in=author_ids).delete()
+
+        tags = list(Tag.objects.order_by('id')[:2])
+        ctx = {
+            'email': guest.email,
+            'author': author_ids[0],
+            'author_ids': author_ids[1:],
+            'recipe': recipe_ids[0],
+            'recipe_ids': recipe_ids[1:],
+            'tag': tags[0].id,
+            'tag_slug': tags[0].slug,
+            'other_tag_slug': tags[-1].slug,
+            'tag_ids': [tag.id for tag in tags],
+            'ingredient': Ingredient.objects.order_by('id')[0].id,
+            'ingredient_ids': list(Ingredient.objects.order_by(
+                'id'
+            ).values_list('id', flat=True)[:10]),
+            'pantry': ','.join(map(str, Ingredient.objects.order_by(
+                'id'
+            ).values_list('id', flat=True)[:30])),
+            'export': ShoppingListExport.objects.create(user=user).id,
+            'created': None,
+        }
+        clients = {'anonymous': APIClient(), 'login': APIClient()}
+        for name, account in (('user', user), ('admin', admin)):
+            token, _ = Token.objects.get_or_create(user=account)
+            clients[name] = APIClient()
+            clients[name].credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        return ctx, clients
+
+    def run_round(self, ctx, clients):
+        results = []
+        for name, client, method, path, data, expected, _ in STEPS:
+            if callable(data):
+                data = data(ctx)
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                response = getattr(clients[client], method)(
+                    path.format(**ctx), data, format='json'
+                )
+                elapsed = time.perf_counter() - started
+            if response.status_code == expected:
+                if name == 'recipes.create':
+                    ctx['created'] = response.data['id']
+                elif name == 'auth.login':
+                    token = response.data['auth_token']
+                    clients['login'].credentials(
+                        HTTP_AUTHORIZATION=f'Token {token}'
+                    )
+            results.append((name, elapsed, len(queries), response.status_code,
+                            expected))
+        return results
@@ -0,0 +1,115 @@
+"""
+Examples: python manage.py renderexports
+          python manage.py renderexports --once
+"""
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from recipes.models import ShoppingListExport
+
+from api.utils import (get_cached_shopping_list, get_shopping_list,
+                       shopping_list_version)
+
+
+class Command(BaseCommand):
+    help = 'Render pending shopping list exports to PDF'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help="exit when the queue is empty")
+        parser.add_argument('--sleep', type=float, default=1.0,
+                            help="seconds to wait when the queue is empty")
+
+    def handle(self, *args, **options):
+        cleaned = None
+        while True:
+            export = self.claim()
+            if export is None:
+                # Очистка - в паузах между задачами, не чаще раза в минуту
+                if cleaned is None or time.monotonic() - cleaned > 60:
+                    self.cleanup()
+                    cleaned = time.monotonic()
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
+                continue
+            self.render(export)
+            self.stdout.write(f'Export {export.pk}: {export.status}')
+
+    def claim(self):
+        now = timezone.now()
+        abandoned = Q(
+            status=ShoppingListExport.PROCESSING,
+            started__lt=now - timedelta(
+                seconds=settings.SHOPPING_LIST_EXPORT_LEASE_SECONDS
+            )
+        )
+        # Задачи, на которых воркер падал каждый раз, больше не берутся
+        ShoppingListExport.objects.filter(
+            abandoned,
+            attempts__gte=settings.SHOPPING_LIST_EXPORT_MAX_ATTEMPTS
+        ).update(status=ShoppingListExport.FAILED,
+                 error='Rendering did not finish.', finished=now)
+        # skip_locked позволяет запускать несколько воркеров параллельно
+        with transaction.atomic():
+            export = ShoppingListExport.objects.select_for_update(
+                skip_locked=True
+            ).filter(
+                Q(status=ShoppingListExport.PENDING) | abandoned
+            ).order_by('pk').first()
+            if export is None:
+                return None
+            export.status = ShoppingListExport.PROCESSING
+            export.started = now
+            export.attempts += 1
+            export.save(update_fields=['status', 'started', 'attempts'])
+        return export
+
+    def render(self, export):
+        try:
+            items = list(get_shopping_list(export.user))
+            content = get_cached_shopping_list(
+                export.user, items, shopping_list_version(items)
+            )
+        except Exception as err:
+            export.status = ShoppingListExport.FAILED
+            export.error = str(err)
+        else:
+            export.file.save(f'{uuid.uuid4().hex}.pdf', ContentFile(content),
+                             save=False)
+            export.status = ShoppingListExport.DONE
+        export.finished = timezone.now()
+        # Если аренда истекла и задачу взял другой воркер, результат
+        # остается за ним
+        saved = ShoppingListExport.objects.filter(
+            pk=export.pk, status=ShoppingListExport.PROCESSING,
+            started=export.started
+        ).update(status=export.status, file=export.file.name,
+                 error=export.error, finished=export.finished)
+        if not saved and export.file:
+            export.file.delete(save=False)
+
+    def cleanup(self):
+        """Delete finished exports and their files past retention."""
+        expired = list(ShoppingListExport.objects.filter(
+            status__in=[ShoppingListExport.DONE, ShoppingListExport.FAILED],
+            finished__lt=timezone.now() - timedelta(
+                seconds=settings.SHOPPING_LIST_EXPORT_RETENTION_SECONDS
+            )
+        ).only('id', 'file'))
+        for export in expired:
+            if export.file:
+                export.file.delete(save=False)
+        if expired:
+            ShoppingListExport.objects.filter(
+                pk__in=[export.pk for export in expired]
+            ).delete()
+            self.stdout.write(f'Deleted {len(expired)} expired exports')
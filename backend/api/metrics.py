@@ -0,0 +1,292 @@
+"""
+In-process metrics registry exposed in the Prometheus text format.
+
+Each process keeps its samples in memory. With METRICS_MULTIPROC_DIR set
+(gunicorn with several workers) a process also writes its samples to
+<dir>/<pid>.json, at most every METRICS_FLUSH_INTERVAL seconds, and
+/metrics merges the files of all workers: counters and histograms are
+summed over every file, gauges over live processes only.
+"""
+import json
+import math
+import os
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.http import HttpResponse
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.values = {}
+        self.lock = threading.Lock()
+        self.flushed = 0
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        self.values[metric.name] = {}
+
+    def update(self, metric, key, change):
+        with self.lock:
+            values = self.values[metric.name]
+            values[key] = change(values.get(key))
+
+    def snapshot(self):
+        with self.lock:
+            return {name: {key: list(value) if isinstance(value, list)
+                           else value for key, value in values.items()}
+                    for name, values in self.values.items()}
+
+    @property
+    def directory(self):
+        return settings.METRICS_MULTIPROC_DIR
+
+    def maybe_flush(self):
+        if (self.directory and time.monotonic() - self.flushed
+                >= settings.METRICS_FLUSH_INTERVAL):
+            self.flush()
+
+    def flush(self):
+        """Write this process' samples to its file in the shared dir."""
+        if not self.directory:
+            return
+        self.flushed = time.monotonic()
+        data = {name: [[list(key), value] for key, value in values.items()]
+                for name, values in self.snapshot().items()}
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        temporary = f'{path}.tmp'
+        with open(temporary, 'w') as file:
+            json.dump(data, file)
+        os.replace(temporary, path)
+
+    def collect(self):
+        """Samples of all processes merged per metric and label values."""
+        if not self.directory:
+            return self.snapshot()
+        self.flush()
+        merged = {name: {} for name in self.metrics}
+        for entry in os.listdir(self.directory):
+            if not entry.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, entry)) as file:
+                    data = json.load(file)
+            except (OSError, ValueError):
+                continue
+            alive = process_alive(int(entry[:-len('.json')]))
+            for name, samples in data.items():
+                metric = self.metrics.get(name)
+                if metric is None or (metric.kind == 'gauge' and not alive):
+                    continue
+                for key, value in samples:
+                    key = tuple(key)
+                    merged[name][key] = metric.merge(merged[name].get(key),
+                                                     value)
+        return merged
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        REGISTRY.register(self)
+
+    def key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def merge(self, total, value):
+        return (total or 0) + value
+
+    def samples(self, key, value):
+        yield self.name, self.labels, key, value
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        REGISTRY.update(self, self.key(labels),
+                        lambda value: (value or 0) + amount)
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, amount, **labels):
+        # Значение: число наблюдений по корзинам (не накопленное), затем
+        # общее число и сумма
+        index = next((index for index, bound in enumerate(self.buckets)
+                      if amount <= bound), len(self.buckets))
+
+        def change(value):
+            value = value or [0] * (len(self.buckets) + 3)
+            value[index] += 1
+            value[-2] += 1
+            value[-1] += amount
+            return value
+        REGISTRY.update(self, self.key(labels), change)
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def merge(self, total, value):
+        if total is None:
+            return list(value)
+        return [a + b for a, b in zip(total, value)]
+
+    def samples(self, key, value):
+        labels = self.labels + ('le',)
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), value):
+            cumulative += count
+            yield (f'{self.name}_bucket', labels,
+                   key + (format_bound(bound),), cumulative)
+        yield f'{self.name}_count', self.labels, key, value[-2]
+        yield f'{self.name}_sum', self.labels, key, value[-1]
+
+
+def format_bound(bound):
+    return '+Inf' if bound == math.inf else repr(float(bound))
+
+
+def escape(value):
+    return (value.replace('\\', r'\\').replace('\n', r'\n')
+            .replace('"', r'\"'))
+
+
+def format_sample(name, labels, key, value):
+    if labels:
+        pairs = ','.join(f'{label}="{escape(item)}"'
+                         for label, item in zip(labels, key))
+        name = f'{name}{{{pairs}}}'
+    return f'{name} {value}'
+
+
+REQUEST_DURATION = Histogram(
+    'http_request_duration_seconds', 'API request duration.',
+    ('view', 'method', 'status')
+)
+REQUEST_QUERIES = Histogram(
+    'http_request_db_queries', 'SQL queries per API request.',
+    ('view', 'method', 'status'), buckets=QUERY_BUCKETS
+)
+REQUESTS_IN_FLIGHT = Gauge('http_requests_in_flight',
+                           'Requests being handled.')
+PDF_RENDER_DURATION = Histogram('shopping_list_pdf_render_seconds',
+                                'Shopping list PDF render time.')
+CACHE_LOOKUPS = Counter('cache_lookups_total', 'Cache lookups by result.',
+                        ('cache', 'result'))
+
+
+def record_lookup(cache, hit):
+    """Count a lookup in the named cache as a hit or a miss."""
+    CACHE_LOOKUPS.inc(cache=cache, result='hit' if hit else 'miss')
+
+
+def exposition():
+    collected = REGISTRY.collect()
+    lines = []
+    for name, metric in REGISTRY.metrics.items():
+        lines.append(f'# HELP {name} {metric.documentation}')
+        lines.append(f'# TYPE {name} {metric.kind}')
+        for key, value in sorted(collected[name].items()):
+            lines += [format_sample(*sample)
+                      for sample in metric.samples(key, value)]
+
+    # Доля попаданий считается по суммарным обращениям всех процессов
+    lookups = {}
+    for (cache, result), count in collected[CACHE_LOOKUPS.name].items():
+        lookups.setdefault(cache, {})[result] = count
+    lines.append('# HELP cache_hit_ratio Cache hits to lookups.')
+    lines.append('# TYPE cache_hit_ratio gauge')
+    for cache, results in sorted(lookups.items()):
+        total = sum(results.values())
+        ratio = results.get('hit', 0) / total if total else 0
+        lines.append(format_sample('cache_hit_ratio', ('cache',), (cache,),
+                                   round(ratio, 6)))
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    return HttpResponse(exposition(),
+                        content_type='text/plain; version=0.0.4; '
+                                     'charset=utf-8')
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = QueryCounter()
+        REQUESTS_IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(queries))
+                response = self.get_response(request)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+        duration = time.perf_counter() - started
+
+        match = request.resolver_match
+        labels = {'view': match.view_name if match else 'unmatched',
+                  'method': request.method,
+                  'status': response.status_code}
+        REQUEST_DURATION.observe(duration, **labels)
+        REQUEST_QUERIES.observe(queries.count, **labels)
+        REGISTRY.maybe_flush()
+        return response
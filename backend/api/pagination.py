@@ -1,5 +1,248 @@
-from rest_framework.pagination import PageNumberPagination
+import base64
+import hashlib
+import json
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.core.paginator import EmptyPage, Page, Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import PageNumberPagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from recipes.feed import get_feed
+from recipes.models import Recipe
+
+from .metrics import record_lookup
+
+
+class CountingPage(Page):
+    def has_next(self):
+        if self.paginator.count_is_exact:
+            return super().has_next()
+        return self.has_more
+
+
+class CountingPaginator(Paginator):
+    """
+    Paginator that avoids exact COUNT(*) where it is expensive.
+
+    Unfiltered querysets over large PostgreSQL tables use the planner's
+    reltuples estimate, filtered counts are cached for a short TTL keyed by
+    the query SQL and stop at PAGINATION_COUNT_CAP rows. count_is_exact
+    tells whether count can be trusted: only a count just computed and not
+    capped is. Otherwise pages are not bounded by count, and one row past
+    the page tells whether there is a next one.
+    """
+    count_is_exact = True
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = self.get_estimate(queryset)
+            if estimate is not None:
+                self.count_is_exact = False
+                return estimate
+
+        try:
+            sql, params = queryset.query.sql_with_params()
+        except EmptyResultSet:
+            # Запрос заведомо пустой, например queryset.none()
+            return 0
+        key = hashlib.md5(f'{sql}{params}'.encode()).hexdigest()
+        key = f'pagination_count:{queryset.db}:{key}'
+        cached = cache.get(key)
+        record_lookup('pagination_count', cached is not None)
+        if cached is not None:
+            # Данные могли измениться за время жизни кэша, такой count не
+            # годится как граница страниц
+            self.count_is_exact = False
+            return cached[0]
+        cap = settings.PAGINATION_COUNT_CAP
+        count = queryset.values('pk')[:cap + 1].count()
+        cached = (min(count, cap), count <= cap)
+        cache.set(key, cached, settings.PAGINATION_COUNT_CACHE_TIMEOUT)
+        count, self.count_is_exact = cached
+        return count
+
+    def get_estimate(self, queryset):
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql':
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT reltuples::bigint FROM pg_class '
+                'WHERE oid = %s::regclass',
+                [connection.ops.quote_name(queryset.model._meta.db_table)]
+            )
+            row = cursor.fetchone()
+        if row is None or row[0] < settings.PAGINATION_ESTIMATE_THRESHOLD:
+            return None
+        return row[0]
+
+    def validate_number(self, number):
+        self.count
+        if self.count_is_exact:
+            return super().validate_number(number)
+        # Для приблизительного count не обрезаем номер страницы сверху
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            return super().validate_number(number)
+        return max(number, 1)
+
+    def page(self, number):
+        number = self.validate_number(number)
+        if self.count_is_exact:
+            return super().page(number)
+        bottom = (number - 1) * self.per_page
+        top = bottom + self.per_page
+        rows = list(self.object_list[bottom:top + 1])
+        if not rows and number > 1:
+            raise EmptyPage(_('That page contains no results'))
+        page = self._get_page(rows[:self.per_page], number, self)
+        page.has_more = len(rows) > self.per_page
+        return page
+
+    def _get_page(self, *args, **kwargs):
+        return CountingPage(*args, **kwargs)
 
 
 class FoodgramPagination(PageNumberPagination):
+    """
+    Page number pagination with an opt-in keyset mode.
+
+    Passing the cursor query parameter (empty for the first page) switches
+    to keyset pagination over view.cursor_ordering: instead of OFFSET and
+    COUNT(*) every page is a range scan that starts after the last row of
+    the previous page. Querysets with their own order (ordering, search,
+    pantry) are rejected in this mode.
+    """
+    django_paginator_class = CountingPaginator
     page_size_query_param = 'limit'
+    cursor_query_param = 'cursor'
+    cursor_ordering = ('-pub_date', '-id')
+    cursor_page_size = 6
+    cursor_max_page_size = 100
+    invalid_cursor_message = 'Invalid cursor.'
+    cursor_ordering_message = ('Cursor pagination cannot be combined with '
+                               'ordering, search or pantry.')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.use_cursor = self.cursor_query_param in request.query_params
+        if not self.use_cursor:
+            return super().paginate_queryset(queryset, request, view)
+
+        if queryset.query.order_by:
+            # Порядок по релевантности, покрытию кладовой или параметру
+            # ordering курсор по cursor_ordering не сохранит
+            raise ValidationError(
+                {self.cursor_query_param: [self.cursor_ordering_message]}
+            )
+        self.request = request
+        self.ordering = getattr(view, 'cursor_ordering', self.cursor_ordering)
+        self.fields = [queryset.model._meta.get_field(name.lstrip('-'))
+                       for name in self.ordering]
+        page_size = self.get_cursor_page_size(request)
+        position = self.decode_cursor(request)
+
+        queryset = queryset.order_by(*self.ordering)
+        if position is not None:
+            queryset = queryset.filter(self.get_position_filter(position))
+        results = list(queryset[:page_size + 1])
+
+        self.next_position = None
+        if len(results) > page_size:
+            results = results[:page_size]
+            self.next_position = [getattr(results[-1], field.attname)
+                                  for field in self.fields]
+        return results
+
+    def get_paginated_response(self, data):
+        if not self.use_cursor:
+            return Response(OrderedDict([
+                ('count', self.page.paginator.count),
+                ('count_is_exact', self.page.paginator.count_is_exact),
+                ('next', self.get_next_link()),
+                ('previous', self.get_previous_link()),
+                ('results', data)
+            ]))
+        return Response(OrderedDict([
+            ('next', self.get_next_cursor_link()),
+            ('results', data)
+        ]))
+
+    def get_cursor_page_size(self, request):
+        try:
+            return _positive_int(
+                request.query_params[self.page_size_query_param],
+                strict=True,
+                cutoff=self.cursor_max_page_size
+            )
+        except (KeyError, ValueError):
+            return self.cursor_page_size
+
+    def get_position_filter(self, position):
+        """Rows strictly after position in (f1, f2, ...) ordering."""
+        condition = Q()
+        for index, name in enumerate(self.ordering):
+            lookup = 'lt' if name.startswith('-') else 'gt'
+            equal = {field.name: value for field, value in
+                     zip(self.fields[:index], position[:index])}
+            condition |= Q(
+                **{f'{self.fields[index].name}__{lookup}': position[index]},
+                **equal
+            )
+        return condition
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            values = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            if len(values) != len(self.fields):
+                raise ValueError
+            return [field.to_python(value)
+                    for field, value in zip(self.fields, values)]
+        except Exception:
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, position):
+        values = [value.isoformat() if hasattr(value, 'isoformat') else value
+                  for value in position]
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    def get_next_cursor_link(self):
+        if self.next_position is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param,
+                                   self.encode_cursor(self.next_position))
+
+
+class FeedPagination(FoodgramPagination):
+    """Keyset pagination over the user's subscriptions feed."""
+
+    def paginate_feed(self, request):
+        """Return recipe ids of the requested feed page, newest first."""
+        self.use_cursor = True
+        self.request = request
+        self.fields = [Recipe._meta.get_field('pub_date'),
+                       Recipe._meta.get_field('id')]
+        page_size = self.get_cursor_page_size(request)
+        position = self.decode_cursor(request)
+
+        rows = get_feed(request.user, position, page_size + 1)
+        self.next_position = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            self.next_position = list(rows[-1])
+        return [recipe_id for _, recipe_id in rows]
@@ -0,0 +1,169 @@
+"""
+Opt-in request profiling (PROFILING_ENABLED).
+
+Every request gets a Server-Timing header and one JSON log line with the
+number of SQL queries, the time spent in the database and in named blocks
+(see timed), and the queries repeated within the request grouped by
+normalized SQL, which is what N+1 patterns look like. A sampled share of
+requests runs under cProfile; the profiles of the slowest of them are kept
+in PROFILING_DIR.
+"""
+import cProfile
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+_IN_LIST = re.compile(r'IN \((?:%s, )*%s\)')
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+_SPACES = re.compile(r'\s+')
+
+
+def normalize(sql):
+    """SQL with literals and IN lists of any length replaced by markers."""
+    sql = _IN_LIST.sub('IN (...)', sql)
+    sql = _LITERAL.sub('?', sql)
+    return _SPACES.sub(' ', sql).strip()
+
+
+class RequestProfile:
+    """Queries and timings of a single request."""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0
+        self.timings = defaultdict(float)
+        self.patterns = defaultdict(lambda: [0, 0.0])
+        self.statements = defaultdict(int)
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.queries += 1
+            self.db_time += elapsed
+            pattern = self.patterns[normalize(sql)]
+            pattern[0] += 1
+            pattern[1] += elapsed
+            self.statements[(sql, repr(params))] += 1
+
+    def repeated(self):
+        """Normalized queries run more than once, most frequent first."""
+        repeated = [(sql, count, elapsed)
+                    for sql, (count, elapsed) in self.patterns.items()
+                    if count > 1]
+        repeated.sort(key=lambda item: (-item[1], -item[2]))
+        return [{'sql': sql[:500], 'count': count,
+                 'ms': round(elapsed * 1000, 2)}
+                for sql, count, elapsed in repeated[:settings.PROFILING_TOP]]
+
+    def server_timing(self, duration):
+        metrics = [f'db;dur={self.db_time * 1000:.1f};'
+                   f'desc="{self.queries} queries"']
+        metrics += [f'{name};dur={elapsed * 1000:.1f}'
+                    for name, elapsed in self.timings.items()]
+        # Остальное время - Python: сериализация, рендеринг, middleware
+        app = duration - self.db_time - sum(self.timings.values())
+        metrics.append(f'app;dur={max(app, 0) * 1000:.1f}')
+        metrics.append(f'total;dur={duration * 1000:.1f}')
+        return ', '.join(metrics)
+
+
+def current():
+    """Profile of the request being handled by this thread, if any."""
+    return getattr(_local, 'profile', None)
+
+
+@contextmanager
+def timed(name):
+    """Add the duration of the block to the current request's timings."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile = current()
+        if profile is not None:
+            profile.timings[name] += time.perf_counter() - started
+
+
+class ProfilingMiddleware:
+    def __init__(self, get_response):
+        if not settings.PROFILING_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        profile = RequestProfile()
+        profiler = None
+        if random.random() < settings.PROFILING_SAMPLE_RATE:
+            profiler = cProfile.Profile()
+        _local.profile = profile
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(profile))
+                if profiler is not None:
+                    profiler.enable()
+                try:
+                    response = self.get_response(request)
+                finally:
+                    if profiler is not None:
+                        profiler.disable()
+        finally:
+            _local.profile = None
+        duration = time.perf_counter() - started
+
+        response['Server-Timing'] = profile.server_timing(duration)
+        match = request.resolver_match
+        logger.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'view': match.view_name if match else None,
+            'status': response.status_code,
+            'ms': round(duration * 1000, 2),
+            'queries': profile.queries,
+            'db_ms': round(profile.db_time * 1000, 2),
+            'timings_ms': {name: round(elapsed * 1000, 2)
+                           for name, elapsed in profile.timings.items()},
+            'duplicates': sum(count - 1 for count
+                              in profile.statements.values()),
+            'repeated': profile.repeated(),
+        }, ensure_ascii=False))
+
+        if (profiler is not None
+                and duration * 1000 >= settings.PROFILING_SLOW_MS):
+            self.dump(profiler, request, duration)
+        return response
+
+    def dump(self, profiler, request, duration):
+        """Save the profile and keep only the PROFILING_KEEP slowest ones."""
+        directory = settings.PROFILING_DIR
+        os.makedirs(directory, exist_ok=True)
+        slug = re.sub(r'[^\w]+', '-', request.path).strip('-') or 'root'
+        # Длительность в начале имени: сортировка по имени = по длительности
+        name = (f'{int(duration * 1000):08d}-{request.method}-{slug}-'
+                f'{int(time.time())}.prof')
+        profiler.dump_stats(os.path.join(directory, name))
+        profiles = sorted((entry for entry in os.listdir(directory)
+                           if entry.endswith('.prof')), reverse=True)
+        for stale in profiles[settings.PROFILING_KEEP:]:
+            try:
+                os.remove(os.path.join(directory, stale))
+            except FileNotFoundError:
+                pass
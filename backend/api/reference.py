@@ -0,0 +1,71 @@
+import gzip
+import hashlib
+from calendar import timegm
+
+from django.http import HttpResponse
+from django.utils.cache import (get_conditional_response, patch_cache_control,
+                                patch_vary_headers, quote_etag)
+from django.utils.http import http_date
+from rest_framework.renderers import JSONRenderer
+
+from recipes.models import CatalogVersion
+
+from .metrics import record_lookup
+
+# Сериализованные справочники живут в памяти воркера и пересобираются,
+# только когда меняется версия каталога в CatalogVersion
+_entries = {}
+
+
+class ReferenceEntry:
+    def __init__(self, version, content):
+        self.version = version
+        self.content = content
+        self.gzip_content = gzip.compress(content)
+        digest = hashlib.sha256(content).hexdigest()
+        self.etag = quote_etag(digest)
+        self.gzip_etag = quote_etag(f'{digest}-gzip')
+
+
+def get_entry(catalog, get_data):
+    entry = _entries.get(catalog.name)
+    stale = entry is None or entry.version != catalog.version
+    record_lookup('reference', not stale)
+    if stale:
+        entry = ReferenceEntry(catalog.version,
+                               JSONRenderer().render(get_data()))
+        _entries[catalog.name] = entry
+    return entry
+
+
+def accepts_gzip(request):
+    return 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+
+
+def reference_response(request, name, get_data):
+    """
+    Serve a reference catalog from precomputed JSON bytes with ETag,
+    Last-Modified and 304 support. get_data is called only when the cached
+    bytes are missing or stale.
+    """
+    catalog = CatalogVersion.get(name)
+    entry = get_entry(catalog, get_data)
+    use_gzip = accepts_gzip(request)
+    etag = entry.gzip_etag if use_gzip else entry.etag
+    last_modified = timegm(catalog.modified.utctimetuple())
+
+    response = get_conditional_response(request, etag=etag,
+                                        last_modified=last_modified)
+    if response is None:
+        if use_gzip:
+            response = HttpResponse(entry.gzip_content,
+                                    content_type='application/json')
+            response['Content-Encoding'] = 'gzip'
+        else:
+            response = HttpResponse(entry.content,
+                                    content_type='application/json')
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    patch_vary_headers(response, ('Accept-Encoding',))
+    patch_cache_control(response, public=True, no_cache=True)
+    return response
@@ -0,0 +1,115 @@
+"""
+Read replica routing.
+
+Safe-method requests to API views with use_replica set read from one of
+DATABASE_REPLICAS, chosen at random per request. Writes always go to the
+primary, and so do all reads of a request after its first write. A request
+that writes pins its user (the client address for anonymous users) to the
+primary for REPLICA_STICKY_SECONDS, so that the requests right after a
+write see it even if the replicas lag behind.
+"""
+import random
+import re
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, connections
+from rest_framework.permissions import SAFE_METHODS
+
+_local = threading.local()
+
+WRITES = re.compile(r'\s*(?:INSERT\s+INTO|UPDATE|DELETE\s+FROM)\s+(\S+)',
+                    re.IGNORECASE)
+DATABASE_CACHE = 'django.core.cache.backends.db.DatabaseCache'
+
+
+def current_replica():
+    """Replica alias the current request reads from, None for the primary."""
+    return getattr(_local, 'replica', None)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        return current_replica() or DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Реплики содержат те же данные, что и основная база
+        databases = {DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+def sticky_keys(request):
+    keys = []
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        keys.append(f'db-primary:user:{user.pk}')
+    address = (request.META.get('HTTP_X_REAL_IP')
+               or request.META.get('REMOTE_ADDR'))
+    keys.append(f'db-primary:address:{address}')
+    return keys
+
+
+def is_pinned(request):
+    cache = caches[settings.REPLICA_STICKY_CACHE]
+    return bool(cache.get_many(sticky_keys(request)))
+
+
+def pin(request):
+    """Send the reads of the requester to the primary for a while."""
+    cache = caches[settings.REPLICA_STICKY_CACHE]
+    # Пользователь закрепляется по id, аноним - по адресу
+    cache.set(sticky_keys(request)[0], True, settings.REPLICA_STICKY_SECONDS)
+
+
+def cache_tables(connection):
+    """Quoted tables of the caches kept in the database."""
+    return {connection.ops.quote_name(cache['LOCATION'])
+            for cache in settings.CACHES.values()
+            if cache['BACKEND'] == DATABASE_CACHE}
+
+
+class WriteDetector:
+    def __init__(self, connection):
+        self.wrote = False
+        # Записи в кэш в базе не меняют данных, которые читаются с реплик
+        self.ignored = cache_tables(connection)
+
+    def __call__(self, execute, sql, params, many, context):
+        write = WRITES.match(sql)
+        if write and write.group(1) not in self.ignored:
+            self.wrote = True
+            _local.replica = None
+        return execute(sql, params, many, context)
+
+
+class ReplicaReadMixin:
+    """
+    Route the safe-method requests of a view to a replica. Set use_replica
+    to False on the view or pass it to @action to keep reads on the primary.
+    """
+    use_replica = True
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if (self.use_replica and settings.DATABASE_REPLICAS
+                and request.method in SAFE_METHODS
+                and not is_pinned(request)):
+            _local.replica = random.choice(settings.DATABASE_REPLICAS)
+
+    def dispatch(self, request, *args, **kwargs):
+        primary = connections[DEFAULT_DB_ALIAS]
+        writes = WriteDetector(primary)
+        try:
+            with primary.execute_wrapper(writes):
+                response = super().dispatch(request, *args, **kwargs)
+        finally:
+            _local.replica = None
+        if writes.wrote:
+            pin(request)
+        return response
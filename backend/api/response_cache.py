@@ -0,0 +1,77 @@
+import hashlib
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.response import Response
+
+from recipes.models import CatalogVersion, Recipe
+
+from .metrics import record_lookup
+
+# Параметры, от которых зависит выдача анонимному пользователю; остальные
+# (is_favorited, is_in_shopping_cart, метки рекламы) на нее не влияют
+CACHED_PARAMS = ('author', 'page', 'limit', 'ordering', 'cursor', 'search',
+                 'include_ingredients', 'exclude_ingredients', 'pantry',
+                 'max_missing')
+# Поля, которые меняются без смены версии рецептов: счетчики обновляются
+# через F() без сигналов, профиль автора - отдельная модель. В странице из
+# кэша они перечитываются одним запросом
+RECIPE_FIELDS = ('favorites_count', 'cart_count')
+AUTHOR_FIELDS = ('email', 'username', 'first_name', 'last_name',
+                 'recipes_count', 'subscribers_count')
+# Порядок по счетчикам устаревает вместе с ними, такие страницы не кэшируем
+UNCACHED_ORDERING = {'favorites_count', 'cart_count'}
+
+
+def anonymous_list_key(request, version):
+    params = [('tags', slug) for slug
+              in sorted(set(request.query_params.getlist('tags')))]
+    params += [(name, request.query_params[name]) for name in CACHED_PARAMS
+               if name in request.query_params]
+    # Ссылки next/previous абсолютные, поэтому схема и хост входят в ключ
+    base = request.build_absolute_uri('/')
+    digest = hashlib.md5(f'{base}?{urlencode(params)}'.encode()).hexdigest()
+    return f'recipes-list:{version}:{digest}'
+
+
+def refresh_fields(data):
+    """Replace counters and author fields of a cached page with current."""
+    recipes = data['results'] if isinstance(data, dict) else data
+    rows = Recipe.objects.filter(
+        pk__in=[recipe['id'] for recipe in recipes]
+    ).values('id', *RECIPE_FIELDS,
+             *(f'author__{name}' for name in AUTHOR_FIELDS))
+    rows = {row['id']: row for row in rows}
+    for recipe in recipes:
+        row = rows.get(recipe['id'])
+        if row is None:
+            continue
+        for name in RECIPE_FIELDS:
+            recipe[name] = row[name]
+        for name in AUTHOR_FIELDS:
+            recipe['author'][name] = row[f'author__{name}']
+    return data
+
+
+def cached_anonymous_list(request, get_response):
+    """
+    Serve an anonymous recipe list page from the cache. Keys contain the
+    recipes catalog version, which is bumped on every recipe change, so
+    nothing has to be deleted; counters and author fields are read anew
+    for every cached page, and pages ordered by counters are not cached.
+    """
+    ordering = request.query_params.get('ordering', '')
+    if UNCACHED_ORDERING & {name.strip().lstrip('-')
+                            for name in ordering.split(',')}:
+        return get_response()
+    version = CatalogVersion.get(Recipe.catalog_name).version
+    key = anonymous_list_key(request, version)
+    data = cache.get(key)
+    record_lookup('recipes_list', data is not None)
+    if data is not None:
+        return Response(refresh_fields(data))
+    response = get_response()
+    if response.status_code == 200:
+        cache.set(key, response.data, settings.RECIPE_LIST_CACHE_TIMEOUT)
+    return response
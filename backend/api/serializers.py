@@ -1,17 +1,24 @@
 import uuid
 import base64
+import hashlib
 
 from django.contrib.auth import get_user_model
 from django.core.files.base import ContentFile
-from django.shortcuts import get_object_or_404
+from django.db import transaction
+from django.utils import timezone
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 
+from recipes import ingredient_index, search
 from recipes.models import (Recipe, Tag, Ingredient, IngredientInRecipe,
-                            Favorite, Subscription, Cart)
+                            Favorite, Subscription, Cart, ShoppingListExport)
 
 User = get_user_model()
 
+RECIPES_LIMIT_MAX = 100
+AUTOCOMPLETE_LIMIT_MAX = 50
+BULK_IDS_MAX = 100
+
 
 class Base64ImageField(serializers.ImageField):
     def to_internal_value(self, data):
@@ -45,9 +52,11 @@ class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ('email', 'id', 'username', 'first_name', 'last_name',
-                  'is_subscribed')
+                  'is_subscribed', 'recipes_count', 'subscribers_count')
 
     def get_is_subscribed(self, obj):
+        if hasattr(obj, 'is_subscribed'):
+            return obj.is_subscribed
         user = self.context['request'].user
         if user.is_authenticated:
             return Subscription.objects.filter(user=user, author=obj).exists()
@@ -66,6 +75,13 @@ class IngredientSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'measurement_unit')
 
 
+class IngredientAutocompleteSerializer(serializers.Serializer):
+    name = serializers.CharField(max_length=200, trim_whitespace=True)
+    limit = serializers.IntegerField(min_value=1,
+                                     max_value=AUTOCOMPLETE_LIMIT_MAX,
+                                     default=10)
+
+
 class IngredientInRecipeSerializer(serializers.ModelSerializer):
     id = serializers.IntegerField(source='ingredient.id', read_only=True)
     name = serializers.CharField(source='ingredient.name', read_only=True)
@@ -83,16 +99,10 @@ class IdAmountIngredientSerializer(serializers.Serializer):
     id = serializers.IntegerField()
     amount = serializers.IntegerField()
 
-    def validate(self, data):
-        if not Ingredient.objects.filter(id=data['id']).exists():
-            raise ValidationError('Ingredient does not exist!')
-        return data
-
 
 class RecipeCreateSerializer(serializers.ModelSerializer):
     ingredients = IdAmountIngredientSerializer(many=True)
-    tags = serializers.PrimaryKeyRelatedField(many=True,
-                                              queryset=Tag.objects.all())
+    tags = serializers.ListField(child=serializers.IntegerField())
     image = Base64ImageField()
 
     class Meta:
@@ -100,49 +110,127 @@ class RecipeCreateSerializer(serializers.ModelSerializer):
         fields = ('ingredients', 'tags', 'image', 'name', 'text',
                   'cooking_time')
 
+    def validate_tags(self, value):
+        tags = Tag.objects.in_bulk(value)
+        if len(tags) != len(set(value)):
+            raise ValidationError('Tag does not exist!')
+        return [tags[tag_id] for tag_id in value]
+
+    def validate_ingredients(self, value):
+        ids = {ingredient['id'] for ingredient in value}
+        if len(ids) != len(value):
+            raise ValidationError('Ingredients must be unique!')
+        if Ingredient.objects.filter(id__in=ids).count() != len(ids):
+            raise ValidationError('Ingredient does not exist!')
+        return value
+
+    def create_ingredients(self, recipe, ingredients):
+        IngredientInRecipe.objects.bulk_create([
+            IngredientInRecipe(recipe=recipe,
+                               ingredient_id=ingredient['id'],
+                               amount=ingredient['amount'])
+            for ingredient in ingredients
+        ])
+
+    @transaction.atomic
     def create(self, validated_data):
         tags = validated_data.pop('tags')
         ingredients = validated_data.pop('ingredients')
+        validated_data['image_hash'] = self.image_hash(validated_data['image'])
         recipe = Recipe.objects.create(**validated_data)
-
-        for tag in tags:
-            recipe.tags.add(tag)
-
-        for ingredient in ingredients:
-            ingredient_id = ingredient['id']
-            amount = ingredient['amount']
-            the_ingredient = get_object_or_404(Ingredient, id=ingredient_id)
-            ingredient_in_recipe = IngredientInRecipe.objects.create(
-                ingredient=the_ingredient,
-                amount=amount
-            )
-            recipe.ingredients.add(ingredient_in_recipe)
-
+        recipe.tags.add(*tags)
+        self.create_ingredients(recipe, ingredients)
         return recipe
 
+    @transaction.atomic
     def update(self, instance, validated_data):
-        if "tags" in validated_data:
-            tags = validated_data.pop('tags')
-            instance.tags.clear()
-            for tag in tags:
-                instance.tags.add(tag)
+        # changed говорит представлению, изменилось ли что-то: повторная
+        # отправка того же рецепта ничего не пишет
+        self.changed = False
+        if 'tags' in validated_data:
+            self.changed |= self.update_tags(instance,
+                                             validated_data.pop('tags'))
 
         if 'ingredients' in validated_data:
-            ingredients = validated_data.pop('ingredients')
-            instance.ingredients.all().delete()
-            instance.ingredients.clear()
-            for ingredient in ingredients:
-                ingredient_id = ingredient['id']
-                amount = ingredient['amount']
-                the_ingredient = get_object_or_404(Ingredient,
-                                                   id=ingredient_id)
-                ingredient_in_recipe = IngredientInRecipe.objects.create(
-                    ingredient=the_ingredient,
-                    amount=amount
-                )
-                instance.ingredients.add(ingredient_in_recipe)
-
-        return super().update(instance, validated_data)
+            self.changed |= self.update_ingredients(
+                instance, validated_data.pop('ingredients')
+            )
+
+        fields = {name: value for name, value in validated_data.items()
+                  if not self.is_unchanged(instance, name, value)}
+        if 'image' in fields:
+            fields['image_hash'] = self.image_hash(fields['image'])
+        if fields:
+            self.changed = True
+            # Пишутся только измененные поля: полный save() вернул бы
+            # счетчики, прочитанные до параллельных изменений
+            for name, value in fields.items():
+                setattr(instance, name, value)
+            instance.save(update_fields=[*fields, 'modified'])
+            return instance
+        if self.changed:
+            # Рецепт не сохраняется, а индекс ингредиентов ищет изменения
+            # по modified
+            Recipe.objects.filter(pk=instance.pk).update(
+                modified=timezone.now()
+            )
+        return instance
+
+    @classmethod
+    def is_unchanged(cls, recipe, name, value):
+        if name != 'image':
+            return getattr(recipe, name) == value
+        # Картинка всегда приходит новым файлом: сравниваются хеши, старый
+        # файл из хранилища не читается. У рецептов без хеша картинка
+        # считается измененной
+        return bool(recipe.image_hash
+                    and recipe.image_hash == cls.image_hash(value))
+
+    @staticmethod
+    def image_hash(image):
+        """Return the sha256 hex digest of an uploaded image."""
+        digest = hashlib.sha256()
+        for chunk in image.chunks():
+            digest.update(chunk)
+        image.seek(0)
+        return digest.hexdigest()
+
+    def update_tags(self, recipe, tags):
+        """Replace the recipe tags if they differ, return whether they did."""
+        if set(recipe.tags.values_list('id', flat=True)) == {tag.id for tag
+                                                             in tags}:
+            return False
+        recipe.tags.set(tags)
+        return True
+
+    def update_ingredients(self, recipe, ingredients):
+        """
+        Write only the difference between stored and submitted ingredient
+        lines: removed lines are deleted, changed amounts are updated and new
+        ingredients are inserted, untouched lines are left as is. Return
+        whether anything was written.
+        """
+        amounts = {ingredient['id']: ingredient['amount']
+                   for ingredient in ingredients}
+        removed, changed = [], []
+        for line in recipe.ingredients.all():
+            amount = amounts.pop(line.ingredient_id, None)
+            if amount is None:
+                removed.append(line.id)
+            elif amount != line.amount:
+                line.amount = amount
+                changed.append(line)
+
+        if removed:
+            IngredientInRecipe.objects.filter(id__in=removed).delete()
+        if changed:
+            IngredientInRecipe.objects.bulk_update(changed, ['amount'])
+        if amounts:
+            self.create_ingredients(recipe, [
+                {'id': ingredient_id, 'amount': amount}
+                for ingredient_id, amount in amounts.items()
+            ])
+        return bool(removed or changed or amounts)
 
 
 class RecipeReadOnlySerializer(serializers.ModelSerializer):
@@ -156,15 +244,28 @@ class RecipeReadOnlySerializer(serializers.ModelSerializer):
         model = Recipe
         fields = ('id', 'tags', 'author', 'ingredients', 'is_favorited',
                   'is_in_shopping_cart', 'name', 'image', 'text',
-                  'cooking_time')
+                  'cooking_time', 'favorites_count', 'cart_count')
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        # Результат поиска: ранг и подсвеченные совпадения
+        if hasattr(instance, 'search_rank'):
+            data['search'] = search.result(instance)
+        if hasattr(instance, 'pantry_rank'):
+            data['pantry'] = ingredient_index.coverage(instance)
+        return data
 
     def get_is_favorited(self, obj):
+        if hasattr(obj, 'is_favorited'):
+            return obj.is_favorited
         user = self.context['request'].user
         if user.is_authenticated:
             return Favorite.objects.filter(user=user, recipe=obj).exists()
         return False
 
     def get_is_in_shopping_cart(self, obj):
+        if hasattr(obj, 'is_in_shopping_cart'):
+            return obj.is_in_shopping_cart
         user = self.context['request'].user
         if user.is_authenticated:
             return Cart.objects.filter(user=user, recipe=obj).exists()
@@ -182,10 +283,23 @@ class RecipeInfoSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'image', 'cooking_time')
 
 
+class BulkIdsSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1),
+                                allow_empty=False, max_length=BULK_IDS_MAX)
+
+    def validate_ids(self, value):
+        return sorted(set(value))
+
+
+class RecipesLimitSerializer(serializers.Serializer):
+    recipes_limit = serializers.IntegerField(min_value=0,
+                                             max_value=RECIPES_LIMIT_MAX,
+                                             default=RECIPES_LIMIT_MAX)
+
+
 class SubscriptionSerializer(serializers.ModelSerializer):
     is_subscribed = serializers.SerializerMethodField()
     recipes = serializers.SerializerMethodField()
-    recipes_count = serializers.SerializerMethodField()
 
     class Meta:
         model = User
@@ -193,22 +307,23 @@ class SubscriptionSerializer(serializers.ModelSerializer):
                   'is_subscribed', 'recipes', 'recipes_count')
 
     def get_is_subscribed(self, obj):
+        if hasattr(obj, 'is_subscribed'):
+            return obj.is_subscribed
         user = self.context['request'].user
         if user.is_authenticated:
             return Subscription.objects.filter(user=user, author=obj).exists()
         return False
 
     def get_recipes(self, obj):
-        request = self.context['request']
-        recipes_limit = request.query_params.get('recipes_limit', None)
-
-        if recipes_limit is None:
-            recipes = Recipe.objects.filter(author=obj)
-            return RecipeInfoSerializer(recipes, many=True).data
-
-        length = int(recipes_limit)
-        recipes = Recipe.objects.filter(author=obj)[:length]
+        if hasattr(obj, 'limited_recipes'):
+            recipes = obj.limited_recipes
+        else:
+            length = self.context.get('recipes_limit', RECIPES_LIMIT_MAX)
+            recipes = Recipe.objects.filter(author=obj)[:length]
         return RecipeInfoSerializer(recipes, many=True).data
 
-    def get_recipes_count(self, obj):
-        return Recipe.objects.filter(author=obj).count()
+
+class ShoppingListExportSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ShoppingListExport
+        fields = ('id', 'status', 'created', 'finished', 'error')
@@ -0,0 +1,26 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from .authentication import token_cache
+
+User = get_user_model()
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_token(sender, instance, **kwargs):
+    token_cache.invalidate(instance.key)
+
+
+@receiver(post_save, sender=User)
+def invalidate_user_tokens(sender, instance, created, **kwargs):
+    # Смена пароля, деактивация и любые другие изменения пользователя
+    # сбрасывают закешированные для него токены
+    if created:
+        return
+    keys = ()
+    if token_cache.backend:
+        keys = Token.objects.filter(user=instance).values_list('key',
+                                                               flat=True)
+    token_cache.invalidate_user(instance.pk, keys)
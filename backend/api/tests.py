@@ -0,0 +1,658 @@
+import base64
+import io
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+from unittest import mock, skipUnless
+
+import PIL.Image
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.management import CommandError, call_command
+from django.db import connections
+from django.test import (SimpleTestCase, TestCase, TransactionTestCase,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from api.authentication import (CachedTokenAuthentication, TokenCache,
+                                token_cache)
+from api.checks import (check_replica_sticky_cache,
+                        check_token_revocation_cache)
+from api.serializers import RecipeCreateSerializer
+from recipes import ingredient_index, relations, search
+from recipes.models import (Cart, Favorite, Ingredient, IngredientInRecipe,
+                            Recipe, ShoppingListExport, Subscription, Tag)
+from users.models import User
+
+MEDIA_ROOT = tempfile.mkdtemp()
+
+
+def tearDownModule():
+    shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+
+# Данные TestCase не закоммичены и реплике-зеркалу не видны
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, SHOPPING_LIST_SYNC_MAX_ITEMS=1000,
+                   DATABASE_REPLICAS=[])
+@mock.patch('api.utils.render_shopping_list', return_value=b'%PDF-1.4')
+class DownloadShoppingCartTests(TestCase):
+    """The shopping list costs the same queries however large the cart."""
+    RECIPES = 300
+    INGREDIENTS = 500
+    LINES = 15
+    QUERIES = 1
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='buyer',
+                                       email='buyer@example.com',
+                                       first_name='Buyer', last_name='Test')
+        # bulk_create возвращает id не на всех базах, строки читаются заново
+        Ingredient.objects.bulk_create([
+            Ingredient(name=f'Ingredient {i}', name_lower=f'ingredient {i}',
+                       measurement_unit='g')
+            for i in range(cls.INGREDIENTS)
+        ])
+        Recipe.objects.bulk_create([
+            Recipe(author=cls.user, name=f'Recipe {i}', text='Text',
+                   image='images/test.png', cooking_time=10)
+            for i in range(cls.RECIPES)
+        ])
+        ingredients = list(Ingredient.objects.order_by('id'))
+        recipes = list(Recipe.objects.order_by('id'))
+        IngredientInRecipe.objects.bulk_create([
+            IngredientInRecipe(
+                recipe=recipe,
+                ingredient=ingredients[(i * cls.LINES + j) % len(ingredients)],
+                amount=j + 1
+            )
+            for i, recipe in enumerate(recipes) for j in range(cls.LINES)
+        ])
+        Cart.objects.bulk_create([Cart(user=cls.user, recipe=recipe)
+                                  for recipe in recipes])
+        cls.small_cart_user = User.objects.create(
+            username='small', email='small@example.com', first_name='Small',
+            last_name='Cart'
+        )
+        Cart.objects.create(user=cls.small_cart_user, recipe=recipes[0])
+
+    def download(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client.get('/api/recipes/download_shopping_cart/')
+
+    def test_large_cart_query_count(self, render):
+        with self.assertNumQueries(self.QUERIES):
+            response = self.download(self.user)
+        self.assertEqual(response.status_code, 200)
+        items = render.call_args[0][0]
+        self.assertEqual(len(items), self.INGREDIENTS)
+        self.assertEqual(sum(item['total'] for item in items),
+                         self.RECIPES * sum(range(1, self.LINES + 1)))
+
+    def test_query_count_does_not_depend_on_cart_size(self, render):
+        with self.assertNumQueries(self.QUERIES):
+            self.download(self.small_cart_user)
+        with self.assertNumQueries(self.QUERIES):
+            self.download(self.user)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, SHOPPING_LIST_EXPORT_MAX_ATTEMPTS=2)
+@mock.patch('api.utils.render_shopping_list', return_value=b'%PDF-1.4')
+class RenderExportsTests(TestCase):
+    """Abandoned exports are queued again, finished ones expire."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='exporter',
+                                       email='exporter@example.com',
+                                       first_name='Exporter',
+                                       last_name='Test')
+
+    def render_exports(self):
+        call_command('renderexports', '--once', stdout=io.StringIO())
+
+    def processing(self, started, attempts):
+        return ShoppingListExport.objects.create(
+            user=self.user, status=ShoppingListExport.PROCESSING,
+            started=started, attempts=attempts
+        )
+
+    def test_abandoned_exports_are_queued_again(self, render):
+        lease = timedelta(seconds=settings.SHOPPING_LIST_EXPORT_LEASE_SECONDS)
+        now = timezone.now()
+        running = self.processing(now, 1)
+        abandoned = self.processing(now - lease * 2, 1)
+        exhausted = self.processing(now - lease * 2, 2)
+        self.render_exports()
+        statuses = dict(ShoppingListExport.objects.values_list('id',
+                                                               'status'))
+        self.assertEqual(statuses, {
+            running.id: ShoppingListExport.PROCESSING,
+            abandoned.id: ShoppingListExport.DONE,
+            exhausted.id: ShoppingListExport.FAILED,
+        })
+
+    def test_expired_exports_are_deleted(self, render):
+        retention = timedelta(
+            seconds=settings.SHOPPING_LIST_EXPORT_RETENTION_SECONDS
+        )
+        exports = []
+        for finished in (timezone.now() - retention * 2, timezone.now()):
+            export = ShoppingListExport(user=self.user, finished=finished,
+                                        status=ShoppingListExport.DONE)
+            export.file.save('export.pdf', ContentFile(b'%PDF-1.4'))
+            exports.append(export)
+        expired, recent = exports
+        storage = expired.file.storage
+        self.render_exports()
+        self.assertEqual(
+            list(ShoppingListExport.objects.values_list('id', flat=True)),
+            [recent.id]
+        )
+        self.assertFalse(storage.exists(expired.file.name))
+        self.assertTrue(storage.exists(recent.file.name))
+
+
+class ImportCsvTests(TestCase):
+    def import_csv(self, content, model, *args):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv',
+                                         delete=False) as file:
+            file.write(content)
+        self.addCleanup(os.remove, file.name)
+        output = io.StringIO()
+        call_command('importcsv', '--path', file.name, '--model_name', model,
+                     *args, stdout=output)
+        return output.getvalue().splitlines()[-1]
+
+    def test_skip_requires_key(self):
+        with self.assertRaisesMessage(CommandError, 'requires --key'):
+            self.import_csv('name,measurement_unit\nsalt,g\n',
+                            'recipes.Ingredient', '--conflicts', 'skip')
+        self.assertFalse(Ingredient.objects.exists())
+
+    def test_skip_counts_inserted_rows(self):
+        # У второго тега занят slug: строка пропускается базой
+        summary = self.import_csv(
+            'name,color,slug\nA,#000001,a\nB,#000002,a\nC,#000003,c\n',
+            'recipes.Tag', '--conflicts', 'skip', '--key', 'name'
+        )
+        self.assertIn('2 created, 0 updated, 1 skipped', summary)
+        self.assertEqual(Tag.objects.count(), 2)
+
+
+@override_settings(INGREDIENT_INDEX_MAX_RESULTS=5, DATABASE_REPLICAS=[])
+class PantryFilterTests(TestCase):
+    """Pantry ranks only the recipes left by the other filters."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.authors = [
+            User.objects.create(username=f'author{i}',
+                                email=f'author{i}@example.com',
+                                first_name='Author', last_name=str(i))
+            for i in range(2)
+        ]
+        cls.ingredient = Ingredient.objects.create(
+            name='Salt', name_lower='salt', measurement_unit='g'
+        )
+        # Более новые рецепты первого автора занимают все места
+        # глобального рейтинга
+        for author, count in zip(reversed(cls.authors), (3, 10)):
+            for i in range(count):
+                recipe = Recipe.objects.create(
+                    author=author, name=f'Recipe {i}', text='Text',
+                    image='images/test.png', cooking_time=10
+                )
+                IngredientInRecipe.objects.create(
+                    recipe=recipe, ingredient=cls.ingredient, amount=1
+                )
+
+    def setUp(self):
+        # Индекс процесса мог остаться от данных другого теста
+        ingredient_index._indexes.clear()
+        ingredient_index.prewarm()
+
+    def test_pantry_respects_author_filter(self):
+        author = self.authors[1]
+        response = APIClient().get('/api/recipes/', {
+            'pantry': self.ingredient.id, 'author': author.id, 'limit': 10
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            sorted(recipe['id'] for recipe in response.data['results']),
+            sorted(author.recipes.values_list('id', flat=True))
+        )
+
+
+@override_settings(DATABASE_REPLICAS=[])
+class IngredientFilterTests(TestCase):
+    """The index and the database fallback give the same recipes."""
+
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create(username='author',
+                                     email='author@example.com',
+                                     first_name='Author', last_name='Test')
+        cls.salt, cls.sugar = [
+            Ingredient.objects.create(name=name, name_lower=name.lower(),
+                                      measurement_unit='g')
+            for name in ('Salt', 'Sugar')
+        ]
+        cls.recipes = [
+            Recipe.objects.create(author=author, name=f'Recipe {i}',
+                                  text='Text', image='images/test.png',
+                                  cooking_time=10)
+            for i in range(4)
+        ]
+        # Без ингредиентов, соль, соль и сахар, сахар
+        for recipe, ingredients in zip(cls.recipes, (
+                (), (cls.salt,), (cls.salt, cls.sugar), (cls.sugar,))):
+            for ingredient in ingredients:
+                IngredientInRecipe.objects.create(
+                    recipe=recipe, ingredient=ingredient, amount=1
+                )
+
+    def setUp(self):
+        ingredient_index._indexes.clear()
+        # Иначе страницы отдаст кэш анонимных списков из другого теста
+        caches['default'].clear()
+
+    def ids(self, params):
+        response = APIClient().get('/api/recipes/', {**params, 'limit': 10})
+        self.assertEqual(response.status_code, 200)
+        return [recipe['id'] for recipe in response.data['results']]
+
+    def check_filters(self):
+        recipes = [recipe.id for recipe in self.recipes]
+        self.assertEqual(
+            sorted(self.ids({'exclude_ingredients': self.sugar.id})),
+            recipes[:2]
+        )
+        self.assertEqual(
+            sorted(self.ids({'include_ingredients': self.salt.id})),
+            recipes[1:3]
+        )
+        self.assertEqual(
+            self.ids({'pantry': self.salt.id, 'max_missing': 1}),
+            [recipes[1], recipes[2]]
+        )
+
+    def test_index(self):
+        ingredient_index.prewarm()
+        self.check_filters()
+
+    @mock.patch.object(ingredient_index, 'rebuild_in_background')
+    def test_missing_index_filters_in_database(self, rebuild):
+        self.check_filters()
+        rebuild.assert_called_with('default')
+        self.assertNotIn('default', ingredient_index._indexes)
+
+
+@override_settings(SEARCH_FALLBACK_LIMIT=5, DATABASE_REPLICAS=[])
+class RecipeSearchTests(TestCase):
+    """Search limits and orders only the recipes left by other filters."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.authors = [
+            User.objects.create(username=f'cook{i}',
+                                email=f'cook{i}@example.com',
+                                first_name='Cook', last_name=str(i))
+            for i in range(2)
+        ]
+        # Более новые рецепты первого автора при равной релевантности
+        # занимают все места в лимите
+        for author, count in zip(reversed(cls.authors), (3, 10)):
+            for i in range(count):
+                Recipe.objects.create(author=author, name=f'Soup {i}',
+                                      text='Soup', image='images/test.png',
+                                      cooking_time=10)
+
+    def setUp(self):
+        search._indexes.clear()
+
+    def test_search_respects_author_filter(self):
+        author = self.authors[1]
+        response = APIClient().get('/api/recipes/', {
+            'search': 'soup', 'author': author.id, 'limit': 10
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            sorted(recipe['id'] for recipe in response.data['results']),
+            sorted(author.recipes.values_list('id', flat=True))
+        )
+
+    def test_highlight_escapes_recipe_text(self):
+        recipe = Recipe.objects.create(
+            author=self.authors[0], name='<script>alert(1)</script> Soup',
+            text='Soup & <img src=x onerror=alert(1)>',
+            image='images/test.png', cooking_time=10
+        )
+        response = APIClient().get('/api/recipes/', {
+            'search': 'soup', 'author': self.authors[0].id, 'limit': 20
+        })
+        found = next(result['search'] for result in response.data['results']
+                     if result['id'] == recipe.id)
+        self.assertEqual(found['name'],
+                         '&lt;script&gt;alert(1)&lt;/script&gt; <b>Soup</b>')
+        self.assertEqual(found['text'], '<b>Soup</b> &amp; &lt;img src=x '
+                                        'onerror=alert(1)&gt;')
+
+    def test_cursor_rejects_search(self):
+        response = APIClient().get('/api/recipes/', {'search': 'soup',
+                                                     'cursor': ''})
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(DATABASE_REPLICAS=[])
+class CounterSaveTests(TestCase):
+    """Saves of stale instances keep the counters changed meanwhile."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create(username='author',
+                                         email='author@example.com',
+                                         first_name='Author', last_name='Test')
+        cls.author.set_password('old-Passw0rd')
+        cls.author.save()
+        cls.follower = User.objects.create(username='follower',
+                                           email='follower@example.com',
+                                           first_name='Follower',
+                                           last_name='Test')
+
+    def setUp(self):
+        token_cache.clear()
+
+    @mock.patch.object(token_cache, 'ttl', 30)
+    def test_set_password_keeps_subscribers_count(self):
+        client = APIClient()
+        token = Token.objects.create(user=self.author)
+        client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        # Пользователь попадает в кэш токенов со счетчиком 0
+        self.assertEqual(client.get('/api/users/me/').status_code, 200)
+        relations.add(Subscription, self.follower, [self.author.id])
+        user, _ = CachedTokenAuthentication().authenticate_credentials(
+            token.key
+        )
+        self.assertEqual(user.subscribers_count, 1)
+        response = client.post('/api/users/set_password/', {
+            'current_password': 'old-Passw0rd',
+            'new_password': 'new-Passw0rd'
+        })
+        self.assertEqual(response.status_code, 204)
+        self.author.refresh_from_db()
+        self.assertEqual(self.author.subscribers_count, 1)
+        self.assertTrue(self.author.check_password('new-Passw0rd'))
+
+    def test_recipe_update_keeps_favorites_count(self):
+        recipe = Recipe.objects.create(author=self.author, name='Recipe',
+                                       text='Text', image='images/test.png',
+                                       cooking_time=10)
+        relations.add(Favorite, self.follower, [recipe.id])
+        serializer = RecipeCreateSerializer(recipe, data={'name': 'Renamed'},
+                                            partial=True)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        recipe.refresh_from_db()
+        self.assertEqual((recipe.name, recipe.favorites_count),
+                         ('Renamed', 1))
+
+    def test_full_save_skips_counters(self):
+        stale = User.objects.get(pk=self.author.pk)
+        relations.add(Subscription, self.follower, [self.author.id])
+        stale.first_name = 'Renamed'
+        stale.save()
+        self.author.refresh_from_db()
+        self.assertEqual((self.author.first_name,
+                          self.author.subscribers_count), ('Renamed', 1))
+
+
+def image_data(color):
+    """Return a 1x1 PNG of the given color as a data URI."""
+    buffer = io.BytesIO()
+    PIL.Image.new('RGB', (1, 1), color).save(buffer, 'PNG')
+    return ('data:image/png;base64,'
+            + base64.b64encode(buffer.getvalue()).decode())
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, DATABASE_REPLICAS=[])
+class RecipeImageUpdateTests(TestCase):
+    """A re-sent image is recognised by its hash, not by the stored file."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create(username='author',
+                                         email='author@example.com',
+                                         first_name='Author', last_name='Test')
+        cls.tag = Tag.objects.create(name='Tag', color='#000000', slug='tag')
+        cls.ingredient = Ingredient.objects.create(name='Salt',
+                                                   measurement_unit='g')
+
+    def setUp(self):
+        serializer = RecipeCreateSerializer(data={
+            'name': 'Recipe', 'text': 'Text', 'cooking_time': 10,
+            'image': image_data('red'), 'tags': [self.tag.id],
+            'ingredients': [{'id': self.ingredient.id, 'amount': 1}]
+        })
+        serializer.is_valid(raise_exception=True)
+        self.recipe = serializer.save(author=self.author)
+
+    def patch_image(self, color):
+        serializer = RecipeCreateSerializer(
+            self.recipe, data={'image': image_data(color)}, partial=True
+        )
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return serializer.changed
+
+    def test_same_image_does_not_read_storage(self):
+        image = self.recipe.image.name
+        with mock.patch.object(self.recipe.image.storage, 'open') as open_:
+            self.assertFalse(self.patch_image('red'))
+        open_.assert_not_called()
+        self.recipe.refresh_from_db()
+        self.assertEqual(self.recipe.image.name, image)
+
+    def test_new_image_is_saved_with_hash(self):
+        old_hash = self.recipe.image_hash
+        self.assertTrue(self.patch_image('blue'))
+        self.recipe.refresh_from_db()
+        self.assertNotIn(self.recipe.image_hash, ('', old_hash))
+        self.assertFalse(self.patch_image('blue'))
+
+
+# Запросы к кэшу в базе не входят в проверяемое число
+@override_settings(DATABASE_REPLICAS=[], CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'
+}})
+class SubscriptionsTests(TestCase):
+    """Subscriptions show the newest recipes_limit recipes of each author."""
+    AUTHORS = 5
+    RECIPES = 4
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='follower',
+                                       email='follower@example.com',
+                                       first_name='Follower',
+                                       last_name='Test')
+        for i in range(cls.AUTHORS):
+            author = User.objects.create(username=f'chef{i}',
+                                         email=f'chef{i}@example.com',
+                                         first_name='Chef', last_name=str(i))
+            Subscription.objects.create(user=cls.user, author=author)
+            Recipe.objects.bulk_create([
+                Recipe(author=author, name=f'Recipe {j}', text='Text',
+                       image='images/test.png', cooking_time=10)
+                for j in range(cls.RECIPES)
+            ])
+
+    def test_recipes_limit(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with self.assertNumQueries(3):
+            response = client.get('/api/users/subscriptions/',
+                                  {'recipes_limit': 2, 'limit': 10})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), self.AUTHORS)
+        for author in response.data['results']:
+            self.assertEqual(
+                [recipe['id'] for recipe in author['recipes']],
+                list(Recipe.objects.filter(author_id=author['id']).order_by(
+                    '-pub_date', '-id'
+                ).values_list('id', flat=True)[:2])
+            )
+
+
+@override_settings(DATABASE_REPLICAS=['replica1'])
+class ReplicaStickyCacheCheckTests(SimpleTestCase):
+    LOCMEM = {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+    DATABASE = {'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+                'LOCATION': 'cache'}
+
+    def errors(self, cache):
+        with override_settings(CACHES={'default': cache}):
+            return [error.id for error in check_replica_sticky_cache(None)]
+
+    def test_per_process_cache_is_rejected(self):
+        self.assertEqual(self.errors(self.LOCMEM), ['api.E002'])
+
+    def test_shared_cache_is_accepted(self):
+        self.assertEqual(self.errors(self.DATABASE), [])
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_no_replicas(self):
+        self.assertEqual(self.errors(self.LOCMEM), [])
+
+
+@override_settings(TOKEN_CACHE_TTL=30)
+class TokenRevocationCacheCheckTests(SimpleTestCase):
+    def errors(self, cache, **options):
+        with override_settings(CACHES={'default': cache}, **options):
+            return [error.id for error in check_token_revocation_cache(None)]
+
+    def test_per_process_cache_is_rejected(self):
+        self.assertEqual(
+            self.errors(ReplicaStickyCacheCheckTests.LOCMEM), ['api.E004']
+        )
+
+    def test_shared_cache_is_accepted(self):
+        self.assertEqual(
+            self.errors(ReplicaStickyCacheCheckTests.DATABASE), []
+        )
+
+    def test_disabled_token_cache(self):
+        self.assertEqual(self.errors(ReplicaStickyCacheCheckTests.LOCMEM,
+                                     TOKEN_CACHE_TTL=0), [])
+
+
+def revoke_token(key):
+    TokenCache(10, 60, 'tokens').invalidate(key)
+
+
+class TokenRevocationTests(TestCase):
+    """A token revoked by one worker is rejected by the others."""
+
+    def setUp(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location, ignore_errors=True)
+        settings_override = override_settings(CACHES={
+            'default': ReplicaStickyCacheCheckTests.LOCMEM,
+            'tokens': {
+                'BACKEND': 'django.core.cache.backends.filebased.'
+                           'FileBasedCache',
+                'LOCATION': location,
+            },
+        })
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_revocation_in_another_process(self):
+        user = User.objects.create(username='worker',
+                                   email='worker@example.com',
+                                   first_name='Worker', last_name='Test')
+        token = Token.objects.create(user=user)
+        worker = TokenCache(10, 60, 'tokens')
+        worker.set(token.key, (user, token), time.time())
+        self.assertIsNotNone(worker.get(token.key))
+        # Отзыв выполняет другой процесс со своим локальным кэшем
+        process = multiprocessing.get_context('fork').Process(
+            target=revoke_token, args=(token.key,)
+        )
+        process.start()
+        process.join()
+        self.assertEqual(process.exitcode, 0)
+        self.assertIsNone(worker.get(token.key))
+
+
+@skipUnless(settings.DATABASE_REPLICAS, 'DB_REPLICA_HOSTS is not set')
+class ReplicaRoutingTests(TransactionTestCase):
+    """
+    Reads routed to the first replica alias. In tests it mirrors the
+    primary's database, so the queries run on its connection tell where a
+    request has read from.
+    """
+    databases = '__all__'
+
+    def setUp(self):
+        self.replica = settings.DATABASE_REPLICAS[0]
+        settings_override = override_settings(
+            DATABASE_REPLICAS=[self.replica]
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        caches[settings.REPLICA_STICKY_CACHE].clear()
+        self.user = User.objects.create(username='reader',
+                                        email='reader@example.com',
+                                        first_name='Reader', last_name='Test')
+        self.recipe = Recipe.objects.create(
+            author=self.user, name='Recipe', text='Text',
+            image='images/test.png', cooking_time=10
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def replica_queries(self, method, url, client=None):
+        with CaptureQueriesContext(connections[self.replica]) as queries:
+            getattr(client or self.client, method)(url)
+        return len(queries)
+
+    def test_safe_request_reads_from_replica(self):
+        self.assertTrue(self.replica_queries('get', '/api/recipes/?limit=1'))
+
+    def test_cache_writes_do_not_pin_user(self):
+        # Количество страниц кэшируется, в том числе в кэше в базе
+        self.client.get('/api/recipes/?limit=1&page=2')
+        self.assertTrue(self.replica_queries('get', '/api/recipes/?limit=1'))
+
+    def test_write_pins_user_to_primary(self):
+        self.assertFalse(self.replica_queries(
+            'post', f'/api/recipes/{self.recipe.id}/favorite/'
+        ))
+        self.assertFalse(self.replica_queries('get', '/api/recipes/?limit=1'))
+        # Закрепление истекло
+        caches[settings.REPLICA_STICKY_CACHE].clear()
+        self.assertTrue(self.replica_queries('get', '/api/recipes/?limit=1'))
+
+    def test_safe_request_that_writes_pins_user(self):
+        self.client.get('/api/recipes/download_shopping_cart/?async=true')
+        self.assertFalse(self.replica_queries('get', '/api/recipes/?limit=1'))
+
+    def test_pin_does_not_affect_other_users(self):
+        self.client.post(f'/api/recipes/{self.recipe.id}/favorite/')
+        self.assertTrue(self.replica_queries('get', '/api/recipes/?limit=1',
+                                             APIClient()))
+
+    def test_opted_out_view_reads_from_primary(self):
+        export = ShoppingListExport.objects.create(user=self.user)
+        self.assertFalse(self.replica_queries(
+            'get', f'/api/recipes/shopping_cart_exports/{export.id}/'
+        ))
@@ -1,6 +1,22 @@
+import hashlib
+import json
 import os
 
+from xhtml2pdf import pisa
+
 from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Sum
+from django.template.loader import render_to_string
+from django.utils.crypto import salted_hmac
+from django.utils.six import BytesIO
+
+from recipes.models import IngredientInRecipe
+
+from .metrics import PDF_RENDER_DURATION, record_lookup
+from .profiling import timed
 
 
 def fetch_resources(uri, rel):
@@ -14,3 +30,67 @@ def fetch_resources(uri, rel):
         path = os.path.join(settings.STATIC_ROOT, uri)
 
     return path.replace("\\", "/")
+
+
+def get_shopping_list(user):
+    """
+    Sum ingredient amounts over every recipe in the user's cart in a single
+    grouped query, sorted by ingredient name.
+    """
+    return IngredientInRecipe.objects.filter(
+        recipe__buyers__user=user
+    ).values(
+        name=F('ingredient__name'),
+        measurement_unit=F('ingredient__measurement_unit')
+    ).annotate(
+        total=Sum('amount')
+    ).order_by('name', 'measurement_unit')
+
+
+def render_shopping_list(items):
+    """Render aggregated shopping list items to PDF bytes."""
+    shopping_list = [
+        '{name} ({measurement_unit}) - {total}\n'.format(**item)
+        for item in items
+    ]
+    template = 'shopping_list.html'
+    context = {'pagesize': 'A4', 'shopping_list': shopping_list}
+    html = render_to_string(template, context)
+    src = BytesIO(html.encode('utf-8'))
+    dest = BytesIO()
+    with timed('pdf'), PDF_RENDER_DURATION.time():
+        pisa.pisaDocument(src, dest, encoding='UTF-8',
+                          link_callback=fetch_resources)
+    return dest.getvalue()
+
+
+def shopping_list_version(items):
+    """Content hash of aggregated shopping list items, used as ETag."""
+    data = json.dumps(list(items), cls=DjangoJSONEncoder, sort_keys=True,
+                      ensure_ascii=False)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def get_cached_shopping_list(user, items, version):
+    """
+    Return the rendered PDF for the given shopping list version, rendering
+    and storing it only when the user's cart content has changed. Stale
+    versions of the user's document are removed from storage.
+    """
+    directory = f'shopping_lists/cache/{user.pk}'
+    # MEDIA_ROOT раздается публично, а хэш списка можно вычислить по
+    # открытым данным рецептов; имя с ключом SECRET_KEY не подобрать
+    name = salted_hmac('shopping-list', f'{user.pk}:{version}').hexdigest()
+    path = f'{directory}/{name}.pdf'
+    cached = default_storage.exists(path)
+    record_lookup('shopping_list_pdf', cached)
+    if cached:
+        with default_storage.open(path, 'rb') as file:
+            return file.read()
+
+    content = render_shopping_list(items)
+    if default_storage.exists(directory):
+        for name in default_storage.listdir(directory)[1]:
+            default_storage.delete(f'{directory}/{name}')
+    default_storage.save(path, ContentFile(content))
+    return content
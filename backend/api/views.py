@@ -1,10 +1,10 @@
 from collections import defaultdict
+from functools import partial
 
-from xhtml2pdf import pisa
-
-from django.template.loader import render_to_string
-from django.http import HttpResponse
-from django.utils.six import BytesIO
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils.cache import (get_conditional_response, patch_cache_control,
+                                quote_etag)
 from django.contrib.auth import get_user_model
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import (ValidationError as
@@ -20,32 +20,63 @@ from rest_framework import permissions
 from rest_framework import status
 from rest_framework import mixins
 
-from recipes.models import (Recipe, Tag, Ingredient, Subscription, Favorite,
-                            Cart)
+from recipes import relations
+from recipes.models import (CatalogVersion, Recipe, Tag, Ingredient,
+                            Subscription, Favorite, Cart, ShoppingListExport)
 
-from .filters import RecipeFilter, IngredientSearchFilter
-from .pagination import FoodgramPagination
+from .authentication import token_cache
+from .filters import (RecipeFilter, RecipeOrderingFilter,
+                      IngredientSearchFilter)
+from .pagination import FeedPagination, FoodgramPagination
 from .serializers import (UserSerializer, UserCreateSerializer,
                           RecipeReadOnlySerializer, TagSerializer,
                           IngredientSerializer, SetPasswordSerializer,
                           SubscriptionSerializer, RecipeInfoSerializer,
-                          RecipeCreateSerializer)
+                          RecipeCreateSerializer, RecipesLimitSerializer,
+                          ShoppingListExportSerializer,
+                          IngredientAutocompleteSerializer,
+                          BulkIdsSerializer)
 from .permissions import IsOwnerPermission, ReadOnlyPermission
-from .utils import fetch_resources
+from .reference import reference_response
+from .replicas import ReplicaReadMixin
+from .response_cache import cached_anonymous_list
+from .utils import (get_cached_shopping_list, get_shopping_list,
+                    shopping_list_version)
 
 User = get_user_model()
 
 
+def get_bulk_ids(request):
+    serializer = BulkIdsSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    return serializer.validated_data['ids']
+
+
+def bulk_relation_response(request, model, targets, ids):
+    """
+    Add (POST) or remove (DELETE) links of the current user to ids taken
+    from the request body, e.g. {"ids": [1, 2, 3]}.
+    """
+    if request.method == 'DELETE':
+        relations.remove(model, request.user, ids)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+    if targets.filter(id__in=ids).count() != len(ids):
+        raise ValidationError('Object does not exist!')
+    added = relations.add(model, request.user, ids)
+    return Response({'ids': added}, status=status.HTTP_201_CREATED)
+
+
 class CreateListRetrieveViewSet(mixins.CreateModelMixin, mixins.ListModelMixin,
                                 mixins.RetrieveModelMixin,
                                 viewsets.GenericViewSet):
     pass
 
 
-class UserViewSet(CreateListRetrieveViewSet):
+class UserViewSet(ReplicaReadMixin, CreateListRetrieveViewSet):
     queryset = User.objects.all()
     permission_classes = [permissions.IsAuthenticated]
     pagination_class = FoodgramPagination
+    cursor_ordering = ('id',)
 
     def get_serializer_class(self):
         if self.action == 'create':
@@ -63,7 +94,8 @@ class UserViewSet(CreateListRetrieveViewSet):
     @action(methods=['get'], detail=False,
             permission_classes=[permissions.IsAuthenticated])
     def me(self, request):
-        user = request.user
+        # request.user может прийти из кеша токенов, счетчики читаются из БД
+        user = User.objects.get(pk=request.user.pk)
         serializer = self.get_serializer(user)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
@@ -91,23 +123,52 @@ class UserViewSet(CreateListRetrieveViewSet):
                 'New password and current password are the same!'
             )
         user.set_password(new_password)
-        user.save()
+        user.save(update_fields=['password'])
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @action(methods=['get'], detail=False,
+            permission_classes=[permissions.IsAdminUser])
+    def auth_cache(self, request):
+        # Статистика кеша токенов текущего воркера
+        return Response(token_cache.stats())
+
+    def get_recipes_limit(self):
+        serializer = RecipesLimitSerializer(data=self.request.query_params)
+        serializer.is_valid(raise_exception=True)
+        return serializer.validated_data['recipes_limit']
+
+    def add_latest_recipes(self, authors, recipes_limit):
+        """Attach the recipes_limit newest recipes to every author."""
+        recipes = defaultdict(list)
+        for recipe in Recipe.objects.latest_by_author(
+                [author.pk for author in authors], recipes_limit):
+            recipes[recipe.author_id].append(recipe)
+        for author in authors:
+            author.is_subscribed = True
+            author.limited_recipes = recipes[author.pk]
+        return authors
+
     @action(methods=['get'], detail=False,
             permission_classes=[permissions.IsAuthenticated])
     def subscriptions(self, request):
         user = self.request.user
+        recipes_limit = self.get_recipes_limit()
         queryset = User.objects.filter(subscribers__user=user)
+        context = {'request': request, 'recipes_limit': recipes_limit}
 
+        # Рецепты читаются одним запросом для авторов страницы
         page = self.paginate_queryset(queryset)
         if page is not None:
-            serializer = SubscriptionSerializer(page, many=True,
-                                                context={'request': request})
+            serializer = SubscriptionSerializer(
+                self.add_latest_recipes(page, recipes_limit), many=True,
+                context=context
+            )
             return self.get_paginated_response(serializer.data)
 
-        serializer = SubscriptionSerializer(page, many=True,
-                                            context={'request': request})
+        serializer = SubscriptionSerializer(
+            self.add_latest_recipes(list(queryset), recipes_limit),
+            many=True, context=context
+        )
         return Response(serializer.data)
 
     @action(methods=['post', 'delete'], detail=True,
@@ -117,35 +178,58 @@ class UserViewSet(CreateListRetrieveViewSet):
         author = get_object_or_404(User, id=pk)
 
         if request.method == 'DELETE':
-            subscription = get_object_or_404(Subscription, user=user,
-                                             author=author)
-            subscription.delete()
+            if not relations.remove(Subscription, user, [author.id]):
+                raise Http404
             return Response(status=status.HTTP_204_NO_CONTENT)
 
         if user == author:
             raise ValidationError(f'Cannot subscribe yourself!')
 
-        if Subscription.objects.filter(user=user, author=author).exists():
+        recipes_limit = self.get_recipes_limit()
+        if not relations.add(Subscription, user, [author.id]):
             raise ValidationError(f'Already subscribe with author!')
-
-        Subscription.objects.create(user=user, author=author)
-        serializer = SubscriptionSerializer(author,
-                                            context={'request': request})
+        author, = self.add_latest_recipes([author], recipes_limit)
+        serializer = SubscriptionSerializer(
+            author,
+            context={'request': request, 'recipes_limit': recipes_limit}
+        )
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
+    @action(methods=['post', 'delete'], detail=False, url_path='subscribe',
+            permission_classes=[permissions.IsAuthenticated])
+    def subscribe_bulk(self, request):
+        ids = get_bulk_ids(request)
+        if request.method == 'POST' and request.user.id in ids:
+            raise ValidationError('Cannot subscribe yourself!')
+        return bulk_relation_response(request, Subscription, User.objects,
+                                      ids)
+
 
-class RecipeViewSet(viewsets.ModelViewSet):
+class RecipeViewSet(ReplicaReadMixin, viewsets.ModelViewSet):
     queryset = Recipe.objects.all()
     permission_classes = [ReadOnlyPermission | IsOwnerPermission]
     pagination_class = FoodgramPagination
-    filter_backends = [DjangoFilterBackend]
+    filter_backends = [DjangoFilterBackend, RecipeOrderingFilter]
     filterset_class = RecipeFilter
+    ordering_fields = ('pub_date', 'favorites_count', 'cart_count')
+
+    def get_queryset(self):
+        if self.action in ('list', 'retrieve'):
+            return Recipe.objects.for_read(self.request.user)
+        return super().get_queryset()
 
     def get_serializer_class(self):
         if self.action in ('create', 'partial_update'):
             return RecipeCreateSerializer
         return RecipeReadOnlySerializer
 
+    def list(self, request, *args, **kwargs):
+        if request.user.is_authenticated:
+            return super().list(request, *args, **kwargs)
+        return cached_anonymous_list(
+            request, partial(super().list, request, *args, **kwargs)
+        )
+
     def perform_create(self, serializer):
         return serializer.save(author=self.request.user)
 
@@ -153,6 +237,7 @@ class RecipeViewSet(viewsets.ModelViewSet):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         instance = self.perform_create(serializer)
+        instance = Recipe.objects.for_read(request.user).get(pk=instance.pk)
         instance_serializer = RecipeReadOnlySerializer(
             instance,
             context={'request': request}
@@ -161,7 +246,13 @@ class RecipeViewSet(viewsets.ModelViewSet):
                         status=status.HTTP_201_CREATED)
 
     def perform_update(self, serializer):
-        return serializer.save()
+        instance = serializer.save()
+        # Изменение только ингредиентов или тегов не сохраняет сам рецепт и
+        # не вызывает post_save, версию выдачи обновляем явно; если ничего
+        # не изменилось, кэш выдачи и индексы остаются в силе
+        if serializer.changed:
+            CatalogVersion.bump(Recipe.catalog_name)
+        return instance
 
     def update(self, request, *args, **kwargs):
         instance = self.get_object()
@@ -169,41 +260,73 @@ class RecipeViewSet(viewsets.ModelViewSet):
                                          partial=True)
         serializer.is_valid(raise_exception=True)
         instance = self.perform_update(serializer)
+        instance = Recipe.objects.for_read(request.user).get(pk=instance.pk)
         instance_serializer = RecipeReadOnlySerializer(
             instance,
             context={'request': request}
         )
         return Response(instance_serializer.data)
 
-    def perform_destroy(self, instance):
-        instance.ingredients.all().delete()
-        instance.delete()
+    @action(methods=['get'], detail=False,
+            permission_classes=[permissions.IsAuthenticated])
+    def feed(self, request):
+        paginator = FeedPagination()
+        ids = paginator.paginate_feed(request)
+        recipes = Recipe.objects.for_read(request.user).in_bulk(ids)
+        serializer = RecipeReadOnlySerializer(
+            [recipes[recipe_id] for recipe_id in ids if recipe_id in recipes],
+            many=True,
+            context={'request': request}
+        )
+        return paginator.get_paginated_response(serializer.data)
 
     @action(methods=['get'], detail=False,
             permission_classes=[permissions.IsAuthenticated])
     def download_shopping_cart(self, request):
-        user = request.user
-        purchases = user.purchases.select_related('recipe').prefetch_related(
-            'recipe__ingredients').all()
-        cart = defaultdict(int)
-        for purchase in purchases:
-            ingredients_in_recipe = purchase.recipe.ingredients.all()
-            for ingredient_in_recipe in ingredients_in_recipe:
-                amount = ingredient_in_recipe.amount
-                ingredient = ingredient_in_recipe.ingredient.name
-                measurement_unit = ingredient_in_recipe.ingredient.measurement_unit  # noqa
-                cart[f'{ingredient} ({measurement_unit})'] += amount
-
-        shopping_list = [f'{key} - {value}\n' for key, value in cart.items()]
-
-        template = 'shopping_list.html'
-        context = {'pagesize': 'A4', 'shopping_list': shopping_list}
-        html = render_to_string(template, context)
-        src = BytesIO(html.encode('utf-8'))
-        dest = BytesIO()
-        pisa.pisaDocument(src, dest, encoding='UTF-8',
-                          link_callback=fetch_resources)
-        response = HttpResponse(dest.getvalue(),
+        items = list(get_shopping_list(request.user))
+        run_async = request.query_params.get('async') in ('1', 'true')
+        # Большие списки рендерятся воркером renderexports, клиент получает
+        # id задачи и забирает файл через shopping_cart_exports
+        if run_async or len(items) > settings.SHOPPING_LIST_SYNC_MAX_ITEMS:
+            export = ShoppingListExport.objects.create(user=request.user)
+            serializer = ShoppingListExportSerializer(export)
+            return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
+
+        version = shopping_list_version(items)
+        etag = quote_etag(version)
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            content = get_cached_shopping_list(request.user, items, version)
+            response = HttpResponse(content, content_type='application/pdf')
+            response['Content-Disposition'] = ('attachment; '
+                                               'filename="Shopping List.pdf"')
+        response['ETag'] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+    # Статус задачи меняет воркер, а не пользователь, поэтому закрепление
+    # за основной базой после записи здесь не помогает
+    @action(methods=['get'], detail=False,
+            url_path=r'shopping_cart_exports/(?P<export_id>\d+)',
+            permission_classes=[permissions.IsAuthenticated],
+            use_replica=False)
+    def shopping_cart_export(self, request, export_id=None):
+        export = get_object_or_404(ShoppingListExport, id=export_id,
+                                   user=request.user)
+        serializer = ShoppingListExportSerializer(export)
+        return Response(serializer.data)
+
+    @action(methods=['get'], detail=False,
+            url_path=r'shopping_cart_exports/(?P<export_id>\d+)/download',
+            permission_classes=[permissions.IsAuthenticated],
+            use_replica=False)
+    def shopping_cart_export_download(self, request, export_id=None):
+        export = get_object_or_404(ShoppingListExport, id=export_id,
+                                   user=request.user)
+        if export.status != ShoppingListExport.DONE:
+            serializer = ShoppingListExportSerializer(export)
+            return Response(serializer.data, status=status.HTTP_409_CONFLICT)
+        response = FileResponse(export.file.open('rb'),
                                 content_type='application/pdf')
         response['Content-Disposition'] = ('attachment; '
                                            'filename="Shopping List.pdf"')
@@ -216,14 +339,13 @@ class RecipeViewSet(viewsets.ModelViewSet):
         recipe = get_object_or_404(Recipe, id=pk)
 
         if request.method == 'DELETE':
-            cart = get_object_or_404(Cart, user=user, recipe=recipe)
-            cart.delete()
+            if not relations.remove(Cart, user, [recipe.id]):
+                raise Http404
             return Response(status=status.HTTP_204_NO_CONTENT)
 
-        if Cart.objects.filter(user=user, recipe=recipe).exists():
+        if not relations.add(Cart, user, [recipe.id]):
             raise ValidationError(f'Recipe already in cart!')
 
-        Cart.objects.create(user=user, recipe=recipe)
         serializer = RecipeInfoSerializer(recipe)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
@@ -234,27 +356,77 @@ class RecipeViewSet(viewsets.ModelViewSet):
         recipe = get_object_or_404(Recipe, id=pk)
 
         if request.method == 'DELETE':
-            favorite = get_object_or_404(Favorite, user=user, recipe=recipe)
-            favorite.delete()
+            if not relations.remove(Favorite, user, [recipe.id]):
+                raise Http404
             return Response(status=status.HTTP_204_NO_CONTENT)
 
-        if Favorite.objects.filter(user=user, recipe=recipe).exists():
+        if not relations.add(Favorite, user, [recipe.id]):
             raise ValidationError('Recipe already favorite with current user!')
 
-        Favorite.objects.create(user=user, recipe=recipe)
         serializer = RecipeInfoSerializer(recipe)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
+    @action(methods=['post', 'delete'], detail=False, url_path='favorite',
+            permission_classes=[permissions.IsAuthenticated])
+    def favorite_bulk(self, request):
+        return bulk_relation_response(request, Favorite, Recipe.objects,
+                                      get_bulk_ids(request))
 
-class TagReadOnlyModelViewSet(viewsets.ReadOnlyModelViewSet):
+    @action(methods=['post', 'delete'], detail=False,
+            url_path='shopping_cart',
+            permission_classes=[permissions.IsAuthenticated])
+    def shopping_cart_bulk(self, request):
+        return bulk_relation_response(request, Cart, Recipe.objects,
+                                      get_bulk_ids(request))
+
+
+class TagReadOnlyModelViewSet(ReplicaReadMixin,
+                              viewsets.ReadOnlyModelViewSet):
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
     permission_classes = [permissions.AllowAny]
 
+    def list(self, request, *args, **kwargs):
+        return reference_response(
+            request, Tag.catalog_name,
+            lambda: self.get_serializer(self.get_queryset(), many=True).data
+        )
+
 
-class IngredientReadOnlyModelViewSet(viewsets.ReadOnlyModelViewSet):
+class IngredientReadOnlyModelViewSet(ReplicaReadMixin,
+                                     viewsets.ReadOnlyModelViewSet):
     queryset = Ingredient.objects.all()
     serializer_class = IngredientSerializer
     permission_classes = [permissions.AllowAny]
     filter_backends = [IngredientSearchFilter]
-    search_fields = ('^name',)
+
+    def list(self, request, *args, **kwargs):
+        if IngredientSearchFilter.search_param in request.query_params:
+            return super().list(request, *args, **kwargs)
+        return reference_response(
+            request, Ingredient.catalog_name,
+            lambda: self.get_serializer(self.get_queryset(), many=True).data
+        )
+
+    @action(methods=['get'], detail=False)
+    def autocomplete(self, request):
+        params = IngredientAutocompleteSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        name = params.validated_data['name'].lower()
+        limit = params.validated_data['limit']
+
+        # Сначала совпадения по началу названия (индекс name_lower), затем,
+        # если мест в выдаче осталось, совпадения по вхождению
+        queryset = self.get_queryset().order_by('name_lower', 'pk')
+        ingredients = list(
+            queryset.filter(name_lower__startswith=name)[:limit]
+        )
+        if len(ingredients) < limit:
+            ingredients += queryset.filter(
+                name_lower__contains=name
+            ).exclude(
+                name_lower__startswith=name
+            )[:limit - len(ingredients)]
+
+        serializer = self.get_serializer(ingredients, many=True)
+        return Response(serializer.data)
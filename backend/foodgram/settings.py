@@ -47,6 +47,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.profiling.ProfilingMiddleware',
+    'api.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -91,6 +93,39 @@ DATABASES = {
     }
 }
 
+# The default cache is local to each worker unless CACHE_BACKEND names a
+# shared one, e.g. django.core.cache.backends.db.DatabaseCache with the
+# table name in CACHE_LOCATION (created by manage.py createcachetable)
+CACHES = {
+    'default': {
+        'BACKEND': (os.getenv('CACHE_BACKEND')
+                    or 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION') or '',
+    }
+}
+
+# Read replicas: DB_REPLICA_HOSTS is a comma separated list of host[:port]
+# of replicas that share the primary's name and credentials. Reads of the
+# API views go to a replica unless the user wrote within the last
+# REPLICA_STICKY_SECONDS, tracked in the REPLICA_STICKY_CACHE entry of
+# CACHES. That cache must be shared by all workers: a system check fails
+# when replicas are configured with a per-process one. In tests replicas
+# mirror the primary's test database
+DATABASE_REPLICAS = []
+for replica_host in filter(None, os.getenv('DB_REPLICA_HOSTS',
+                                           default='').split(',')):
+    replica_host, _, replica_port = replica_host.strip().partition(':')
+    DATABASE_REPLICAS.append(f'replica{len(DATABASE_REPLICAS) + 1}')
+    DATABASES[DATABASE_REPLICAS[-1]] = dict(
+        DATABASES['default'],
+        HOST=replica_host,
+        PORT=replica_port or DATABASES['default']['PORT'],
+        TEST={'MIRROR': 'default'}
+    )
+DATABASE_ROUTERS = ['api.replicas.ReplicaRouter']
+REPLICA_STICKY_SECONDS = int(os.getenv('REPLICA_STICKY_SECONDS', default=5))
+REPLICA_STICKY_CACHE = os.getenv('REPLICA_STICKY_CACHE', default='default')
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
@@ -143,10 +178,125 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticated',
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'api.authentication.CachedTokenAuthentication',
     ],
 }
 
 DJOSER = {
     'LOGIN_FIELD': 'email',
 }
+
+# Paginated list counts: exact counts stop at the cap, filtered counts are
+# cached for the timeout (seconds), unfiltered tables larger than the
+# threshold use the PostgreSQL planner estimate
+PAGINATION_COUNT_CAP = int(os.getenv('PAGINATION_COUNT_CAP', default=10000))
+PAGINATION_COUNT_CACHE_TIMEOUT = int(
+    os.getenv('PAGINATION_COUNT_CACHE_TIMEOUT', default=30)
+)
+PAGINATION_ESTIMATE_THRESHOLD = int(
+    os.getenv('PAGINATION_ESTIMATE_THRESHOLD', default=100000)
+)
+
+# Subscribing to an author with more recipes than this does not copy them
+# into the subscriber's feed, they are merged into the feed when it is read
+FEED_BACKFILL_MAX_RECIPES = int(
+    os.getenv('FEED_BACKFILL_MAX_RECIPES', default=500)
+)
+
+# Shopping lists with more distinct ingredients than this are rendered by the
+# renderexports worker instead of inside the request
+SHOPPING_LIST_SYNC_MAX_ITEMS = int(
+    os.getenv('SHOPPING_LIST_SYNC_MAX_ITEMS', default=100)
+)
+
+# An export still processing SHOPPING_LIST_EXPORT_LEASE_SECONDS after a
+# worker took it is considered abandoned (the worker died) and queued
+# again, up to SHOPPING_LIST_EXPORT_MAX_ATTEMPTS attempts in total. Finished
+# exports and their files are deleted after
+# SHOPPING_LIST_EXPORT_RETENTION_SECONDS
+SHOPPING_LIST_EXPORT_LEASE_SECONDS = int(
+    os.getenv('SHOPPING_LIST_EXPORT_LEASE_SECONDS', default=300)
+)
+SHOPPING_LIST_EXPORT_MAX_ATTEMPTS = 3
+SHOPPING_LIST_EXPORT_RETENTION_SECONDS = int(
+    os.getenv('SHOPPING_LIST_EXPORT_RETENTION_SECONDS', default=24 * 3600)
+)
+
+# Authenticated tokens are cached in each worker for TOKEN_CACHE_TTL seconds
+# (at most TOKEN_CACHE_SIZE entries), 0 turns the cache off. TOKEN_CACHE_BACKEND
+# names an entry of CACHES shared by all workers. Logout, password change and
+# deactivation are recorded there (in the default cache without it) and
+# checked on every hit. That cache has to be shared for the other workers to
+# see them: a system check fails when the token cache is on and it is
+# per-process
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', default=10000))
+TOKEN_CACHE_TTL = int(os.getenv('TOKEN_CACHE_TTL', default=0))
+TOKEN_CACHE_BACKEND = os.getenv('TOKEN_CACHE_BACKEND') or None
+
+# Anonymous recipe list pages are cached for this many seconds; recipe
+# changes invalidate them at once, favorite and cart counters may lag
+RECIPE_LIST_CACHE_TIMEOUT = int(
+    os.getenv('RECIPE_LIST_CACHE_TIMEOUT', default=60)
+)
+
+# Recipe full-text search: text search configuration of PostgreSQL and the
+# number of best matches considered by the in-memory fallback on SQLite
+SEARCH_CONFIG = os.getenv('SEARCH_CONFIG', default='russian')
+SEARCH_FALLBACK_LIMIT = 200
+
+# In-memory ingredient index of every worker (recipes.ingredient_index):
+# filters matching up to INGREDIENT_INDEX_MAX_IDS recipes pass their ids to
+# the database, larger ones fall back to subqueries; pantry returns the
+# INGREDIENT_INDEX_MAX_RESULTS best covered recipes lacking at most
+# max_missing (up to INGREDIENT_INDEX_MAX_MISSING) ingredients. More than
+# INGREDIENT_INDEX_MAX_CHANGES changed recipes, or
+# INGREDIENT_INDEX_REBUILD_SECONDS since the last build, rebuild the index in
+# a background thread; the first build runs when the worker starts
+INGREDIENT_INDEX_MAX_IDS = 5000
+INGREDIENT_INDEX_MAX_RESULTS = 200
+INGREDIENT_INDEX_MAX_MISSING = 5
+INGREDIENT_INDEX_BITMAPS = 512
+INGREDIENT_INDEX_OVERLAP = 60
+INGREDIENT_INDEX_MAX_CHANGES = 10000
+INGREDIENT_INDEX_REBUILD_SECONDS = int(
+    os.getenv('INGREDIENT_INDEX_REBUILD_SECONDS', default=3600)
+)
+
+# Opt-in request profiling: Server-Timing header and a JSON log line per
+# request; PROFILING_SAMPLE_RATE of requests run under cProfile and the
+# PROFILING_KEEP slowest of those over PROFILING_SLOW_MS are saved
+PROFILING_ENABLED = os.getenv('PROFILING_ENABLED',
+                              default='false').lower() == 'true'
+PROFILING_SAMPLE_RATE = float(os.getenv('PROFILING_SAMPLE_RATE',
+                                        default=0.01))
+PROFILING_SLOW_MS = int(os.getenv('PROFILING_SLOW_MS', default=500))
+PROFILING_KEEP = int(os.getenv('PROFILING_KEEP', default=20))
+PROFILING_TOP = 5
+PROFILING_DIR = os.getenv('PROFILING_DIR',
+                          default=os.path.join(BASE_DIR, 'profiles'))
+
+# Request, cache and PDF metrics served at /metrics. With several gunicorn
+# workers METRICS_MULTIPROC_DIR must point to a directory shared by them:
+# each worker writes its samples there every METRICS_FLUSH_INTERVAL seconds
+METRICS_ENABLED = os.getenv('METRICS_ENABLED',
+                            default='true').lower() == 'true'
+METRICS_MULTIPROC_DIR = os.getenv('METRICS_MULTIPROC_DIR') or None
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL',
+                                         default=5))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'api.profiling': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'foodgram.settings')
 
 application = get_wsgi_application()
+
+# Индекс ингредиентов строится до первого запроса воркера
+from recipes import ingredient_index  # noqa: E402
+
+ingredient_index.prewarm()
@@ -0,0 +1,19 @@
+import glob
+import os
+
+# Воркеры пишут метрики в общий каталог, /metrics суммирует их файлы
+metrics_dir = os.environ.setdefault('METRICS_MULTIPROC_DIR',
+                                    '/tmp/foodgram-metrics')
+
+
+def on_starting(server):
+    # Файлы предыдущего запуска не должны попасть в счетчики нового
+    os.makedirs(metrics_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(metrics_dir, '*.json*')):
+        os.remove(path)
+
+
+def worker_exit(server, worker):
+    from api.metrics import REGISTRY
+
+    REGISTRY.flush()
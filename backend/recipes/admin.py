@@ -1,18 +1,25 @@
 from django.contrib import admin
 
 from .models import (Recipe, Tag, Ingredient, IngredientInRecipe, Favorite,
-                     Cart, Subscription)
+                     Cart, Subscription, ShoppingListExport)
+
+
+class IngredientInRecipeInline(admin.TabularInline):
+    model = IngredientInRecipe
+    autocomplete_fields = ('ingredient',)
+    extra = 1
 
 
 class RecipeAdmin(admin.ModelAdmin):
     list_display = ('name', 'author')
     list_filter = ('author', 'name', 'tags')
-    fields = ('author', 'name', 'image', 'text', 'ingredients', 'tags',
-              'cooking_time', 'count_favorite')
+    fields = ('author', 'name', 'image', 'text', 'tags', 'cooking_time',
+              'count_favorite')
     readonly_fields = ('count_favorite',)
+    inlines = (IngredientInRecipeInline,)
 
     def count_favorite(self, obj):
-        return obj.favorites.count()
+        return obj.favorites_count
 
 
 class IngredientAdmin(admin.ModelAdmin):
@@ -25,6 +32,12 @@ class TagAdmin(admin.ModelAdmin):
     list_display = ('name', 'color', 'slug')
 
 
+class ShoppingListExportAdmin(admin.ModelAdmin):
+    list_display = ('user', 'status', 'created', 'started', 'attempts',
+                    'finished')
+    list_filter = ('status',)
+
+
 admin.site.register(Recipe, RecipeAdmin)
 admin.site.register(Ingredient, IngredientAdmin)
 admin.site.register(Tag, TagAdmin)
@@ -32,3 +45,4 @@ admin.site.register(IngredientInRecipe, admin.ModelAdmin)
 admin.site.register(Favorite, admin.ModelAdmin)
 admin.site.register(Cart, admin.ModelAdmin)
 admin.site.register(Subscription, admin.ModelAdmin)
+admin.site.register(ShoppingListExport, ShoppingListExportAdmin)
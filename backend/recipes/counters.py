@@ -0,0 +1,80 @@
+"""
+Denormalized counters: Recipe.favorites_count, Recipe.cart_count,
+User.recipes_count and User.subscribers_count.
+
+Counters are changed with F() expressions, so concurrent requests never
+overwrite each other. The reconcilecounters command repairs any drift.
+"""
+from django.contrib.auth import get_user_model
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from .models import Cart, Favorite, Recipe, Subscription
+
+User = get_user_model()
+
+# Модель со счетчиком -> {поле счетчика: (модель строк, поле связи)}
+COUNTERS = {
+    Recipe: {
+        'favorites_count': (Favorite, 'recipe'),
+        'cart_count': (Cart, 'recipe'),
+    },
+    User: {
+        'recipes_count': (Recipe, 'author'),
+        'subscribers_count': (Subscription, 'author'),
+    },
+}
+
+
+def change(queryset, field, delta):
+    """Atomically add delta to a counter field of the queryset rows."""
+    if delta < 0:
+        # Счетчик не уходит ниже нуля даже при рассинхронизации
+        queryset = queryset.filter(**{f'{field}__gte': -delta})
+    queryset.update(**{field: F(field) + delta})
+
+
+def change_for(instance, delta):
+    """Apply delta to every counter that counts rows like instance."""
+    for model, fields in COUNTERS.items():
+        for field, (source, relation) in fields.items():
+            if isinstance(instance, source):
+                pk = getattr(instance, f'{relation}_id')
+                change(model.objects.filter(pk=pk), field, delta)
+
+
+def count_of(source, relation):
+    """Expression counting source rows that point to the outer row."""
+    counts = source.objects.filter(
+        **{relation: OuterRef('pk')}
+    ).order_by().values(relation).annotate(total=Count('pk'))
+    return Coalesce(
+        Subquery(counts.values('total'), output_field=IntegerField()), 0
+    )
+
+
+def actual_counts(model):
+    """Annotations with the real value of every counter of the model."""
+    return {f'actual_{field}': count_of(source, relation)
+            for field, (source, relation) in COUNTERS[model].items()}
+
+
+def recount(source, pks):
+    """
+    Set the counters of source rows of the given model rows (recipes or
+    authors) to their real values with one UPDATE per counter.
+    """
+    for model, fields in COUNTERS.items():
+        for field, (counted, relation) in fields.items():
+            if counted is source:
+                model.objects.filter(pk__in=pks).update(
+                    **{field: count_of(source, relation)}
+                )
+
+
+def recount_all():
+    """Set every counter to its real value, one UPDATE per model."""
+    for model, fields in COUNTERS.items():
+        model.objects.update(**{field: count_of(source, relation)
+                                for field, (source, relation)
+                                in fields.items()})
@@ -0,0 +1,92 @@
+"""
+Materialized "recipes from my subscriptions" feed.
+
+Recipes are copied into FeedItem on write: fanned out to subscribers when
+published and back-filled when a user subscribes. Authors with more than
+FEED_BACKFILL_MAX_RECIPES recipes at subscription time are not copied; their
+recipes are merged into the feed at read time instead.
+"""
+from django.conf import settings
+from django.db.models import Q
+
+from .models import FeedItem, Recipe, Subscription
+
+BATCH_SIZE = 1000
+
+
+def _bulk_insert(items):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == BATCH_SIZE:
+            FeedItem.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    FeedItem.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+def fan_out(recipe):
+    """Add a freshly published recipe to its author's subscribers' feeds."""
+    subscribers = Subscription.objects.filter(
+        author_id=recipe.author_id, feed_materialized=True
+    ).values_list('user_id', flat=True)
+    _bulk_insert(
+        FeedItem(user_id=user_id, recipe_id=recipe.id,
+                 author_id=recipe.author_id, pub_date=recipe.pub_date)
+        for user_id in subscribers.iterator(chunk_size=BATCH_SIZE)
+    )
+
+
+def backfill(subscription):
+    """Copy the author's recipes into a new subscriber's feed."""
+    recipes = Recipe.objects.filter(author_id=subscription.author_id)
+    if recipes.count() > settings.FEED_BACKFILL_MAX_RECIPES:
+        Subscription.objects.filter(id=subscription.id).update(
+            feed_materialized=False
+        )
+        subscription.feed_materialized = False
+        return
+    _bulk_insert(
+        FeedItem(user_id=subscription.user_id, recipe_id=recipe_id,
+                 author_id=subscription.author_id, pub_date=pub_date)
+        for recipe_id, pub_date in recipes.values_list('id', 'pub_date')
+    )
+
+
+def prune(subscription):
+    """Drop an unsubscribed author's recipes from the user's feed."""
+    FeedItem.objects.filter(user_id=subscription.user_id,
+                            author_id=subscription.author_id).delete()
+
+
+def _after(position, date_field, id_field):
+    if position is None:
+        return Q()
+    pub_date, recipe_id = position
+    return (Q(**{f'{date_field}__lt': pub_date})
+            | Q(**{date_field: pub_date, f'{id_field}__lt': recipe_id}))
+
+
+def get_feed(user, position, limit):
+    """
+    Return up to limit (pub_date, recipe_id) pairs of the user's feed that
+    come after position, newest first. Materialized items are read with one
+    range scan of the feed index; authors that are not materialized are
+    merged in from the recipe table.
+    """
+    rows = list(
+        FeedItem.objects.filter(
+            _after(position, 'pub_date', 'recipe_id'), user=user
+        ).order_by('-pub_date', '-recipe_id').values_list(
+            'pub_date', 'recipe_id'
+        )[:limit]
+    )
+    merged_authors = Subscription.objects.filter(
+        user=user, feed_materialized=False
+    ).values('author_id')
+    if merged_authors.exists():
+        rows += Recipe.objects.filter(
+            _after(position, 'pub_date', 'id'),
+            author_id__in=merged_authors
+        ).order_by('-pub_date', '-id').values_list('pub_date', 'id')[:limit]
+        rows = sorted(rows, reverse=True)[:limit]
+    return rows
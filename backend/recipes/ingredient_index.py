@@ -0,0 +1,465 @@
+"""
+In-memory ingredient index for the include_ingredients,
+exclude_ingredients and pantry recipe filters.
+
+Every worker keeps, per database alias, the sorted ids of the recipes
+using each ingredient (postings) and the ingredients of every recipe, both
+in compact array('I') form, 4 bytes per ingredient line. Set operations
+run on bitmaps: Python ints with bit n set for recipe n, built from the
+postings and cached for the INGREDIENT_INDEX_BITMAPS most used
+ingredients. Pantry coverage is counted with bit-sliced counters (bit j of
+every recipe's count in one int), so a query costs a few hundred
+operations on ints of max recipe id / 8 bytes however many recipes match.
+
+The index is built when the worker starts (prewarm(), called from the
+WSGI module); a worker left without one (the prewarm failed, or the
+database is a replica) builds it in a background thread and filters in
+the database meanwhile. It is updated incrementally afterwards: when the
+recipes catalog version changes, the ingredients of recipes modified since
+the previous refresh are reloaded. Full rebuilds, every
+INGREDIENT_INDEX_REBUILD_SECONDS or after too many changes, run in a
+background thread while requests keep using the previous index, which is
+then swapped for the new one. Deleted recipes stay in the index until the
+next full rebuild; results are always filtered by the database, so they
+never show up.
+"""
+import logging
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from datetime import timedelta
+from itertools import repeat
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+from django.db.models import (Case, CharField, Count, F, IntegerField, Q,
+                              Value, When)
+from django.utils import timezone
+
+from .models import CatalogVersion, IngredientInRecipe, Recipe
+
+NONZERO = re.compile(b'[^\x00]')
+ONE = ord('1')
+EMPTY = array('I')
+
+logger = logging.getLogger(__name__)
+
+# Индексы по алиасу базы и алиасы, для которых идет фоновое построение
+_indexes = {}
+_rebuilding = set()
+_lock = threading.RLock()
+
+
+def from_digits(digits):
+    """Bitmap from ASCII digits, digits[n] == ONE for bit n."""
+    digits.reverse()
+    return int(digits, 2) if digits else 0
+
+
+def to_bitmap(ids):
+    # Двоичная запись числа собирается из ASCII-цифр: так быстрее, чем
+    # выставлять биты по одному
+    digits = bytearray(b'0') * (ids[-1] + 1 if ids else 0)
+    for pk in ids:
+        digits[pk] = ONE
+    return from_digits(digits)
+
+
+def bits(bitmap, limit=None):
+    """Positions of the set bits of bitmap, highest first."""
+    size = (bitmap.bit_length() + 7) // 8
+    data = bitmap.to_bytes(size, 'big')
+    result = []
+    for match in NONZERO.finditer(data):
+        byte, offset = data[match.start()], (size - 1 - match.start()) * 8
+        for bit in range(7, -1, -1):
+            if byte >> bit & 1:
+                result.append(offset + bit)
+                if len(result) == limit:
+                    return result
+    return result
+
+
+def popcount(bitmap):
+    return bin(bitmap).count('1')
+
+
+def add(counter, bitmap):
+    """Add 1 to the bit-sliced counter for the recipes in bitmap."""
+    carry = bitmap
+    for bit, value in enumerate(counter):
+        if not carry:
+            return
+        counter[bit], carry = value ^ carry, value & carry
+    if carry:
+        counter.append(carry)
+
+
+def subtract(minuend, subtrahend):
+    """Bit-sliced difference, every count of subtrahend is not greater."""
+    size = max(len(minuend), len(subtrahend))
+    minuend = minuend + [0] * (size - len(minuend))
+    subtrahend = subtrahend + [0] * (size - len(subtrahend))
+    result, borrow = [], 0
+    for x, y in zip(minuend, subtrahend):
+        result.append(x ^ y ^ borrow)
+        borrow = (~x & y) | (~(x ^ y) & borrow)
+    return result
+
+
+def equal(counter, value, within):
+    """Recipes of within whose count in the bit-sliced counter is value."""
+    if value >> len(counter):
+        return 0
+    for bit, slice_ in enumerate(counter):
+        within &= slice_ if value >> bit & 1 else ~slice_
+        if not within:
+            break
+    return within
+
+
+class IngredientIndex:
+    def __init__(self, version, rows, recipe_ids=EMPTY):
+        """
+        rows: (recipe id, ingredient id) pairs ordered by recipe id,
+        recipe_ids: ids of all recipes in ascending order.
+        """
+        self.version = version
+        self.built = time.monotonic()
+        self.refreshed = timezone.now()
+        self.postings = {}
+        # Ингредиенты рецепта r - lines[offsets[r]:offsets[r + 1]], после
+        # построения измененные рецепты хранятся в changed
+        self.offsets = array('I')
+        self.lines = array('I')
+        self.changed = {}
+        self.bitmaps = OrderedDict()
+        offsets, lines, postings = self.offsets, self.lines, self.postings
+        append, previous = lines.append, None
+        for recipe_id, ingredient_id in rows:
+            if recipe_id != previous:
+                offsets.extend(repeat(len(lines),
+                                      recipe_id + 1 - len(offsets)))
+                previous = recipe_id
+            append(ingredient_id)
+            posting = postings.get(ingredient_id)
+            if posting is None:
+                posting = postings[ingredient_id] = array('I')
+            posting.append(recipe_id)
+        offsets.append(len(lines))
+
+        # Число ингредиентов рецептов - побитовые срезы: totals[j] - рецепты
+        # с установленным битом j в числе
+        alive, totals = bytearray(b'0') * len(offsets), []
+        self.max_total = 0
+        for recipe_id in range(len(offsets) - 1):
+            total = offsets[recipe_id + 1] - offsets[recipe_id]
+            if not total:
+                continue
+            alive[recipe_id] = ONE
+            while len(totals) < total.bit_length():
+                totals.append(bytearray(b'0') * len(offsets))
+            for bit in range(total.bit_length()):
+                if total >> bit & 1:
+                    totals[bit][recipe_id] = ONE
+            if total > self.max_total:
+                self.max_total = total
+        # Рецепты без ингредиентов тоже живые: их не исключает
+        # exclude_ingredients
+        self.alive = from_digits(alive) | to_bitmap(recipe_ids)
+        self.totals = [from_digits(digits) for digits in totals]
+
+    def ingredients(self, recipe_id):
+        if recipe_id in self.changed:
+            return self.changed[recipe_id]
+        if recipe_id + 1 < len(self.offsets):
+            return self.lines[self.offsets[recipe_id]:
+                              self.offsets[recipe_id + 1]]
+        return EMPTY
+
+    def bitmap(self, ingredient_id):
+        bitmap = self.bitmaps.get(ingredient_id)
+        if bitmap is None:
+            bitmap = to_bitmap(self.postings.get(ingredient_id, EMPTY))
+            self.bitmaps[ingredient_id] = bitmap
+            if len(self.bitmaps) > settings.INGREDIENT_INDEX_BITMAPS:
+                self.bitmaps.popitem(last=False)
+        else:
+            self.bitmaps.move_to_end(ingredient_id)
+        return bitmap
+
+    def set_recipe(self, recipe_id, ingredient_ids):
+        old = set(self.ingredients(recipe_id))
+        new = set(ingredient_ids)
+        mask = 1 << recipe_id
+        for ingredient_id in old - new:
+            posting = self.postings[ingredient_id]
+            del posting[bisect_left(posting, recipe_id)]
+            if ingredient_id in self.bitmaps:
+                self.bitmaps[ingredient_id] &= ~mask
+        for ingredient_id in new - old:
+            insort(self.postings.setdefault(ingredient_id, array('I')),
+                   recipe_id)
+            if ingredient_id in self.bitmaps:
+                self.bitmaps[ingredient_id] |= mask
+        self.changed[recipe_id] = array('I', sorted(new))
+
+        total = len(new)
+        self.alive |= mask
+        while len(self.totals) < total.bit_length():
+            self.totals.append(0)
+        self.totals = [slice_ | mask if total >> bit & 1 else slice_ & ~mask
+                       for bit, slice_ in enumerate(self.totals)]
+        self.max_total = max(self.max_total, total)
+
+    def matching(self, include=(), exclude=()):
+        """Bitmap of recipes with every include and no exclude ingredient."""
+        result = self.alive
+        for ingredient_id in sorted(
+                set(include),
+                key=lambda pk: len(self.postings.get(pk, EMPTY))):
+            result &= self.bitmap(ingredient_id)
+            if not result:
+                return 0
+        excluded = 0
+        for ingredient_id in set(exclude):
+            excluded |= self.bitmap(ingredient_id)
+        return result & ~excluded
+
+    def pantry(self, ingredient_ids, max_missing, within, limit):
+        """
+        Up to limit (recipe id, missing, total) of the recipes of within
+        that use some of ingredient_ids and lack at most max_missing other
+        ingredients: fewest missing first, then the most pantry ingredients
+        used, newest first.
+        """
+        have, candidates = [], 0
+        for ingredient_id in set(ingredient_ids):
+            bitmap = self.bitmap(ingredient_id)
+            if bitmap:
+                add(have, bitmap)
+                candidates |= bitmap
+        candidates &= within
+        missing = subtract(self.totals, have)
+        ranked = []
+        for lacking in range(max_missing + 1):
+            level = equal(missing, lacking, candidates)
+            total = self.max_total
+            while level and total > lacking:
+                group = equal(self.totals, total, level)
+                if group:
+                    level &= ~group
+                    ranked += [(recipe_id, lacking, total) for recipe_id
+                               in bits(group, limit - len(ranked))]
+                    if len(ranked) == limit:
+                        return ranked
+                total -= 1
+        return ranked
+
+    def refresh(self, using, version):
+        since = self.refreshed - timedelta(
+            seconds=settings.INGREDIENT_INDEX_OVERLAP
+        )
+        refreshed = timezone.now()
+        changed = list(Recipe.objects.using(using).filter(
+            modified__gte=since
+        ).values_list('id', flat=True))
+        if len(changed) > settings.INGREDIENT_INDEX_MAX_CHANGES:
+            return False
+        ingredients = {recipe_id: [] for recipe_id in changed}
+        for recipe_id, ingredient_id in IngredientInRecipe.objects.using(
+                using).filter(recipe__modified__gte=since).values_list(
+                    'recipe_id', 'ingredient_id'):
+            ingredients.setdefault(recipe_id, []).append(ingredient_id)
+        for recipe_id, ingredient_ids in ingredients.items():
+            self.set_recipe(recipe_id, ingredient_ids)
+        self.version, self.refreshed = version, refreshed
+        return True
+
+
+def build(using, version):
+    # Рецепты читаются до строк: рецепт, созданный между запросами, попадет
+    # в индекс по своим строкам
+    recipe_ids = array('I', Recipe.objects.using(using).order_by(
+        'pk'
+    ).values_list('pk', flat=True).iterator(chunk_size=10000))
+    rows = IngredientInRecipe.objects.using(using).order_by(
+        'recipe_id'
+    ).values_list('recipe_id', 'ingredient_id')
+    return IngredientIndex(version, rows.iterator(chunk_size=10000),
+                           recipe_ids)
+
+
+def current_version(using):
+    return CatalogVersion.objects.using(using).filter(
+        name=Recipe.catalog_name
+    ).values_list('version', flat=True).first()
+
+
+def rebuild(using):
+    """Build a new index of the database and swap it in."""
+    try:
+        index = build(using, current_version(using))
+        with _lock:
+            _indexes[using] = index
+    except DatabaseError:
+        logger.exception('Ingredient index build failed for %s', using)
+    finally:
+        with _lock:
+            _rebuilding.discard(using)
+        # Соединения потока не закрываются обработчиком конца запроса
+        connections.close_all()
+
+
+def rebuild_in_background(using):
+    """Start rebuild() in a thread unless one is running. Call under _lock."""
+    if using not in _rebuilding:
+        _rebuilding.add(using)
+        threading.Thread(target=rebuild, args=(using,), daemon=True,
+                         name=f'ingredient-index-{using}').start()
+
+
+def prewarm(using='default'):
+    """Build the index before the worker serves requests."""
+    try:
+        index = build(using, current_version(using))
+    except DatabaseError:
+        # База еще не готова: индекс построит в фоне первый запрос
+        logger.exception('Ingredient index prewarm failed for %s', using)
+        return
+    with _lock:
+        _indexes.setdefault(using, index)
+
+
+def get_index(using):
+    """
+    Index of the database, brought up to date, or None while it is being
+    built. Call under _lock.
+    """
+    index = _indexes.get(using)
+    if index is None:
+        # Индекс не прогрет при старте (например, у реплики): построение
+        # под блокировкой остановило бы все запросы воркера
+        rebuild_in_background(using)
+        return None
+    # Версия читается до данных: запись между ними вызовет еще одно
+    # обновление, а не потерю изменений
+    version = current_version(using)
+    if (time.monotonic() - index.built
+            > settings.INGREDIENT_INDEX_REBUILD_SECONDS):
+        # Следующая попытка - не раньше чем через период, даже если эта
+        # не удастся
+        index.built = time.monotonic()
+        rebuild_in_background(using)
+    if index.version != version and not index.refresh(using, version):
+        # Изменилось слишком много рецептов, дешевле построить заново; до
+        # замены индекса их изменения не видны фильтрам по ингредиентам
+        index.version = version
+        rebuild_in_background(using)
+    return index
+
+
+def candidates(queryset):
+    """
+    Bitmap of the recipes of queryset, None when no filter restricts it.
+    """
+    if not queryset.query.where:
+        return None
+    return to_bitmap(sorted(queryset.order_by().values_list('pk', flat=True)))
+
+
+def filter_recipes(queryset, include=(), exclude=(), pantry=(),
+                   max_missing=0):
+    """
+    Recipes of queryset using every include and no exclude ingredient.
+    With pantry, only the recipes lacking at most max_missing ingredients
+    besides the pantry ones, best covered first, annotated with pantry_rank
+    and what coverage() needs.
+    """
+    # Кладовая ранжирует только рецепты, прошедшие остальные фильтры:
+    # иначе лучшие рецепты всего каталога вытеснили бы подходящие
+    within = candidates(queryset) if pantry else None
+    ids = None
+    with _lock:
+        index = get_index(queryset.db)
+        if index is not None:
+            matching = index.matching(include, exclude)
+            if pantry:
+                if within is not None:
+                    matching &= within
+                ranked = index.pantry(pantry, max_missing, matching,
+                                      settings.INGREDIENT_INDEX_MAX_RESULTS)
+            elif popcount(matching) <= settings.INGREDIENT_INDEX_MAX_IDS:
+                ids = bits(matching)
+
+    if index is None:
+        # Индекс еще строится, фильтрует база
+        queryset = filter_in_database(queryset, include, exclude)
+        if not pantry:
+            return queryset
+        ranked = rank_in_database(queryset, pantry, max_missing,
+                                  settings.INGREDIENT_INDEX_MAX_RESULTS)
+    if pantry:
+        if not ranked:
+            return queryset.none()
+        return queryset.filter(pk__in=[pk for pk, _, _ in ranked]).annotate(
+            pantry_rank=Case(*[When(pk=pk, then=Value(position))
+                               for position, (pk, _, _) in enumerate(ranked)],
+                             output_field=IntegerField()),
+            pantry_ingredients=Value(
+                ','.join(map(str, sorted(set(pantry)))),
+                output_field=CharField()
+            )
+        ).order_by('pantry_rank')
+    if ids is not None:
+        return queryset.filter(pk__in=ids)
+    # Слишком много совпадений для списка id, фильтрует база
+    return filter_in_database(queryset, include, exclude)
+
+
+def filter_in_database(queryset, include=(), exclude=()):
+    """Recipes of queryset using every include and no exclude ingredient."""
+    for ingredient_id in set(include):
+        queryset = queryset.filter(pk__in=IngredientInRecipe.objects.filter(
+            ingredient_id=ingredient_id
+        ).values('recipe_id'))
+    if exclude:
+        queryset = queryset.exclude(pk__in=IngredientInRecipe.objects.filter(
+            ingredient_id__in=exclude
+        ).values('recipe_id'))
+    return queryset
+
+
+def rank_in_database(queryset, pantry, max_missing, limit):
+    """
+    What IngredientIndex.pantry() returns for the recipes of queryset,
+    counted by the database.
+    """
+    # Ранжируются рецепты, а не строки queryset с его аннотациями
+    recipes = queryset.model.objects.using(queryset.db).filter(
+        pk__in=queryset.order_by().values('pk')
+    )
+    return list(recipes.annotate(
+        total=Count('ingredients'),
+        have=Count('ingredients', filter=Q(
+            ingredients__ingredient_id__in=set(pantry)
+        ))
+    ).annotate(
+        missing=F('total') - F('have')
+    ).filter(
+        have__gt=0, missing__lte=max_missing
+    ).order_by('missing', '-total', '-pk').values_list(
+        'pk', 'missing', 'total'
+    )[:limit])
+
+
+def coverage(recipe):
+    """Pantry coverage of a recipe found by filter_recipes()."""
+    pantry = {int(pk) for pk in recipe.pantry_ingredients.split(',')}
+    ingredients = [line.ingredient_id for line in recipe.ingredients.all()]
+    have = len(pantry.intersection(ingredients))
+    return {'coverage': round(have / len(ingredients), 4) if ingredients
+            else 0, 'missing': len(ingredients) - have}
@@ -2,13 +2,31 @@
 Examples: python manage.py importcsv --path "/home/michael/dev/foodgram-project-react/data/ingredients.csv" --model_name "recipes.Ingredient"
           python manage.py importcsv --path "data/ingredients.csv" --model_name "recipes.Ingredient"
           python manage.py importcsv --path "data/tags.csv" --model_name "recipes.Tag"
+          python manage.py importcsv --path "data/ingredients.csv" \
+              --model_name "recipes.Ingredient" --conflicts skip \
+              --key name,measurement_unit
+          python manage.py importcsv --path "data/ingredients.csv" \
+              --model_name "recipes.Ingredient" --copy
+          python manage.py importcsv --path "data/tags.csv" \
+              --model_name "recipes.Tag" --dry-run
 """
 import csv
+import io
+import time
+from itertools import islice
 
+from django.core.exceptions import ValidationError
 from django.core.management.base import BaseCommand, CommandError
 from django.apps import apps
+from django.db import connection, transaction
 from django.db.utils import IntegrityError
 
+from recipes.models import CatalogVersion, Recipe
+
+CONFLICT_ERROR = 'error'
+CONFLICT_SKIP = 'skip'
+CONFLICT_UPDATE = 'update'
+
 
 class Command(BaseCommand):
     help = 'Import data from CSV file'
@@ -16,6 +34,21 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('--path', type=str, help="file path")
         parser.add_argument('--model_name', type=str, help="model name")
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help="rows per bulk insert")
+        parser.add_argument('--conflicts', default=CONFLICT_ERROR,
+                            choices=(CONFLICT_ERROR, CONFLICT_SKIP,
+                                     CONFLICT_UPDATE),
+                            help="what to do with rows that already exist")
+        parser.add_argument('--key', type=str,
+                            help="comma separated fields identifying "
+                                 "existing rows for skip/update")
+        parser.add_argument('--copy', action='store_true',
+                            help="load with PostgreSQL COPY")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="validate rows without writing")
+        parser.add_argument('--skip-invalid', action='store_true',
+                            help="import valid rows and report invalid ones")
 
     def handle(self, *args, **options):
         file_path = options['path']
@@ -25,21 +58,180 @@ class Command(BaseCommand):
         except Exception as err:
             raise CommandError(str(err))
 
+        self.model = model
+        self.batch_size = options['batch_size']
+        self.conflicts = options['conflicts']
+        self.key = options['key'].split(',') if options['key'] else None
+        self.use_copy = options['copy']
+        self.dry_run = options['dry_run']
+
+        # Без ключа пропускать было бы нечего: у Ingredient нет
+        # уникальных полей, и повторы вставлялись бы как новые строки
+        if self.conflicts != CONFLICT_ERROR and not self.key:
+            raise CommandError(f'--conflicts {self.conflicts} requires --key')
+        if self.use_copy and connection.vendor != 'postgresql':
+            raise CommandError('--copy is supported on PostgreSQL only')
+        if self.use_copy and self.conflicts != CONFLICT_ERROR:
+            raise CommandError('--copy cannot be combined with --conflicts')
+
         try:
-            file = open(file_path, 'r')
+            file = open(file_path, 'r', newline='')
         except IOError as err:
             raise CommandError(str(err))
 
-        reader = csv.reader(file, delimiter=',')
-        header = reader.__next__()
-        for row in reader:
-            data = {key: value for key, value in zip(header, row)}
+        self.errors = []
+        self.stats = {'created': 0, 'updated': 0, 'skipped': 0}
+        started = time.monotonic()
+        processed = 0
+
+        with file:
+            reader = csv.reader(file, delimiter=',')
+            header = reader.__next__()
             try:
-                model.objects.create(**data)
-            except IntegrityError as err:
-                line = ', '.join(row)
-                raise CommandError(f'{err}, \"{line}\"')
+                self.fields = [model._meta.get_field(name) for name in header]
             except Exception as err:
                 raise CommandError(str(err))
 
-        file.close()
+            try:
+                with transaction.atomic():
+                    # Первая строка файла - заголовок, данные со второй
+                    line_number = 2
+                    while True:
+                        chunk = list(islice(reader, self.batch_size))
+                        if not chunk:
+                            break
+                        objects = self.validate(chunk, line_number)
+                        line_number += len(chunk)
+                        processed += len(chunk)
+                        if not self.dry_run:
+                            self.write(objects)
+                        self.progress(processed, started)
+
+                    if self.errors and not options['skip_invalid']:
+                        raise CommandError(self.format_errors())
+                    if self.dry_run:
+                        transaction.set_rollback(True)
+                    elif hasattr(model, 'catalog_name'):
+                        # bulk_create не отправляет сигналы, версию
+                        # справочника обновляем явно
+                        CatalogVersion.bump(model.catalog_name)
+                        CatalogVersion.bump(Recipe.catalog_name)
+            except IntegrityError as err:
+                raise CommandError(str(err))
+
+        if self.errors:
+            self.stderr.write(self.format_errors())
+        elapsed = time.monotonic() - started
+        self.stdout.write(
+            f'{"Validated" if self.dry_run else "Imported"} {processed} rows '
+            f'in {elapsed:.2f}s ({self.rate(processed, elapsed)} rows/s): '
+            f'{self.stats["created"]} created, {self.stats["updated"]} '
+            f'updated, {self.stats["skipped"]} skipped, '
+            f'{len(self.errors)} invalid'
+        )
+
+    def validate(self, chunk, line_number):
+        objects = []
+        for offset, row in enumerate(chunk):
+            data = {field.name: value
+                    for field, value in zip(self.fields, row)}
+            obj = self.model(**data)
+            try:
+                if len(row) != len(self.fields):
+                    raise ValidationError('Wrong number of columns')
+                obj.clean_fields()
+                obj.clean()
+            except ValidationError as err:
+                line = ', '.join(row)
+                self.errors.append(f'line {line_number + offset}: '
+                                   f'{"; ".join(err.messages)}, "{line}"')
+                continue
+            objects.append(obj)
+        return objects
+
+    def write(self, objects):
+        if self.key:
+            objects = self.merge_existing(objects)
+        if not objects:
+            return
+        if self.use_copy:
+            self.copy(objects)
+        elif self.conflicts == CONFLICT_SKIP:
+            # Строки, конфликтующие по другим уникальным полям, тоже
+            # пропускаются; созданные считаются по числу строк таблицы
+            before = self.model.objects.count()
+            self.model.objects.bulk_create(objects, ignore_conflicts=True)
+            created = self.model.objects.count() - before
+            self.stats['skipped'] += len(objects) - created
+            self.stats['created'] += created
+            return
+        else:
+            self.model.objects.bulk_create(objects)
+        self.stats['created'] += len(objects)
+
+    def merge_existing(self, objects):
+        """Skip or update rows whose key already exists in the table."""
+        existing = {}
+        lookup = {f'{self.key[0]}__in': {getattr(obj, self.key[0])
+                                         for obj in objects}}
+        for obj in self.model.objects.filter(**lookup):
+            existing[tuple(getattr(obj, name) for name in self.key)] = obj
+
+        new_objects, changed = [], []
+        for obj in objects:
+            key = tuple(getattr(obj, name) for name in self.key)
+            if key not in existing:
+                existing[key] = obj
+                new_objects.append(obj)
+            elif self.conflicts == CONFLICT_UPDATE:
+                current = existing[key]
+                for field in self.fields:
+                    setattr(current, field.attname,
+                            getattr(obj, field.attname))
+                current.clean()
+                if current.pk is not None:
+                    changed.append(current)
+            elif self.conflicts == CONFLICT_SKIP:
+                self.stats['skipped'] += 1
+            else:
+                new_objects.append(obj)
+
+        if changed:
+            fields = [field.name for field in self.model._meta.concrete_fields
+                      if not field.primary_key and field.name not in self.key]
+            if fields:
+                self.model.objects.bulk_update(changed, fields,
+                                               batch_size=self.batch_size)
+            self.stats['updated'] += len(changed)
+        return new_objects
+
+    def copy(self, objects):
+        # Как и bulk_create, пишем все столбцы, а не только заголовок файла:
+        # вычисляемые поля (Ingredient.name_lower) заданы в clean()
+        fields = [field for field in self.model._meta.concrete_fields
+                  if not field.primary_key or field in self.fields]
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for obj in objects:
+            writer.writerow([
+                field.get_db_prep_save(field.pre_save(obj, True), connection)
+                for field in fields
+            ])
+        buffer.seek(0)
+        columns = ', '.join(connection.ops.quote_name(field.column)
+                            for field in fields)
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.copy_expert(f'COPY {table} ({columns}) FROM STDIN '
+                               f'WITH (FORMAT csv)', buffer)
+
+    def progress(self, processed, started):
+        elapsed = time.monotonic() - started
+        self.stdout.write(f'{processed} rows '
+                          f'({self.rate(processed, elapsed)} rows/s)')
+
+    def rate(self, processed, elapsed):
+        return int(processed / elapsed) if elapsed else processed
+
+    def format_errors(self):
+        return '\n'.join([f'{len(self.errors)} invalid rows:'] + self.errors)
@@ -0,0 +1,41 @@
+"""
+Examples: python manage.py reconcilecounters
+          python manage.py reconcilecounters --batch-size 5000
+"""
+from django.core.management.base import BaseCommand
+
+from recipes.counters import COUNTERS, actual_counts
+
+
+class Command(BaseCommand):
+    help = 'Repair drift of denormalized counters'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="rows checked per query")
+
+    def handle(self, *args, **options):
+        for model in COUNTERS:
+            repaired = self.reconcile(model, options['batch_size'])
+            self.stdout.write(f'{model._meta.label}: {repaired} rows '
+                              f'repaired')
+
+    def reconcile(self, model, batch_size):
+        fields = list(COUNTERS[model])
+        annotations = actual_counts(model)
+        repaired, last_pk = 0, 0
+        while True:
+            rows = list(
+                model.objects.filter(pk__gt=last_pk).order_by('pk').annotate(
+                    **annotations
+                ).values('pk', *fields, *annotations)[:batch_size]
+            )
+            if not rows:
+                return repaired
+            last_pk = rows[-1]['pk']
+            for row in rows:
+                drift = {field: row[f'actual_{field}'] for field in fields
+                         if row[field] != row[f'actual_{field}']}
+                if drift:
+                    model.objects.filter(pk=row['pk']).update(**drift)
+                    repaired += 1
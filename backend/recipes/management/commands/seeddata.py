@@ -0,0 +1,95 @@
+"""
+Examples: python manage.py seeddata --users 10000 --recipes 100000
+          python manage.py seeddata --users 1000000 --recipes 5000000 \
+              --workers 8 --copy
+          python manage.py seeddata --users 1000 --recipes 10000 \
+              --images 20 --seed 42
+
+Adds a synthetic dataset (see recipes.synthetic) on top of the existing
+data and reports rows/s per phase.
+"""
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from recipes import synthetic
+
+
+class Command(BaseCommand):
+    help = 'Generate a large synthetic dataset for capacity testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--recipes', type=int, default=100000)
+        parser.add_argument('--ingredients', type=int, default=2000,
+                            help="new ingredients, existing ones are used "
+                                 "as well")
+        parser.add_argument('--tags', type=int, default=10,
+                            help="new tags, existing ones are used as well")
+        parser.add_argument('--min-lines', type=int, default=5,
+                            help="ingredient lines per recipe")
+        parser.add_argument('--max-lines', type=int, default=30)
+        parser.add_argument('--favorites', type=float, default=20,
+                            help="average favorites per user")
+        parser.add_argument('--carts', type=float, default=5,
+                            help="average cart rows per user")
+        parser.add_argument('--subscriptions', type=float, default=10,
+                            help="average subscriptions per user")
+        parser.add_argument('--images', type=int, default=0,
+                            help="placeholder images to create in "
+                                 "MEDIA_ROOT, shared by the recipes")
+        parser.add_argument('--chunk-size', type=int, default=5000,
+                            help="users or recipes per worker task")
+        parser.add_argument('--workers', type=int,
+                            default=os.cpu_count() or 1)
+        parser.add_argument('--copy', action='store_true',
+                            help="load with PostgreSQL COPY")
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if options['min_lines'] > options['max_lines']:
+            raise CommandError('--min-lines is greater than --max-lines')
+        if options['copy'] and connection.vendor != 'postgresql':
+            raise CommandError('--copy is supported on PostgreSQL only')
+        workers = options['workers']
+        if connection.vendor == 'sqlite' and workers > 1:
+            # SQLite не допускает параллельной записи
+            self.stdout.write('SQLite: using a single worker')
+            workers = 1
+
+        self.verbosity = options['verbosity']
+        started = time.monotonic()
+        try:
+            rows = synthetic.build(
+                users=options['users'], recipes=options['recipes'],
+                ingredients=options['ingredients'], tags=options['tags'],
+                lines=(options['min_lines'], options['max_lines']),
+                favorites=options['favorites'], carts=options['carts'],
+                subscriptions=options['subscriptions'],
+                images=options['images'], seed=options['seed'],
+                workers=workers, copy=options['copy'],
+                chunk_size=options['chunk_size'], progress=self.progress
+            )
+        except ValueError as error:
+            raise CommandError(error)
+        total = sum(rows.values())
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'{total} rows in {elapsed:.1f}s '
+            f'({self.rate(total, elapsed)} rows/s)'
+        ))
+
+    def progress(self, phase, rows, elapsed, done):
+        if rows is None:
+            self.stdout.write(f'{phase}: {elapsed:.1f}s')
+        elif done:
+            self.stdout.write(f'{phase}: {rows} rows in {elapsed:.1f}s '
+                              f'({self.rate(rows, elapsed)} rows/s)')
+        elif self.verbosity > 1:
+            self.stdout.write(f'  {phase}: {rows} rows '
+                              f'({self.rate(rows, elapsed)} rows/s)')
+
+    def rate(self, rows, elapsed):
+        return int(rows / elapsed) if elapsed else rows
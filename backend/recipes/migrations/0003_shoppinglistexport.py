@@ -0,0 +1,33 @@
+# Generated by Django 2.2.26 on 2026-10-18 05:40
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('recipes', '0002_auto_20220201_0752'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShoppingListExport',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('done', 'Done'), ('failed', 'Failed')], db_index=True, default='pending', max_length=16, verbose_name='status')),
+                ('file', models.FileField(blank=True, upload_to='shopping_lists/', verbose_name='file')),
+                ('error', models.TextField(blank=True, verbose_name='error')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='created')),
+                ('finished', models.DateTimeField(blank=True, null=True, verbose_name='finished')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shopping_list_exports', to=settings.AUTH_USER_MODEL, verbose_name='user')),
+            ],
+            options={
+                'verbose_name': 'Shopping list export',
+                'verbose_name_plural': 'Shopping list exports',
+                'ordering': ['pk'],
+            },
+        ),
+    ]
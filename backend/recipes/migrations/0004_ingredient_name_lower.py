@@ -0,0 +1,60 @@
+# Generated by Django 2.2.26 on 2026-10-18 06:02
+
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+
+def fill_name_lower(apps, schema_editor):
+    Ingredient = apps.get_model('recipes', 'Ingredient')
+    ingredients = Ingredient.objects.only('id', 'name').order_by('pk')
+    batch = []
+    for ingredient in ingredients.iterator(chunk_size=BATCH_SIZE):
+        ingredient.name_lower = ingredient.name.lower()
+        batch.append(ingredient)
+        if len(batch) == BATCH_SIZE:
+            Ingredient.objects.bulk_update(batch, ['name_lower'])
+            batch = []
+    Ingredient.objects.bulk_update(batch, ['name_lower'])
+
+
+def create_trigram_index(apps, schema_editor):
+    # Триграммный индекс ускоряет поиск по вхождению (LIKE '%part%'),
+    # доступен только на PostgreSQL
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS ingredient_name_lower_trgm_idx '
+        'ON recipes_ingredient USING gin (name_lower gin_trgm_ops)'
+    )
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'DROP INDEX IF EXISTS ingredient_name_lower_trgm_idx'
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0003_shoppinglistexport'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingredient',
+            name='name_lower',
+            field=models.CharField(default='', editable=False, max_length=200, verbose_name='lowercase name'),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_name_lower, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='ingredient',
+            index=models.Index(fields=['name_lower'], name='ingredient_name_lower_idx', opclasses=['varchar_pattern_ops']),
+        ),
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.2.26 on 2026-10-18 05:45
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0004_ingredient_name_lower'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True, verbose_name='name')),
+                ('version', models.PositiveIntegerField(default=1, verbose_name='version')),
+                ('modified', models.DateTimeField(default=django.utils.timezone.now, verbose_name='modified')),
+            ],
+            options={
+                'verbose_name': 'Catalog version',
+                'verbose_name_plural': 'Catalog versions',
+            },
+        ),
+    ]
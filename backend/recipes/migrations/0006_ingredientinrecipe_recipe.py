@@ -0,0 +1,93 @@
+# Generated by Django 2.2.26 on 2026-10-18 06:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+BATCH_SIZE = 1000
+
+
+def move_to_recipe_fk(apps, schema_editor):
+    """
+    Copy links from the recipe_ingredients join table into the new recipe
+    column. A line shared by several recipes is duplicated, repeated
+    ingredients of one recipe are merged and unlinked lines are removed.
+    """
+    Recipe = apps.get_model('recipes', 'Recipe')
+    IngredientInRecipe = apps.get_model('recipes', 'IngredientInRecipe')
+    Link = Recipe.ingredients.through
+
+    links = Link.objects.select_related('ingredientinrecipe').order_by(
+        'recipe_id', 'ingredientinrecipe_id'
+    )
+    assigned = set()
+    to_update, to_create, to_delete = [], [], []
+    current_recipe, lines = None, {}
+
+    def flush():
+        IngredientInRecipe.objects.bulk_update(to_update,
+                                               ['recipe', 'amount'])
+        IngredientInRecipe.objects.bulk_create(to_create)
+        IngredientInRecipe.objects.filter(id__in=to_delete).delete()
+        to_update.clear()
+        to_create.clear()
+        to_delete.clear()
+
+    for link in links.iterator(chunk_size=BATCH_SIZE):
+        if link.recipe_id != current_recipe:
+            if len(to_update) + len(to_create) >= BATCH_SIZE:
+                flush()
+            current_recipe, lines = link.recipe_id, {}
+
+        line = link.ingredientinrecipe
+        existing = lines.get(line.ingredient_id)
+        if existing is not None:
+            existing.amount += line.amount
+            if line.id not in assigned:
+                assigned.add(line.id)
+                to_delete.append(line.id)
+        elif line.id in assigned:
+            copy = IngredientInRecipe(recipe_id=link.recipe_id,
+                                      ingredient_id=line.ingredient_id,
+                                      amount=line.amount)
+            lines[line.ingredient_id] = copy
+            to_create.append(copy)
+        else:
+            assigned.add(line.id)
+            line.recipe_id = link.recipe_id
+            lines[line.ingredient_id] = line
+            to_update.append(line)
+    flush()
+
+    IngredientInRecipe.objects.filter(recipe__isnull=True).delete()
+
+
+def move_to_join_table(apps, schema_editor):
+    Recipe = apps.get_model('recipes', 'Recipe')
+    IngredientInRecipe = apps.get_model('recipes', 'IngredientInRecipe')
+    Link = Recipe.ingredients.through
+
+    batch = []
+    lines = IngredientInRecipe.objects.only('id', 'recipe_id')
+    for line in lines.iterator(chunk_size=BATCH_SIZE):
+        batch.append(Link(recipe_id=line.recipe_id,
+                          ingredientinrecipe_id=line.id))
+        if len(batch) == BATCH_SIZE:
+            Link.objects.bulk_create(batch)
+            batch = []
+    Link.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0005_catalogversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingredientinrecipe',
+            name='recipe',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='ingredient_lines', to='recipes.Recipe', verbose_name='recipe'),
+        ),
+        migrations.RunPython(move_to_recipe_fk, move_to_join_table),
+    ]
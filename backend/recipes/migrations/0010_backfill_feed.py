@@ -0,0 +1,40 @@
+# Generated by Django 2.2.26 on 2026-10-18 05:52
+
+from django.conf import settings
+from django.db import migrations
+
+BATCH_SIZE = 1000
+
+
+def backfill_feed(apps, schema_editor):
+    Subscription = apps.get_model('recipes', 'Subscription')
+    Recipe = apps.get_model('recipes', 'Recipe')
+    FeedItem = apps.get_model('recipes', 'FeedItem')
+
+    batch = []
+    for subscription in Subscription.objects.iterator(chunk_size=BATCH_SIZE):
+        recipes = Recipe.objects.filter(author_id=subscription.author_id)
+        if recipes.count() > settings.FEED_BACKFILL_MAX_RECIPES:
+            subscription.feed_materialized = False
+            subscription.save(update_fields=['feed_materialized'])
+            continue
+        for recipe_id, pub_date in recipes.values_list('id', 'pub_date'):
+            batch.append(FeedItem(user_id=subscription.user_id,
+                                  recipe_id=recipe_id,
+                                  author_id=subscription.author_id,
+                                  pub_date=pub_date))
+        if len(batch) >= BATCH_SIZE:
+            FeedItem.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    FeedItem.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0009_feed'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_feed, migrations.RunPython.noop),
+    ]
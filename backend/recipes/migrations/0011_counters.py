@@ -0,0 +1,53 @@
+# Generated by Django 2.2.26 on 2026-10-18 09:12
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_of(model, relation):
+    counts = model.objects.filter(
+        **{relation: OuterRef('pk')}
+    ).order_by().values(relation).annotate(total=Count('pk'))
+    return Coalesce(
+        Subquery(counts.values('total'), output_field=IntegerField()), 0
+    )
+
+
+def fill_counters(apps, schema_editor):
+    Recipe = apps.get_model('recipes', 'Recipe')
+    Favorite = apps.get_model('recipes', 'Favorite')
+    Cart = apps.get_model('recipes', 'Cart')
+    Subscription = apps.get_model('recipes', 'Subscription')
+    User = apps.get_model('users', 'User')
+
+    Recipe.objects.update(favorites_count=count_of(Favorite, 'recipe'),
+                          cart_count=count_of(Cart, 'recipe'))
+    User.objects.update(recipes_count=count_of(Recipe, 'author'),
+                        subscribers_count=count_of(Subscription, 'author'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_user_counters'),
+        ('recipes', '0010_backfill_feed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='cart_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='cart count'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='favorites_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='favorites count'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['-favorites_count', '-id'], name='recipe_favorites_count_idx'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 2.2.26 on 2026-10-18 10:02
+
+from django.db import migrations
+from django.db.models import Count, IntegerField, Min, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def dedupe_cart(apps, schema_editor):
+    Cart = apps.get_model('recipes', 'Cart')
+    Recipe = apps.get_model('recipes', 'Recipe')
+
+    # Уникальность корзины не проверялась (опечатка в Meta), из повторов
+    # остается самая ранняя строка
+    first_ids = Cart.objects.values('user', 'recipe').annotate(
+        first_id=Min('id')
+    ).values('first_id')
+    Cart.objects.exclude(id__in=first_ids).delete()
+
+    counts = Cart.objects.filter(
+        recipe=OuterRef('pk')
+    ).order_by().values('recipe').annotate(total=Count('pk'))
+    Recipe.objects.update(cart_count=Coalesce(
+        Subquery(counts.values('total'), output_field=IntegerField()), 0
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0011_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_cart, migrations.RunPython.noop),
+    ]
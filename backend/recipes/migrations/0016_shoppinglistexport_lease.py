@@ -0,0 +1,23 @@
+# Generated by Django 2.2.26 on 2026-10-18 06:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0015_recipe_modified'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shoppinglistexport',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0, verbose_name='attempts'),
+        ),
+        migrations.AddField(
+            model_name='shoppinglistexport',
+            name='started',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='started'),
+        ),
+    ]
@@ -1,11 +1,51 @@
+from django.contrib.postgres.search import SearchVectorField
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
-from django.db import models
+from django.db import connections, models
+from django.db.models import (BooleanField, Exists, F, OuterRef, Prefetch,
+                              Value)
 from django.contrib.auth import get_user_model
 
+from users.models import CounterFieldsMixin
+
 User = get_user_model()
 
 
+class CatalogVersion(models.Model):
+    """Version counter of a catalog (tags, ingredients, recipes)."""
+    name = models.CharField(_('name'), max_length=50, unique=True)
+    version = models.PositiveIntegerField(_('version'), default=1)
+    modified = models.DateTimeField(_('modified'), default=timezone.now)
+
+    class Meta:
+        verbose_name = _('Catalog version')
+        verbose_name_plural = _('Catalog versions')
+
+    def __str__(self):
+        return f'{self.name} - {self.version}'
+
+    @classmethod
+    def get(cls, name):
+        # Версия читается из той же базы (реплики), что и данные каталога;
+        # get_or_create всегда обращается к основной
+        catalog = cls.objects.filter(name=name).first()
+        if catalog is None:
+            catalog, _ = cls.objects.get_or_create(name=name)
+        return catalog
+
+    @classmethod
+    def bump(cls, name):
+        updated = cls.objects.filter(name=name).update(
+            version=F('version') + 1,
+            modified=timezone.now()
+        )
+        if not updated:
+            cls.objects.get_or_create(name=name)
+
+
 class Tag(models.Model):
+    catalog_name = 'tags'
+
     name = models.CharField(_('name'), max_length=200, unique=True)
     color = models.CharField(_('color'), max_length=7, null=True, unique=True)
     slug = models.SlugField(_('slug'), unique=True)
@@ -20,19 +60,40 @@ class Tag(models.Model):
 
 
 class Ingredient(models.Model):
+    catalog_name = 'ingredients'
+
     name = models.CharField(_('name'), max_length=200)
     measurement_unit = models.CharField(_('measurement unit'), max_length=200)
+    name_lower = models.CharField(_('lowercase name'), max_length=200,
+                                  editable=False)
 
     class Meta:
         ordering = ['pk']
         verbose_name = _('Ingredient')
         verbose_name_plural = _('Ingredients')
+        indexes = [
+            # varchar_pattern_ops позволяет PostgreSQL использовать индекс
+            # для LIKE 'prefix%' при любой collation
+            models.Index(fields=['name_lower'],
+                         name='ingredient_name_lower_idx',
+                         opclasses=['varchar_pattern_ops']),
+        ]
 
     def __str__(self):
         return self.name
 
+    def clean(self):
+        self.name_lower = self.name.lower()
+
+    def save(self, *args, **kwargs):
+        self.clean()
+        super().save(*args, **kwargs)
+
 
 class IngredientInRecipe(models.Model):
+    recipe = models.ForeignKey('Recipe', on_delete=models.CASCADE,
+                               related_name='ingredients',
+                               verbose_name=_('recipe'))
     ingredient = models.ForeignKey(Ingredient, on_delete=models.CASCADE,
                                    verbose_name=_('ingredient'))
     amount = models.IntegerField(_('amount'), default=1)
@@ -41,31 +102,130 @@ class IngredientInRecipe(models.Model):
         ordering = ['pk']
         verbose_name = _('Ingredient in recipe')
         verbose_name_plural = _('Ingredients in recipe')
+        constraints = [
+            models.UniqueConstraint(
+                fields=['recipe', 'ingredient'],
+                name='unique_recipe_ingredient'
+            )
+        ]
 
     def __str__(self):
         return (f'{self.ingredient.name} - {self.amount} '
                 f'{self.ingredient.measurement_unit}')
 
 
-class Recipe(models.Model):
+class RecipeQuerySet(models.QuerySet):
+    INFO_FIELDS = ('id', 'author', 'name', 'image', 'cooking_time',
+                   'pub_date')
+
+    def latest_by_author(self, author_ids, limit):
+        """
+        The limit newest recipes of each author, newest first, with only
+        the fields of a recipe preview loaded.
+        """
+        if not author_ids or not limit:
+            return []
+        # ROW_NUMBER() по автору читает рецепты каждого автора одним
+        # проходом по индексу (author, -pub_date), без подзапроса на строку
+        quote = connections[self.db].ops.quote_name
+        columns = ', '.join(quote(self.model._meta.get_field(name).column)
+                            for name in self.INFO_FIELDS)
+        author, pub_date = (quote(self.model._meta.get_field(name).column)
+                            for name in ('author', 'pub_date'))
+        return self.raw(
+            f'SELECT {columns} FROM (SELECT {columns}, ROW_NUMBER() OVER '
+            f'(PARTITION BY {author} ORDER BY {pub_date} DESC, '
+            f'{quote("id")} DESC) AS {quote("position")} '
+            f'FROM {quote(self.model._meta.db_table)} '
+            f'WHERE {author} IN ({", ".join(["%s"] * len(author_ids))})) '
+            f'{quote("ranked")} WHERE {quote("position")} <= %s '
+            f'ORDER BY {author}, {quote("position")}',
+            [*author_ids, limit]
+        )
+
+    def with_user_flags(self, user):
+        """Annotate is_favorited and is_in_shopping_cart for the viewer."""
+        if not user.is_authenticated:
+            return self.annotate(
+                is_favorited=Value(False, output_field=BooleanField()),
+                is_in_shopping_cart=Value(False, output_field=BooleanField())
+            )
+        return self.annotate(
+            is_favorited=Exists(
+                Favorite.objects.filter(user=user, recipe=OuterRef('pk'))
+            ),
+            is_in_shopping_cart=Exists(
+                Cart.objects.filter(user=user, recipe=OuterRef('pk'))
+            )
+        )
+
+    def for_read(self, user):
+        """
+        Queryset for the recipe read path: viewer flags are annotated,
+        the search vector is not loaded and author, tags and ingredient
+        lines are fetched in a fixed number of queries regardless of the
+        page size.
+        """
+        if user.is_authenticated:
+            is_subscribed = Exists(
+                Subscription.objects.filter(user=user, author=OuterRef('pk'))
+            )
+        else:
+            is_subscribed = Value(False, output_field=BooleanField())
+        authors = User.objects.annotate(is_subscribed=is_subscribed)
+        ingredients = IngredientInRecipe.objects.select_related('ingredient')
+        return self.with_user_flags(user).defer(
+            'search_vector'
+        ).prefetch_related(
+            Prefetch('author', queryset=authors),
+            'tags',
+            Prefetch('ingredients', queryset=ingredients)
+        )
+
+
+class Recipe(CounterFieldsMixin, models.Model):
+    catalog_name = 'recipes'
+    counter_fields = ('favorites_count', 'cart_count')
+
     author = models.ForeignKey(User, on_delete=models.CASCADE,
                                related_name='recipes',
                                verbose_name=_('author'))
     pub_date = models.DateTimeField(_('date published'), auto_now_add=True)
+    # По нему индекс ингредиентов дочитывает измененные рецепты
+    modified = models.DateTimeField(_('modified'), auto_now=True,
+                                    db_index=True)
     name = models.CharField(_('name'), max_length=200)
     image = models.ImageField(_('image'), upload_to='images/')
+    # sha256 содержимого картинки: по нему PATCH узнает повторно
+    # присланную картинку, не читая файл из хранилища
+    image_hash = models.CharField(_('image hash'), max_length=64,
+                                  blank=True, editable=False)
     text = models.TextField(_('description'))
-    ingredients = models.ManyToManyField(IngredientInRecipe,
-                                         related_name='recipes',
-                                         verbose_name=_('ingredients'))
     tags = models.ManyToManyField(Tag, related_name='recipes',
                                   verbose_name=_('tags'))
     cooking_time = models.PositiveSmallIntegerField(_('cooking time'))
+    favorites_count = models.PositiveIntegerField(_('favorites count'),
+                                                  default=0, editable=False)
+    cart_count = models.PositiveIntegerField(_('cart count'), default=0,
+                                             editable=False)
+    # Заполняется только на PostgreSQL, см. recipes.search
+    search_vector = SearchVectorField(_('search vector'), null=True,
+                                      editable=False)
+
+    objects = RecipeQuerySet.as_manager()
 
     class Meta:
         ordering = ['-pub_date']
         verbose_name = _('Recipe')
         verbose_name_plural = _('Recipes')
+        indexes = [
+            models.Index(fields=['-pub_date', '-id'],
+                         name='recipe_pub_date_id_idx'),
+            models.Index(fields=['-favorites_count', '-id'],
+                         name='recipe_favorites_count_idx'),
+            models.Index(fields=['author', '-pub_date'],
+                         name='recipe_author_pub_date_idx'),
+        ]
 
     def __str__(self):
         return self.name
@@ -101,13 +261,13 @@ class Cart(models.Model):
                                related_name='buyers',
                                verbose_name=_('recipe'))
 
-    class Mete:
+    class Meta:
         verbose_name = _('Cart')
         verbose_name_plural = _('Carts')
         constraints = [
             models.UniqueConstraint(
                 fields=['user', 'recipe'],
-                name='unique_user_recipe'
+                name='unique_cart_user_recipe'
             )
         ]
 
@@ -122,6 +282,10 @@ class Subscription(models.Model):
     author = models.ForeignKey(User, on_delete=models.CASCADE,
                                related_name='subscribers',
                                verbose_name=_('author'))
+    # False - рецепты автора не копируются в FeedItem, а подмешиваются в
+    # ленту при чтении (автор с очень большим числом рецептов)
+    feed_materialized = models.BooleanField(_('feed materialized'),
+                                            default=True)
 
     class Meta:
         verbose_name = _('Subscription')
@@ -135,3 +299,71 @@ class Subscription(models.Model):
 
     def __str__(self):
         return f'{self.user.username} - {self.author.username}'
+
+
+class FeedItem(models.Model):
+    """A recipe of a followed author in the user's materialized feed."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE,
+                             related_name='feed_items',
+                             verbose_name=_('user'))
+    recipe = models.ForeignKey(Recipe, on_delete=models.CASCADE,
+                               related_name='feed_items',
+                               verbose_name=_('recipe'))
+    author = models.ForeignKey(User, on_delete=models.CASCADE,
+                               related_name='+',
+                               verbose_name=_('author'))
+    pub_date = models.DateTimeField(_('date published'))
+
+    class Meta:
+        verbose_name = _('Feed item')
+        verbose_name_plural = _('Feed items')
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'recipe'],
+                name='unique_feed_user_recipe'
+            )
+        ]
+        indexes = [
+            models.Index(fields=['user', '-pub_date', '-recipe'],
+                         name='feed_user_pub_date_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.user_id} - {self.recipe_id}'
+
+
+class ShoppingListExport(models.Model):
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, _('Pending')),
+        (PROCESSING, _('Processing')),
+        (DONE, _('Done')),
+        (FAILED, _('Failed')),
+    )
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE,
+                             related_name='shopping_list_exports',
+                             verbose_name=_('user'))
+    status = models.CharField(_('status'), max_length=16,
+                              choices=STATUS_CHOICES, default=PENDING,
+                              db_index=True)
+    file = models.FileField(_('file'), upload_to='shopping_lists/',
+                            blank=True)
+    error = models.TextField(_('error'), blank=True)
+    created = models.DateTimeField(_('created'), auto_now_add=True)
+    # Начало последней попытки: по нему воркеры возвращают в очередь
+    # задачи упавших воркеров
+    started = models.DateTimeField(_('started'), null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(_('attempts'), default=0)
+    finished = models.DateTimeField(_('finished'), null=True, blank=True)
+
+    class Meta:
+        ordering = ['pk']
+        verbose_name = _('Shopping list export')
+        verbose_name_plural = _('Shopping list exports')
+
+    def __str__(self):
+        return f'{self.user.username} - {self.status}'
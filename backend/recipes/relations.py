@@ -0,0 +1,82 @@
+"""
+Set-based changes of a user's favorites, cart and subscriptions.
+
+Rows are added with one INSERT ... ON CONFLICT DO NOTHING RETURNING, so
+the ids reported as added are exactly the rows this request inserted, even
+under concurrent requests. The INSERT sends no model signals, denormalized
+counters and the feed are updated here. Rows are removed with
+QuerySet.delete(), whose post_delete signals do the same.
+"""
+from django.db import connections, router, transaction
+
+from . import counters, feed
+from .models import Cart, Favorite, Subscription
+
+# Модель связи -> поле, на которое ссылается пользователь
+RELATIONS = {
+    Favorite: 'recipe',
+    Cart: 'recipe',
+    Subscription: 'author',
+}
+
+
+def can_return_rows(connection):
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 35)
+    return connection.vendor == 'postgresql'
+
+
+def insert(model, objects, field):
+    """
+    Insert objects skipping rows that conflict with a unique constraint and
+    return the values of field of the inserted ones.
+    """
+    connection = connections[router.db_for_write(model)]
+    quote = connection.ops.quote_name
+    fields = [f for f in model._meta.concrete_fields if not f.primary_key]
+    sql = (f'INSERT INTO {quote(model._meta.db_table)} '
+           f'({", ".join(quote(f.column) for f in fields)}) VALUES {{}} '
+           f'ON CONFLICT DO NOTHING')
+    placeholders = f'({", ".join(["%s"] * len(fields))})'
+    rows = [[f.get_db_prep_save(f.pre_save(obj, True), connection)
+             for f in fields] for obj in objects]
+    with connection.cursor() as cursor:
+        if can_return_rows(connection):
+            cursor.execute(
+                sql.format(', '.join([placeholders] * len(rows)))
+                + f' RETURNING {quote(field.column)}',
+                [value for row in rows for value in row]
+            )
+            return [value for value, in cursor.fetchall()]
+        # Без RETURNING строки вставляются по одной,
+        # rowcount показывает, вставлена ли строка
+        inserted = []
+        for obj, row in zip(objects, rows):
+            cursor.execute(sql.format(placeholders), row)
+            if cursor.rowcount:
+                inserted.append(field.value_from_object(obj))
+        return inserted
+
+
+def add(model, user, ids):
+    """Link the user to the ids and return the ids that were not linked."""
+    field = model._meta.get_field(RELATIONS[model])
+    with transaction.atomic(using=router.db_for_write(model)):
+        added = insert(model, [model(user=user, **{field.attname: pk})
+                               for pk in sorted(set(ids))], field)
+        if not added:
+            return []
+        counters.recount(model, added)
+        if model is Subscription:
+            for subscription in Subscription.objects.filter(
+                    user=user, author_id__in=added):
+                feed.backfill(subscription)
+    return sorted(added)
+
+
+def remove(model, user, ids):
+    """Unlink the user from the ids and return the number of removed rows."""
+    field = f'{RELATIONS[model]}_id'
+    removed, _ = model.objects.filter(user=user,
+                                      **{f'{field}__in': ids}).delete()
+    return removed
@@ -0,0 +1,207 @@
+"""
+Full-text search over recipe names and descriptions.
+
+On PostgreSQL Recipe.search_vector holds the weighted tsvector of the name
+(A) and the text (B) in the SEARCH_CONFIG configuration. It is refreshed
+on save and indexed with GIN; results are ranked with ts_rank and
+highlighted with ts_headline. Other databases (SQLite in development) use
+InvertedIndex, an in-memory index of the worker that is rebuilt when the
+recipes catalog version changes. It matches whole words, without stemming.
+"""
+import heapq
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.contrib.postgres.search import (SearchQuery, SearchRank,
+                                            SearchVector)
+from django.db import connections
+from django.db.models import (Case, CharField, F, FloatField, Func,
+                              TextField, Value, When)
+from django.db.models.functions import Replace
+from django.utils.html import escape
+
+from .models import CatalogVersion, Recipe
+
+WORD = re.compile(r'\w+')
+NAME_WEIGHT = 1.0
+TEXT_WEIGHT = 0.4
+TEXT_HEADLINE_WORDS = 20
+# Совпадения отмечаются управляющими символами, в <b> они превращаются
+# после экранирования текста
+START, STOP = '\x02', '\x03'
+NAME_HEADLINE = f'StartSel={START}, StopSel={STOP}, HighlightAll=true'
+TEXT_HEADLINE = (f'StartSel={START}, StopSel={STOP}, MaxFragments=2, '
+                 f'MaxWords={TEXT_HEADLINE_WORDS}, MinWords=5')
+
+# Обратные индексы по алиасу базы
+_indexes = {}
+_lock = threading.Lock()
+
+
+def uses_postgres(queryset):
+    return connections[queryset.db].vendor == 'postgresql'
+
+
+def document():
+    """Search vector of a recipe: the name weighs more than the text."""
+    return (SearchVector('name', weight='A', config=settings.SEARCH_CONFIG)
+            + SearchVector('text', weight='B',
+                           config=settings.SEARCH_CONFIG))
+
+
+def refresh(queryset):
+    """Recompute search_vector of the recipes in queryset."""
+    if uses_postgres(queryset):
+        queryset.update(search_vector=document())
+
+
+class Headline(Func):
+    function = 'ts_headline'
+    output_field = TextField()
+
+    def __init__(self, expression, query, options):
+        # Метки из самого текста удаляются, чтобы не стать тегами
+        for mark in (START, STOP):
+            expression = Replace(expression, Value(mark), Value(''))
+        super().__init__(Value(settings.SEARCH_CONFIG), expression, query,
+                         Value(options))
+
+
+def tokenize(text):
+    return WORD.findall(text.lower())
+
+
+class InvertedIndex:
+    """Term -> {recipe id: weight} postings of all recipes."""
+
+    def __init__(self, version):
+        self.version = version
+        self.postings = defaultdict(dict)
+        self.documents = 0
+
+    def add(self, pk, name, text):
+        weights = Counter()
+        for field, weight in ((name, NAME_WEIGHT), (text, TEXT_WEIGHT)):
+            # Повторы слова в поле увеличивают вес логарифмически
+            for term, count in Counter(tokenize(field)).items():
+                weights[term] += weight * (1 + math.log(count))
+        for term, weight in weights.items():
+            self.postings[term][pk] = weight
+        self.documents += 1
+
+    def search(self, value, limit, within=None):
+        """
+        Up to limit (id, rank) of recipes containing every term, only
+        among the ids in within if given.
+        """
+        terms = set(tokenize(value))
+        if not terms:
+            return []
+        postings = sorted((self.postings.get(term, {}) for term in terms),
+                          key=len)
+        if not postings[0]:
+            return []
+        found = set(postings[0]).intersection(*postings[1:])
+        if within is not None:
+            found &= within
+        # Редкие слова весят больше (idf)
+        weights = [math.log(1 + self.documents / len(posting))
+                   for posting in postings]
+        ranks = ((pk, sum(weight * posting[pk] for weight, posting
+                          in zip(weights, postings)))
+                 for pk in found)
+        return heapq.nlargest(limit, ranks, key=lambda item: item[::-1])
+
+
+def get_index(using):
+    version = CatalogVersion.objects.using(using).filter(
+        name=Recipe.catalog_name
+    ).values_list('version', flat=True).first()
+    index = _indexes.get(using)
+    if index is None or index.version != version:
+        with _lock:
+            index = _indexes.get(using)
+            if index is None or index.version != version:
+                index = InvertedIndex(version)
+                recipes = Recipe.objects.using(using).values_list(
+                    'id', 'name', 'text'
+                )
+                for pk, name, text in recipes.iterator():
+                    index.add(pk, name, text)
+                _indexes[using] = index
+    return index
+
+
+def search(queryset, value):
+    """
+    Recipes of queryset matching value, most relevant first, annotated
+    with search_rank and what result() needs to highlight them.
+    """
+    if uses_postgres(queryset):
+        query = SearchQuery(value, config=settings.SEARCH_CONFIG)
+        return queryset.filter(search_vector=query).annotate(
+            search_rank=SearchRank(F('search_vector'), query),
+            name_highlight=Headline('name', query, NAME_HEADLINE),
+            text_highlight=Headline('text', query, TEXT_HEADLINE)
+        ).order_by('-search_rank', '-id')
+
+    # Лимит применяется к рецептам, прошедшим остальные фильтры: иначе
+    # лучшие совпадения всего каталога вытеснили бы подходящие
+    within = None
+    if queryset.query.where:
+        within = set(queryset.order_by().values_list('pk', flat=True))
+    ranks = get_index(queryset.db).search(value,
+                                          settings.SEARCH_FALLBACK_LIMIT,
+                                          within)
+    if not ranks:
+        return queryset.none()
+    return queryset.filter(pk__in=[pk for pk, _ in ranks]).annotate(
+        search_rank=Case(*[When(pk=pk, then=Value(rank))
+                           for pk, rank in ranks],
+                         output_field=FloatField()),
+        search_query=Value(value, output_field=CharField())
+    ).order_by('-search_rank', '-id')
+
+
+def markup(headline):
+    """HTML of a headline with matches between START and STOP."""
+    return escape(headline).replace(START, '<b>').replace(STOP, '</b>')
+
+
+def highlight(text, terms, max_words=None):
+    """
+    Text with words from terms between START and STOP, cut to max_words
+    words around the first of them.
+    """
+    words = list(WORD.finditer(text))
+    start, stop = 0, len(text)
+    if max_words is not None and len(words) > max_words:
+        first = next((index for index, word in enumerate(words)
+                      if word.group().lower() in terms), 0)
+        begin = max(0, min(first - max_words // 2, len(words) - max_words))
+        start = words[begin].start()
+        stop = words[begin + max_words - 1].end()
+    # Метки из самого текста удаляются, чтобы не стать тегами
+    return WORD.sub(
+        lambda word: (f'{START}{word.group()}{STOP}'
+                      if word.group().lower() in terms else word.group()),
+        text[start:stop].replace(START, '').replace(STOP, '')
+    )
+
+
+def result(recipe):
+    """
+    Rank and highlighted name and text of a recipe found by search(), as
+    escaped HTML with matches in <b>.
+    """
+    if hasattr(recipe, 'name_highlight'):
+        name, text = recipe.name_highlight, recipe.text_highlight
+    else:
+        terms = set(tokenize(recipe.search_query))
+        name = highlight(recipe.name, terms)
+        text = highlight(recipe.text, terms, TEXT_HEADLINE_WORDS)
+    return {'rank': round(recipe.search_rank, 6), 'name': markup(name),
+            'text': markup(text)}
@@ -0,0 +1,59 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import counters, feed, search
+from .models import (Cart, CatalogVersion, Favorite, Ingredient, Recipe,
+                     Subscription, Tag)
+
+
+@receiver([post_save, post_delete], sender=Tag)
+@receiver([post_save, post_delete], sender=Ingredient)
+def bump_catalog_version(sender, **kwargs):
+    CatalogVersion.bump(sender.catalog_name)
+    # Названия тегов и ингредиентов входят в выдачу рецептов
+    CatalogVersion.bump(Recipe.catalog_name)
+
+
+@receiver([post_save, post_delete], sender=Recipe)
+def bump_recipes_version(sender, **kwargs):
+    CatalogVersion.bump(Recipe.catalog_name)
+
+
+@receiver(post_save, sender=Recipe)
+def fan_out_recipe(sender, instance, created, **kwargs):
+    if created:
+        feed.fan_out(instance)
+
+
+@receiver(post_save, sender=Recipe)
+def refresh_search_vector(sender, instance, update_fields, **kwargs):
+    if update_fields is None or {'name', 'text'} & set(update_fields):
+        search.refresh(Recipe.objects.filter(pk=instance.pk))
+
+
+@receiver(post_save, sender=Subscription)
+def backfill_feed(sender, instance, created, **kwargs):
+    if created:
+        feed.backfill(instance)
+
+
+@receiver(post_delete, sender=Subscription)
+def prune_feed(sender, instance, **kwargs):
+    feed.prune(instance)
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_save, sender=Favorite)
+@receiver(post_save, sender=Cart)
+@receiver(post_save, sender=Subscription)
+def count_created(sender, instance, created, **kwargs):
+    if created:
+        counters.change_for(instance, 1)
+
+
+@receiver(post_delete, sender=Recipe)
+@receiver(post_delete, sender=Favorite)
+@receiver(post_delete, sender=Cart)
+@receiver(post_delete, sender=Subscription)
+def count_deleted(sender, instance, **kwargs):
+    counters.change_for(instance, -1)
@@ -0,0 +1,342 @@
+"""
+Synthetic dataset for benchmarks and capacity tests.
+
+build() adds users, recipes with tags and ingredient lines, favorites,
+cart rows and subscriptions (with the materialized feed) on top of the
+existing data. Popularity is skewed: a few authors write most recipes and
+attract most subscribers, a few recipes collect most favorites, a few
+users have huge carts. Users, recipes and relations are written in chunks,
+optionally by a pool of worker processes; every chunk has its own random
+generator derived from the seed, so the result does not depend on the
+number of workers. Rows are written with bulk_create (or PostgreSQL COPY)
+and do not send signals; counters and search vectors are filled in at the
+end.
+"""
+import csv
+import io
+import multiprocessing
+import os
+import random
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.color import no_style
+from django.db import connection, connections, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from . import counters, search
+from .models import (Cart, CatalogVersion, Favorite, FeedItem, Ingredient,
+                     IngredientInRecipe, Recipe, Subscription, Tag)
+
+User = get_user_model()
+RecipeTag = Recipe.tags.through
+
+PASSWORD = 'Synthetic-pa55word'
+UNITS = ('г', 'кг', 'мл', 'л', 'шт.', 'ст. л.', 'ч. л.', 'по вкусу')
+IMAGE = 'images/synthetic.png'
+
+# Параметры генерации, которые пул передает каждому воркеру один раз
+PARAMS = {}
+
+
+def skewed_index(rng, count):
+    """Index in range(count) with probability roughly 1 / (index + 1)."""
+    return int(count ** rng.random()) - 1
+
+
+def heavy_tailed(rng, average, limit):
+    """Pareto distributed count with the given mean, at most limit."""
+    return min(int(average * (rng.paretovariate(2) - 1)), limit)
+
+
+@contextmanager
+def keep_pub_date():
+    """Let bulk_create write the generated Recipe.pub_date (auto_now_add)."""
+    field = Recipe._meta.get_field('pub_date')
+    field.auto_now_add = False
+    try:
+        yield
+    finally:
+        field.auto_now_add = True
+
+
+def init_worker(params):
+    PARAMS.update(params)
+
+
+def chunk_rng(phase, start):
+    return random.Random(f"{PARAMS['seed']}:{phase}:{start}")
+
+
+def write(model, objects):
+    """Write objects, return the number of rows per model label."""
+    if not objects:
+        return Counter()
+    if PARAMS['copy']:
+        copy(model, objects)
+    else:
+        model.objects.bulk_create(objects)
+    return Counter({model._meta.label: len(objects)})
+
+
+def copy(model, objects):
+    fields = [field for field in model._meta.concrete_fields
+              if getattr(objects[0], field.attname) is not None
+              or not field.primary_key]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for obj in objects:
+        writer.writerow([field.get_db_prep_value(getattr(obj, field.attname),
+                                                 connection)
+                         for field in fields])
+    buffer.seek(0)
+    columns = ', '.join(connection.ops.quote_name(field.column)
+                        for field in fields)
+    table = connection.ops.quote_name(model._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.copy_expert(f'COPY {table} ({columns}) FROM STDIN '
+                           f'WITH (FORMAT csv)', buffer)
+
+
+def seed_users(start, stop):
+    users = [
+        User(id=user_id, username=f'seed{user_id}',
+             email=f'seed{user_id}@example.com', first_name=f'Имя{user_id}',
+             last_name=f'Фамилия{user_id}', password=PARAMS['password'],
+             date_joined=PARAMS['now'])
+        for user_id in range(start, stop)
+    ]
+    with transaction.atomic():
+        return write(User, users)
+
+
+def seed_recipes(start, stop):
+    rng = chunk_rng('recipes', start)
+    first_user, users = PARAMS['first_user'], PARAMS['users']
+    tag_ids, ingredient_ids = PARAMS['tag_ids'], PARAMS['ingredient_ids']
+    min_lines, max_lines = PARAMS['lines']
+    images = PARAMS['images']
+    recipes, recipe_tags, lines = [], [], []
+    for recipe_id in range(start, stop):
+        recipes.append(Recipe(
+            id=recipe_id, author_id=first_user + skewed_index(rng, users),
+            name=f'Рецепт {recipe_id}', text='Описание рецепта',
+            image=images[recipe_id % len(images)],
+            cooking_time=rng.randint(1, 180),
+            pub_date=PARAMS['now'] - timedelta(
+                seconds=rng.randint(0, PARAMS['period'])
+            ),
+            modified=PARAMS['now']
+        ))
+        recipe_tags += [
+            RecipeTag(recipe_id=recipe_id, tag_id=tag_id)
+            for tag_id in rng.sample(tag_ids, rng.randint(1, min(
+                3, len(tag_ids)
+            )))
+        ]
+        lines += [
+            IngredientInRecipe(recipe_id=recipe_id,
+                               ingredient_id=ingredient_id,
+                               amount=rng.randint(1, 500))
+            for ingredient_id in rng.sample(ingredient_ids, min(
+                rng.randint(min_lines, max_lines), len(ingredient_ids)
+            ))
+        ]
+    with transaction.atomic(), keep_pub_date():
+        return (write(Recipe, recipes) + write(RecipeTag, recipe_tags)
+                + write(IngredientInRecipe, lines))
+
+
+def seed_relations(start, stop):
+    rng = chunk_rng('relations', start)
+    first_user, users = PARAMS['first_user'], PARAMS['users']
+    first_recipe, recipes = PARAMS['first_recipe'], PARAMS['recipes']
+    rows = {Favorite: [], Cart: [], Subscription: []}
+    for user_id in range(start, stop):
+        for model, average in ((Favorite, PARAMS['favorites']),
+                               (Cart, PARAMS['carts'])):
+            recipe_ids = {first_recipe + skewed_index(rng, recipes)
+                          for _ in range(heavy_tailed(rng, average,
+                                                      recipes))}
+            rows[model] += [model(user_id=user_id, recipe_id=recipe_id)
+                            for recipe_id in recipe_ids]
+        author_ids = {first_user + skewed_index(rng, users)
+                      for _ in range(heavy_tailed(
+                          rng, PARAMS['subscriptions'], users
+                      ))}
+        rows[Subscription] += [
+            Subscription(user_id=user_id, author_id=author_id)
+            for author_id in author_ids - {user_id}
+        ]
+
+    # Авторы с большим числом рецептов не копируются в ленту, как и при
+    # подписке через API (см. recipes.feed)
+    authors = {subscription.author_id for subscription in rows[Subscription]}
+    materialized = set(User.objects.filter(
+        id__in=authors,
+        recipes_count__lte=settings.FEED_BACKFILL_MAX_RECIPES
+    ).values_list('id', flat=True))
+    author_recipes = defaultdict(list)
+    for author_id, recipe_id, pub_date in Recipe.objects.filter(
+            author_id__in=materialized).values_list('author_id', 'id',
+                                                    'pub_date'):
+        author_recipes[author_id].append((recipe_id, pub_date))
+    feed_items = []
+    for subscription in rows[Subscription]:
+        subscription.feed_materialized = subscription.author_id in materialized
+        feed_items += [
+            FeedItem(user_id=subscription.user_id, recipe_id=recipe_id,
+                     author_id=subscription.author_id, pub_date=pub_date)
+            for recipe_id, pub_date in author_recipes[subscription.author_id]
+        ]
+
+    with transaction.atomic():
+        return (sum((write(model, objects) for model, objects
+                     in rows.items()), Counter())
+                + write(FeedItem, feed_items))
+
+
+def run_chunk(chunk):
+    task, start, stop = chunk
+    return task(start, stop)
+
+
+def make_images(count):
+    """Write count solid color PNG placeholders into MEDIA_ROOT."""
+    from PIL import Image
+
+    field = Recipe._meta.get_field('image')
+    directory = os.path.join(settings.MEDIA_ROOT, field.upload_to)
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(PARAMS['seed'])
+    names = []
+    for number in range(count):
+        name = f'{field.upload_to}seed-{number}.png'
+        color = tuple(rng.randint(0, 255) for _ in range(3))
+        Image.new('RGB', (480, 320), color).save(
+            os.path.join(settings.MEDIA_ROOT, name)
+        )
+        names.append(name)
+    return names
+
+
+def seed_catalogs(tags, ingredients):
+    """Add tags and ingredients, return the ids of all of them."""
+    rng = random.Random(PARAMS['seed'])
+    base = Tag.objects.aggregate(last=Max('id'))['last'] or 0
+    Tag.objects.bulk_create(
+        Tag(name=f'Тег {base + i}', slug=f'tag-{base + i}',
+            color=f'#{base + i:06x}')
+        for i in range(1, tags + 1)
+    )
+    base = Ingredient.objects.aggregate(last=Max('id'))['last'] or 0
+    Ingredient.objects.bulk_create(
+        Ingredient(name=f'ингредиент {base + i}',
+                   name_lower=f'ингредиент {base + i}',
+                   measurement_unit=rng.choice(UNITS))
+        for i in range(1, ingredients + 1)
+    )
+    return (list(Tag.objects.values_list('id', flat=True)),
+            list(Ingredient.objects.values_list('id', flat=True)))
+
+
+def run_phase(name, task, first, count, chunk_size, workers, progress):
+    chunks = [(task, start, min(start + chunk_size, first + count))
+              for start in range(first, first + count, chunk_size)]
+    started = time.monotonic()
+    rows = Counter()
+    if workers > 1:
+        # Воркеры открывают свои соединения, унаследованные от родителя
+        # закрываются до fork
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        with context.Pool(workers, init_worker, (PARAMS,)) as pool:
+            for written in pool.imap_unordered(run_chunk, chunks):
+                rows += written
+                progress(name, sum(rows.values()),
+                         time.monotonic() - started, False)
+    else:
+        for written in map(run_chunk, chunks):
+            rows += written
+            progress(name, sum(rows.values()), time.monotonic() - started,
+                     False)
+    progress(name, sum(rows.values()), time.monotonic() - started, True)
+    return rows
+
+
+def reset_sequences():
+    # Пользователи и рецепты записаны с явными id
+    statements = connection.ops.sequence_reset_sql(no_style(),
+                                                   [User, Recipe])
+    with connection.cursor() as cursor:
+        for sql in statements:
+            cursor.execute(sql)
+
+
+def no_progress(phase, rows, elapsed, done):
+    pass
+
+
+def build(users, recipes, ingredients, tags=10, lines=(5, 30),
+          favorites=20, carts=5, subscriptions=10, images=0, seed=0,
+          workers=1, copy=False, chunk_size=5000, progress=no_progress):
+    """
+    Add a synthetic dataset and return the number of rows written per
+    model label. favorites, carts and subscriptions are per-user averages,
+    images is the number of placeholder images shared by the recipes.
+    progress(phase, rows, elapsed, done) is called after every chunk and
+    once more when a phase is done; the final counters and search phase
+    reports rows=None.
+    """
+    first_user = (User.objects.aggregate(last=Max('id'))['last'] or 0) + 1
+    first_recipe = (Recipe.objects.aggregate(last=Max('id'))['last']
+                    or 0) + 1
+    init_worker({
+        'seed': seed,
+        'copy': copy,
+        'now': timezone.now(),
+        'period': 3 * 365 * 24 * 3600,
+        'password': make_password(PASSWORD),
+        'first_user': first_user,
+        'users': users,
+        'first_recipe': first_recipe,
+        'recipes': recipes,
+        'lines': lines,
+        'favorites': favorites,
+        'carts': carts,
+        'subscriptions': subscriptions,
+    })
+    PARAMS['images'] = make_images(images) or [IMAGE]
+    PARAMS['tag_ids'], PARAMS['ingredient_ids'] = seed_catalogs(tags,
+                                                                ingredients)
+    if not PARAMS['tag_ids'] or not PARAMS['ingredient_ids']:
+        raise ValueError('Tags and ingredients are required')
+
+    rows = Counter({Tag._meta.label: tags,
+                    Ingredient._meta.label: ingredients})
+    rows += run_phase('users', seed_users, first_user, users, chunk_size,
+                      workers, progress)
+    rows += run_phase('recipes', seed_recipes, first_recipe, recipes,
+                      chunk_size, workers, progress)
+    reset_sequences()
+    # recipes_count нужен для решения, материализовать ли ленту
+    counters.recount(Recipe, User.objects.filter(
+        id__gte=first_user
+    ).values('id'))
+    rows += run_phase('relations', seed_relations, first_user, users,
+                      chunk_size, workers, progress)
+
+    started = time.monotonic()
+    counters.recount_all()
+    search.refresh(Recipe.objects.filter(id__gte=first_recipe))
+    for name in (Tag.catalog_name, Ingredient.catalog_name,
+                 Recipe.catalog_name):
+        CatalogVersion.bump(name)
+    progress('counters and search', None, time.monotonic() - started, True)
+    return dict(rows)
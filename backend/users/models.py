@@ -3,10 +3,38 @@ from django.contrib.auth.models import AbstractUser
 from django.db import models
 
 
-class User(AbstractUser):
+class CounterFieldsMixin:
+    """
+    Leave the counter_fields out of full saves of existing rows: they are
+    changed with F() expressions, and the values of an instance loaded
+    earlier (or taken from a cache) would overwrite newer counts.
+    """
+    counter_fields = ()
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            # Отложенные поля тоже не пишутся, как и при обычном save()
+            deferred = self.get_deferred_fields()
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.name not in self.counter_fields
+                and field.attname not in deferred
+            ]
+        super().save(*args, **kwargs)
+
+
+class User(CounterFieldsMixin, AbstractUser):
+    counter_fields = ('recipes_count', 'subscribers_count')
+
     first_name = models.CharField(_('first name'), max_length=150)
     last_name = models.CharField(_('last name'), max_length=150)
     email = models.EmailField(_('email address'), max_length=254)
+    recipes_count = models.PositiveIntegerField(_('recipes count'),
+                                                default=0, editable=False)
+    subscribers_count = models.PositiveIntegerField(_('subscribers count'),
+                                                    default=0,
+                                                    editable=False)
 
     class Meta:
         ordering = ['pk']